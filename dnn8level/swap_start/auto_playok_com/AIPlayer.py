@@ -0,0 +1 @@
+../../../swap_start/auto_playok_com/AIPlayer.py
\ No newline at end of file
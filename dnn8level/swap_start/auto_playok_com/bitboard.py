@@ -0,0 +1 @@
+../../../swap_start/auto_playok_com/bitboard.py
\ No newline at end of file
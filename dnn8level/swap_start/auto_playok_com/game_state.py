@@ -0,0 +1 @@
+../../../swap_start/auto_playok_com/game_state.py
\ No newline at end of file
@@ -0,0 +1 @@
+../torch_train/common/AIPlayer.py
\ No newline at end of file
@@ -2,14 +2,20 @@
 
 from __future__ import print_function, division
 import itertools, time, copy
+import threading
 import collections, random
 import os, pickle
 import numba
 import numpy as np
+from threat_search import vcf_search, new_threat_table
+from bitboard import new_bitboard, set_bitboard
+from patterns import MY_FIVE, OPPONENT_FIVE, HARD_4_SHIFT, line_pattern, pattern_table
+from opening_book import load_book
 
 board_size = 15
 estimate_level = 3
-def strategy(state):
+vcf_max_nodes = 1000 # max number of moves tried in each VCF search, 0 to disable
+def strategy(state, time_left=None):
     """ AI's strategy
 
     Information provided to you:
@@ -20,6 +26,9 @@ def strategy(state):
         x_stones = {(8,8), (8,9), (8,10), (8,11)}
     playing = 0|1, the current player's index
 
+    If strategy.time_manager is set and time_left (seconds on the clock) is given,
+    search deeper level by level until estimate_level or the time given by the time manager runs out
+
     Your strategy will return a position code for the next stone, e.g. (8,7)
 
     """
@@ -48,13 +57,30 @@ def strategy(state):
         state[i-1,j-1] = -1
 
     oppo_state_id = state.tobytes()
-    # clear the U cache
-    U_stone.cache = dict()
+    # start with the U values found while pondering on this position
+    U_stone.cache = pondered_cache(state, last_move)
     alpha = -2.0
     beta = 2.0
     empty_spots_left = np.sum(state==0)
     start_level = -1
-    best_move, best_q = best_action_q(state, empty_spots_left, last_move, alpha, beta, 1, start_level)
+    # the opponent played a move searched while pondering
+    ponder_result = ponder.results.get(oppo_state_id)
+    # the book has black stones as 1, and the opening positions were searched ahead of time
+    book_entry = None
+    if strategy.book is not None:
+        book_entry = strategy.book.lookup(state if playing == 0 else -state, 1 if playing == 0 else -1)
+    # look for a forced win by continuous fours first
+    vcf_move = vcf_search(state, 1, vcf_max_nodes, strategy.vcf_table) if vcf_max_nodes > 0 and book_entry is None and ponder_result is None else -1
+    if ponder_result is not None:
+        best_move, best_q = ponder_result
+    elif book_entry is not None:
+        best_move, best_q = book_entry
+    elif vcf_move >= 0:
+        best_move, best_q = divmod(vcf_move, board_size), 1.0
+    elif strategy.time_manager is not None and time_left is not None:
+        best_move, best_q = iterative_deepening(state, empty_spots_left, last_move, time_left)
+    else:
+        best_move, best_q = best_action_q(state, empty_spots_left, last_move, alpha, beta, 1, start_level)
 
     if oppo_state_id not in strategy.opponent_learndata and best_q != None:
         strategy.opponent_learndata[oppo_state_id] = [state.copy(), -best_q, 1]
@@ -113,9 +139,134 @@ def strategy(state):
 
 
 
+def iterative_deepening(state, empty_spots_left, last_move, time_left):
+    """
+    Search with estimate_level 1, 2, ... until the original estimate_level
+    A deeper search is only started within the soft limit from strategy.time_manager, which is adjusted with the
+    spread of q among my moves after level 1, and stopped at the hard limit
+    Return the result of the deepest finished search
+    """
+    global estimate_level
+    max_level = estimate_level
+    t_start = time.time()
+    soft, hard = strategy.time_manager.budget(time_left, board_size**2 - empty_spots_left)
+    best_move, best_q = None, None
+    finished_level = 0
+    try:
+        for level in range(1, max(max_level, 1)+1):
+            estimate_level = level
+            # the cached values are from the shallower search, the ones from pondering were searched with the full level
+            U_stone.cache = pondered_cache(state, last_move) if level == max_level else dict()
+            best_action_q.root_qs = []
+            # the first search always finishes, so we have a move to play
+            if best_move is not None:
+                best_action_q.deadline = t_start + hard
+            # the search leaves stones on the state when stopped
+            best_move, best_q = best_action_q(state.copy(), empty_spots_left, last_move, -2.0, 2.0, 1, -1)
+            finished_level = level
+            if level == 1:
+                soft = strategy.time_manager.adjust(soft, best_action_q.root_qs)
+            if best_q is None or abs(best_q) >= 1.0 or time.time() - t_start > soft:
+                break
+    except SearchTimeout:
+        pass
+    finally:
+        estimate_level = max_level
+        best_action_q.deadline = None
+        best_action_q.root_qs = None
+    print("Finished level %d in %.1fs, soft limit %.1fs, hard limit %.1fs" % (finished_level, time.time() - t_start, soft, hard))
+    return best_move, best_q
+
+class SearchTimeout(Exception):
+    """ Raised in best_action_q when best_action_q.deadline has passed """
+
+class PonderStopped(Exception):
+    """ Raised in best_action_q to stop pondering """
+
+def ponder(board, playing, n_replies=3):
+    """
+    Search my moves after the most interesting replies of the opponent, while the opponent is thinking
+    board = (x_stones, o_stones) after my move, playing is my index
+    The results are kept in ponder.results, so strategy() plays instantly if the opponent plays one of them
+    The U values of all replies are kept in ponder.cache, which strategy() starts with if the opponent plays another move
+    """
+    strategy.playing = playing
+    if playing == 0:
+        strategy.learndata = strategy.black_learndata
+        strategy.opponent_learndata = strategy.white_learndata
+    else:
+        strategy.learndata = strategy.white_learndata
+        strategy.opponent_learndata = strategy.black_learndata
+    state = np.zeros(board_size**2, dtype=np.int8).reshape(board_size, board_size)
+    for i,j in board[playing]:
+        state[i-1,j-1] = 1
+    for i,j in board[1-playing]:
+        state[i-1,j-1] = -1
+    empty_spots_left = np.sum(state==0)
+    move_interest_values = np.zeros(board_size**2, dtype=np.float32).reshape(board_size,board_size)
+    move_interest_values[4:11, 4:11] = 5.0
+    n_moves = 40 if empty_spots_left > 200 else 20
+    replies = find_interesting_moves(state, empty_spots_left, move_interest_values, -1, n_moves)[:n_replies]
+    ponder.results = dict()
+    # the states after any reply are searched from the same level, so they share the U values
+    ponder.position = state.tobytes()
+    ponder.cache = U_stone.cache = dict()
+    for reply in replies:
+        reply = (reply[0], reply[1])
+        state[reply] = -1
+        if i_win(state, reply, -1):
+            state[reply] = 0
+            continue
+        vcf_move = vcf_search(state, 1, vcf_max_nodes, strategy.vcf_table) if vcf_max_nodes > 0 else -1
+        if vcf_move >= 0:
+            result = divmod(vcf_move, board_size), 1.0
+        else:
+            result = best_action_q(state, empty_spots_left-1, reply, -2.0, 2.0, 1, -1)
+        ponder.results[state.tobytes()] = result
+        state[reply] = 0
+
+def pondered_cache(state, last_move):
+    """ Return a copy of ponder.cache if it was filled on state before the opponent's last_move (1-based), otherwise an empty dict """
+    before = state.copy()
+    before[last_move[0]-1, last_move[1]-1] = 0
+    if ponder.position == before.tobytes():
+        return dict(ponder.cache)
+    return dict()
+
+def start_pondering(board, playing):
+    """ Start ponder() in a thread, until stop_pondering() """
+    stop_pondering()
+    ponder.thread = threading.Thread(target=run_ponder, args=(board, playing), daemon=True)
+    ponder.thread.start()
+
+def run_ponder(board, playing):
+    try:
+        ponder(board, playing)
+    except PonderStopped:
+        pass
+
+def stop_pondering():
+    """ Stop the pondering thread at the next node, strategy() can only be called after this """
+    if ponder.thread is not None:
+        ponder.stopping = True
+        ponder.thread.join()
+        ponder.thread = None
+        ponder.stopping = False
+
+ponder.results = dict()
+# the position the opponent is thinking on, my stones are 1, and the U values of the states searched from it
+ponder.position = None
+ponder.cache = dict()
+ponder.thread = None
+ponder.stopping = False
+
 level_max_n = [50, 50, 50, 50, 20, 20, 15, 15]
 def best_action_q(state, empty_spots_left, last_move, alpha, beta, player, level):
     "Return the optimal action for a state"
+    if ponder.stopping:
+        raise PonderStopped()
+    if best_action_q.deadline is not None and time.time() > best_action_q.deadline:
+        raise SearchTimeout()
     if empty_spots_left == 0: # Board filled up, it's a tie
         return None, 0.0
     #move_interest_values = np.zeros(board_size**2, dtype=np.float32).reshape(board_size,board_size)
@@ -159,6 +310,9 @@ def best_action_q(state, empty_spots_left, last_move, alpha, beta, player, level
         for current_move in interested_moves:
             current_move = (current_move[0], current_move[1]) # convert into tuple
             q = Q_stone(state, empty_spots_left, current_move, alpha, beta, player, level+1)
+            if is_first_move and best_action_q.root_qs is not None:
+                # for the time manager
+                best_action_q.root_qs.append(q)
             if q > alpha: alpha = q
             if q > max_q:
                 max_q = q
@@ -254,6 +408,10 @@ def tf_predict_u(state, empty_spots_left, last_move, player):
         move_interest_values.fill(0)
         interested_moves = find_interesting_moves(next_state, empty_spots_left, move_interest_values, next_player, n_moves)
 
+    # no need for tensorflow if next player has a forced win by continuous fours
+    if vcf_max_nodes > 0 and vcf_search(next_state, next_player, vcf_max_nodes, strategy.vcf_table) >= 0:
+        return 1.0 * next_player
+
     # find the known moves among interested_moves
     tf_moves, move_state_ids = [], []
     max_q = -1.0
@@ -297,7 +455,6 @@ def tf_predict_u(state, empty_spots_left, last_move, player):
     return max_q * next_player # if next_player is opponent, my win rate is negative of his
 
 
-@numba.jit(nopython=True, nogil=True)
 def find_interesting_moves(state, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
     """ Look at state and find the interesing n_move moves.
     input:
@@ -316,176 +473,41 @@ def find_interesting_moves(state, empty_spots_left, move_interest_values, player
 
     #suggested_n_moves: suggested number of moves to
     """
+    return scan_interesting_moves(state, pattern_table, empty_spots_left, move_interest_values, player, n_moves, verbose)
+
+@numba.jit(nopython=True, nogil=True)
+def scan_interesting_moves(state, table, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
+    """ find_interesting_moves() with the pattern table as an argument, the lines are looked up in the table """
     force_to_block = False
     exist_will_win_move = False
-    directions = ((1,1), (1,0), (0,1), (1,-1))
     final_single_move = np.zeros(2, dtype=np.int8).reshape(1,2) # for returning the single move
+    bits = new_bitboard()
+    set_bitboard(bits, state)
+    pidx = 0 if player == 1 else 1
     for r in range(board_size):
         for c in range(board_size):
             if state[r,c] != 0: continue
             interest_value = 10 # as long as it's a valid point, this is for avoiding the taken spaces
             my_hard_4 = 0
-            for dr, dc in directions:
-                my_line_length = 1 # last_move
-                opponent_line_length = 1
-                # try to extend in the positive direction (max 5 times to check overline)
-                ext_r = r
-                ext_c = c
-                skipped_1 = 0
-                my_blocked = False
-                opponent_blocked = False
-                for i in range(5):
-                    ext_r += dr
-                    ext_c += dc
-                    if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                        break
-                    elif state[ext_r, ext_c] == player:
-                        if my_blocked == True:
-                            break
-                        else:
-                            my_line_length += 1
-                            opponent_blocked = True
-                    elif state[ext_r, ext_c] == -player:
-                        if opponent_blocked == True:
-                            break
-                        else:
-                            opponent_line_length += 1
-                            my_blocked = True
-                    else:
-                        if skipped_1 == 0:
-                            skipped_1 = i + 1 # allow one skip and record the position of the skip
-                        else:
-                            # peek at the next one and if it might be useful, add some interest
-                            if ((state[ext_r+dr, ext_c+dc] == player) and (my_blocked == False)) or ((state[ext_r+dr, ext_c+dc] == -player) and (opponent_blocked == False)):
-                                interest_value += 15
-                            break
-
-                # the backward counting starts at the furthest "unskipped" stone
-                forward_my_open = False
-                forward_opponent_open = False
-                if skipped_1 == 0:
-                    my_line_length_back = my_line_length
-                    opponent_line_length_back = opponent_line_length
-                elif skipped_1 == 1:
-                    my_line_length_back = 1
-                    opponent_line_length_back = 1
-                    forward_my_open = True
-                    forward_opponent_open = True
-                else:
-                    if my_blocked == False:
-                        my_line_length_back = skipped_1
-                        opponent_line_length_back = 1
-                        forward_my_open = True
-                    else:
-                        my_line_length_back = 1
-                        opponent_line_length_back = skipped_1
-                        forward_opponent_open = True
-                my_line_length_no_skip = my_line_length_back
-                opponent_line_length_no_skip = opponent_line_length_back
-
-                # backward is a little complicated, will try to extend my stones first
-                ext_r = r
-                ext_c = c
-                skipped_2 = 0
-                opponent_blocked = False
-                for i in range(6-my_line_length_no_skip):
-                    ext_r -= dr
-                    ext_c -= dc
-                    if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                        break
-                    elif state[ext_r, ext_c] == player:
-                        my_line_length_back += 1
-                        opponent_blocked = True
-                    elif state[ext_r, ext_c] == -player:
-                        break
-                    else:
-                        if skipped_2 == 0:
-                            skipped_2 = i + 1
-                        else:
-                            # peek at the next one and if it might be useful, add some interest
-                            if state[ext_r-dr, ext_c-dc] == player:
-                                interest_value += 15
-                            break
-
-                # see if i'm winning
-                if my_line_length_back == 5:
-                    # if there are 5 stones in backward counting, and it's not skipped in the middle
-                    if skipped_2 == 0 or skipped_2 == (6-my_line_length_no_skip):
-                        # i will win with this move, I will place the stone
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        return final_single_move
-
-                # extend my forward line length to check if there is hard 4
-                if skipped_2 == 0:
-                    my_line_length += my_line_length_back - my_line_length_no_skip
-                else:
-                    my_line_length += skipped_2 - 1
-
-                backward_my_open = True if skipped_2 > 0 else False
-                backward_opponent_open = False
-                # then try to extend the opponent
-                if opponent_blocked == True:
-                    if skipped_2 == 1:
-                        backward_opponent_open = True
-                    skipped_2 = 0 # reset the skipped_2 here to enable the check of opponent 5 later
-                else:
-                    ext_r = r
-                    ext_c = c
-                    skipped_2 = 0
-                    for i in range(6-opponent_line_length_no_skip):
-                        ext_r -= dr
-                        ext_c -= dc
-                        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                            break
-                        elif state[ext_r, ext_c] == player:
-                            break
-                        elif state[ext_r, ext_c] == -player:
-                            opponent_line_length_back += 1
-                        else:
-                            if skipped_2 == 0:
-                                skipped_2 = i + 1
-                            else:
-                                # peek at the next one and if it might be useful, add some interest
-                                if state[ext_r-dr, ext_c-dc] == -player:
-                                    interest_value += 15
-                                break
-                    # extend opponent forward line length to check if there is hard 4
-                    if skipped_2 == 0:
-                        opponent_line_length += opponent_line_length_back - opponent_line_length_no_skip
-                    else:
-                        opponent_line_length += skipped_2 - 1
-                        backward_opponent_open = True
-                        # here if opponent_line_length_back == 5, skipped_2 will be 0 and this flag won't be True
-                        # but it do not affect our final result, because we have to block this no matter if it's open
-
-                # check if we have to block this
-                if opponent_line_length_back == 5:
-                    if (skipped_2 == 0) or (skipped_2 == 6-opponent_line_length_no_skip):
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        force_to_block = True
-                if force_to_block == False:
-                    # if I will win after this move, I won't consider other moves
-                    if forward_my_open == True and my_line_length == 4:
-                        my_hard_4 += 1
-                    if backward_my_open == True and my_line_length_back == 4:
-                        my_hard_4 += 1
-                    if my_hard_4 >= 2:
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        exist_will_win_move = True
-                if force_to_block == False and exist_will_win_move == False:
-                    # compute the interest_value for other moves
-                    # if any line length >= 5, it's an overline so skipped
-                    if (forward_my_open == True) and (my_line_length < 5):
-                        interest_value += my_line_length ** 4
-                    if (backward_my_open == True) and (my_line_length_back < 5):
-                        interest_value += my_line_length_back ** 4
-                    if (forward_opponent_open == True) and (opponent_line_length < 5):
-                        interest_value += opponent_line_length ** 4
-                    if (backward_opponent_open == True) and (opponent_line_length_back < 5):
-                        interest_value += opponent_line_length_back ** 4
+            for k in range(4):
+                value, flags = line_pattern(table, bits, r, c, k, pidx)
+                if flags & MY_FIVE:
+                    # i will win with this move, I will place the stone
+                    final_single_move[0,0] = r
+                    final_single_move[0,1] = c
+                    return final_single_move
+                if flags & OPPONENT_FIVE:
+                    # check if we have to block this
+                    final_single_move[0,0] = r
+                    final_single_move[0,1] = c
+                    force_to_block = True
+                my_hard_4 += flags >> HARD_4_SHIFT
+                interest_value += value
+            if force_to_block == False and my_hard_4 >= 2:
+                # if I will win after this move, I won't consider other moves
+                final_single_move[0,0] = r
+                final_single_move[0,1] = c
+                exist_will_win_move = True
             # after looking at all directions, record the total interest_value of this move
             move_interest_values[r, c] += interest_value
             if interest_value > 256: # one (length_4) ** 4, highly interesting move
@@ -661,6 +683,19 @@ def initialize():
 
     reset()
 
+    if not hasattr(strategy, 'vcf_table'):
+        strategy.vcf_table = new_threat_table()
+
+    if not hasattr(strategy, 'book'):
+        strategy.book = load_book('opening_book.npy')
+
+    if not hasattr(strategy, 'time_manager'):
+        strategy.time_manager = None
+
+    # the search stops when the time is past deadline, and the q of my moves are kept in root_qs if it's a list
+    best_action_q.deadline = None
+    best_action_q.root_qs = None
+
     if not hasattr(tf_predict_u, 'all_interest_states'):
         tf_predict_u.all_interest_states = np.zeros(board_size**4 * 3, dtype=np.int8).reshape(board_size**2, board_size, board_size, 3)
 
@@ -669,6 +704,10 @@ def initialize():
 
 def reset():
     """ reset the AI, clean history states """
+    stop_pondering()
+    ponder.results = dict()
+    ponder.position = None
+    ponder.cache = dict()
     strategy.started_from_beginning = True
     strategy.hist_states = []
     strategy.oppo_hist_states = []
@@ -0,0 +1 @@
+../torch_train/common/bitboard.py
\ No newline at end of file
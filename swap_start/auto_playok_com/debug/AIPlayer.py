@@ -0,0 +1 @@
+../AIPlayer.py
\ No newline at end of file
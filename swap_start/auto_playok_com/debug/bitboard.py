@@ -0,0 +1 @@
+../bitboard.py
\ No newline at end of file
@@ -0,0 +1 @@
+../game_state.py
\ No newline at end of file
@@ -0,0 +1 @@
+../opening_book.py
\ No newline at end of file
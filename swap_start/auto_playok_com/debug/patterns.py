@@ -0,0 +1 @@
+../patterns.py
\ No newline at end of file
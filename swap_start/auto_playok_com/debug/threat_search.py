@@ -0,0 +1 @@
+../threat_search.py
\ No newline at end of file
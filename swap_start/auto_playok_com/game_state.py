@@ -0,0 +1 @@
+../torch_train/common/game_state.py
\ No newline at end of file
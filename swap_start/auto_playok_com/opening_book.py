@@ -0,0 +1 @@
+../torch_train/common/opening_book.py
\ No newline at end of file
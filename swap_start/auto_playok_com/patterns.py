@@ -0,0 +1 @@
+../torch_train/common/patterns.py
\ No newline at end of file
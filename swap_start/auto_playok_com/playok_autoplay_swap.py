@@ -3,9 +3,12 @@
 from __future__ import division, print_function
 from Xlib import display, X
 from PIL import Image
-import time, random
+import time, random, functools
 import pyautogui
+import numpy as np
 from colors import COLORS
+from threat_search import vct_search, new_proof_table
+from time_manager import TimeManager
 
 pyautogui.PAUSE = 0.1
 pyautogui.FAILSAFE = True
@@ -400,6 +403,15 @@ def swap_choose_side(scnshot, strategy, expected=3):
     return time_spent
 
 def rough_estimate_q(state):
+    # no need for the AI if there is a victory by continuous threats
+    (black_stones, white_stones), last_move, playing, board_size = state
+    board = np.zeros((board_size, board_size), dtype=np.int8)
+    for i,j in (black_stones, white_stones)[playing]:
+        board[i-1,j-1] = 1
+    for i,j in (black_stones, white_stones)[1-playing]:
+        board[i-1,j-1] = -1
+    if vct_search(board, 1, rough_estimate_q.vct_max_depth, rough_estimate_q.vct_max_nodes, *rough_estimate_q.vct_table) >= 0:
+        return 1.0
     orig_level = rough_estimate_q.AI.estimate_level
     rough_estimate_q.AI.estimate_level = 2
     _, q = rough_estimate_q.AI.strategy(state)
@@ -425,7 +437,7 @@ def main():
     import argparse
     parser = argparse.ArgumentParser(description='Player Gomoku on playok.com', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-t', '--time', default=5, type=int, help='Time limit in minutes')
-    parser.add_argument('-l', '--level', default=3, type=int, help='Estimate Level')
+    parser.add_argument('-l', '--level', default=3, type=int, help='Max Estimate Level, the time manager decides how deep to search each move')
     parser.add_argument('-d', '--detect', default=False, action='store_true', help='Detect game board at beginning')
     args = parser.parse_args()
 
@@ -451,8 +463,12 @@ def main():
     model = load_existing_model('tf_model.h5')
     AI_Swap.tf_predict_u.model = model
     AI_Swap.initialize()
+    AI_Swap.strategy.time_manager = TimeManager()
 
     rough_estimate_q.AI = AI_Swap
+    rough_estimate_q.vct_max_depth = 7
+    rough_estimate_q.vct_max_nodes = 20000
+    rough_estimate_q.vct_table = new_proof_table()
 
     time_spent = 0
     total_time = args.time * 60
@@ -464,6 +480,7 @@ def main():
             if status == -1: # game board not found
                 time.sleep(1)
             elif status == 1:
+                AI_Swap.stop_pondering()
                 time.sleep(1)
                 # try to click the start button and wait for game start
                 if click_start(scnshot) == True:
@@ -484,21 +501,18 @@ def main():
                     if last_move == None:
                         print("Warning: Did not find last move! Rechecking state ...")
                         continue
-                    t = play_one_move(scnshot, AI_Swap.strategy)
+                    AI_Swap.stop_pondering()
+                    t = play_one_move(scnshot, functools.partial(AI_Swap.strategy, time_left=total_time - time_spent))
                     if t is None: continue
                     time_spent += t
+                    if t > 0:
+                        # search my next move on the opponent's time
+                        AI_Swap.start_pondering(read_game_state(scnshot)[0], playing)
                     # check how much time left
                     time_left = total_time - time_spent
                     print("Time Left: %02d:%02d " % divmod(time_left, 60))
-                    tdown2 = min(total_time*0.6, 60)
-                    if time_left < tdown2 and AI_Swap.estimate_level > 2:
-                        print("Switching to fast mode, AI level = 2")
-                        AI_Swap.estimate_level = 2
-                    tdown1 = min(total_time*0.3, 30)
-                    if time_left < tdown1 and AI_Swap.estimate_level > 1:
-                        print("Switching to ultrafast mode, AI level = 1")
-                        AI_Swap.estimate_level = 1
         except (KeyboardInterrupt, pyautogui.FailSafeException):
+            AI_Swap.stop_pondering()
             new_total_time = input("Stopped by user, enter new time limit in minutes, or enter to continue...")
             try:
                 total_time = float(new_total_time)*60
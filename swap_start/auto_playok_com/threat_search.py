@@ -0,0 +1 @@
+../torch_train/common/threat_search.py
\ No newline at end of file
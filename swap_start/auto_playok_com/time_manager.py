@@ -0,0 +1 @@
+../torch_train/common/time_manager.py
\ No newline at end of file
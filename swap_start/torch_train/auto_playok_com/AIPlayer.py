@@ -1 +1 @@
-../1_torch/AIPlayer.py
\ No newline at end of file
+../common/AIPlayer.py
\ No newline at end of file
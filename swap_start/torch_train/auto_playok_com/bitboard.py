@@ -0,0 +1 @@
+../common/bitboard.py
\ No newline at end of file
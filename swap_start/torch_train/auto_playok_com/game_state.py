@@ -0,0 +1 @@
+../common/game_state.py
\ No newline at end of file
@@ -0,0 +1 @@
+../common/opening_book.py
\ No newline at end of file
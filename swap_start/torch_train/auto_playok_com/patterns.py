@@ -0,0 +1 @@
+../common/patterns.py
\ No newline at end of file
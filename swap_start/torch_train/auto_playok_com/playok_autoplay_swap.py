@@ -3,7 +3,7 @@
 from __future__ import division, print_function
 from Xlib import display, X
 from PIL import Image
-import time, random
+import time, random, functools
 import pyautogui
 from colors import COLORS
 
@@ -419,8 +419,10 @@ def main():
     parser = argparse.ArgumentParser(description='Player Gomoku on playok.com', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-t', '--time', default=5, type=int, help='Time limit in minutes')
     parser.add_argument('-l', '--level', default=3, type=int, help='Estimate Level')
+    parser.add_argument('-s', '--move_time', default=0, type=float, help='Seconds to think for each move, search deeper until the Estimate Level or time runs out, at most the hard limit of the time manager, 0 to let the time manager decide')
     parser.add_argument('-d', '--detect', default=False, action='store_true', help='Detect game board at beginning')
     parser.add_argument('-m', '--model_file', default='dnn_model.pt', help='File to load model from')
+    parser.add_argument('-b', '--book', default='opening_book.npy', help='Opening book file, used if it exists')
     args = parser.parse_args()
 
     if args.detect:
@@ -442,7 +444,15 @@ def main():
     # load the AI player
     from AIPlayer import AIPlayer
     from dnn_model import load_existing_model
-    player = AIPlayer('p', level=args.level, model=load_existing_model(args.model_file))
+    from opening_book import load_book
+    from time_manager import TimeManager
+    player = AIPlayer('p', level=args.level, model=load_existing_model(args.model_file), pruning=True)
+    player.book = load_book(args.book)
+    if args.move_time > 0:
+        strategy = functools.partial(player.strategy, time_budget=args.move_time)
+    else:
+        strategy = player.strategy
+    time_manager = TimeManager()
 
     time_spent = 0
     total_time = args.time * 60
@@ -460,7 +470,7 @@ def main():
                     # if game started, we check if we are the black first
                     player.level = args.level
                     print("Game started with AI level = %d" % args.level)
-                    time_spent = choose_swap_start(scnshot, scnshot2, player.strategy)
+                    time_spent = choose_swap_start(scnshot, scnshot2, strategy)
                     player.reset()
                     print("Time Left: %02d:%02d " % divmod(total_time - time_spent, 60))
             else:
@@ -474,20 +484,20 @@ def main():
                     if last_move == None:
                         print("Warning: Did not find last move! Rechecking state ...")
                         continue
-                    t = play_one_move(scnshot, player.strategy)
+                    soft, hard = time_manager.budget(total_time - time_spent, len(board[0]) + len(board[1]))
+                    if args.move_time > 0:
+                        # the fixed time, unless the clock is running out
+                        move_strategy = functools.partial(player.strategy, time_budget=min(args.move_time, hard))
+                    else:
+                        # search deeper until the hard limit, don't start a deeper level after the soft limit,
+                        # which is adjusted with the spread of q among the moves after the first level
+                        move_strategy = functools.partial(player.strategy, time_budget=hard, soft_budget=soft, time_manager=time_manager)
+                    t = play_one_move(scnshot, move_strategy)
                     if t is None: continue
                     time_spent += t
                     # check how much time left
                     time_left = total_time - time_spent
                     print("Time Left: %02d:%02d " % divmod(time_left, 60))
-                    tdown2 = min(total_time*0.6, 60)
-                    if time_left < tdown2 and player.level > 2:
-                        print("Switching to fast mode, AI level = 2")
-                        player.level = 2
-                    tdown1 = min(total_time*0.3, 30)
-                    if time_left < tdown1 and player.level > 1:
-                        print("Switching to ultrafast mode, AI level = 1")
-                        player.level = 1
         except (KeyboardInterrupt, pyautogui.FailSafeException):
             new_total_time = input("Stopped by user, enter new time limit in minutes, or enter to continue...")
             try:
@@ -0,0 +1 @@
+../common/threat_search.py
\ No newline at end of file
@@ -0,0 +1 @@
+../common/time_manager.py
\ No newline at end of file
@@ -2,20 +2,55 @@
 
 from __future__ import print_function, division
 import itertools, time, copy
+import multiprocessing as mp
 import collections, random
 import os, pickle
 import numba
 from numba import cuda
 import numpy as np
+from threat_search import vcf_search, new_threat_table, vct_search, new_proof_table
+from bitboard import new_bitboard, set_bitboard, place_stone, remove_stone, count_five_spots, is_win_next
+from patterns import MY_FIVE, OPPONENT_FIVE, EXACT_FIVE, HARD_4_SHIFT, line_pattern, pattern_table
+from game_state import GameState
 
 board_size = 15
 show_q = False
 
 class AIPlayer:
-    def __init__(self, name, model=None, level=0):
+    def __init__(self, name, model=None, level=0, symmetric=False, pruning=False):
         self.name = name
         self.load_model(model)
         self.level = level
+        # if True, symmetric states (rotated or mirrored) will share the same cache key
+        self.symmetric = symmetric
+        # if True, use alpha-beta pruning in best_action_q
+        self.pruning = pruning
+        # the time when the search has to stop, None if no limit
+        self.deadline = None
+        # max number of moves tried in each VCF search, 0 to disable
+        self.vcf_max_nodes = 1000
+        self.vcf_table = new_threat_table()
+        # max number of attacker moves and tried moves in each VCT search before going deeper, 0 to disable
+        # proved and disproved states are kept in vct_table between searches
+        self.vct_max_depth = 5
+        self.vct_max_nodes = 300
+        self.vct_table = new_proof_table()
+        # LineBoard of the state being searched in best_action_q
+        self.board = None
+        # number of leaves of sibling subtrees collected before evaluating them in one model.predict, 0 to disable
+        # otherwise the leaves are evaluated one node (20-40 positions) at a time
+        # not used with pruning, the cutoffs skip most of the leaves that would be evaluated ahead
+        self.leaf_batch_size = 0
+        self.leaf_states = np.zeros((0, 3, board_size, board_size), dtype=np.float32)
+        # process pool searching the subtrees of the first moves with more than one choice, see start_root_pool()
+        self.root_pool = None
+        # OpeningBook consulted before searching, None to always search
+        self.book = None
+        # SearchStats of the move being searched, None when not collecting
+        self.stats = None
+        # if True, the SearchStats of every move are kept in self.game_stats until reset()
+        self.collect_stats = False
+        self.game_stats = []
         self.learndata = dict()
         self.opponent = None
         self.all_interest_states = np.zeros(board_size**4 * 3, dtype=np.float32).reshape(board_size**2, 3, board_size, board_size)
@@ -40,12 +75,13 @@ class AIPlayer:
         self.hist_states = []
         self.surprised = False
         self.started_from_beginning = True
+        self.game_stats = []
 
     def reset_cache(self):
         """ Reset cache before using new model """
-        self.cache = LeveledCache(maxlevel=self.level, maxsize=2000000)
+        self.cache = TranspositionTable(maxsize=2000000)
 
-    def strategy(self, board_state, starting_level=0):
+    def strategy(self, board_state, starting_level=0, time_budget=None, soft_budget=None, return_stats=False, time_manager=None):
         """ AI's strategy 
         Information provided to you:
         board_state = (board, last_move, playing, board_size)
@@ -54,35 +90,155 @@ class AIPlayer:
             x_stones = {(8,8), (8,9), (8,10), (8,11)}
         playing = 0|1, the current player's index
 
+        If time_budget (seconds) is given, search deeper level by level until self.level or time runs out,
+        no deeper level is started after soft_budget seconds if given
+        With a TimeManager as time_manager, soft_budget is adjusted with the spread of q after the first level
+
+        board_state can also be a GameState, whose board is used without rebuilding it from the stones
+
         Your strategy will return a position code for the next stone, e.g. (8,7)
+        With return_stats, the SearchStats of this move are returned too, as (move, q, stats)
         """
-        # load input board_state
-        board, last_move, playing, board_size = board_state
-        self.playing_white = bool(playing)
-        # build new state representation
-        state = np.zeros(board_size**2, dtype=np.int8).reshape(board_size, board_size)
-        # put black stones, update index
-        for br, bc in board[0]:
-            state[br-1,bc-1] = 1
-        # put white stones, update index
-        for wr, wc in board[1]:
-            state[wr-1,wc-1] = -1
-        # update index 1 -> 0 for last_move
-        last_move = (last_move[0]-1, last_move[1]-1)
+        if isinstance(board_state, GameState):
+            self.playing_white = bool(board_state.playing)
+            state = board_state.board.copy()
+            empty_spots_left = board_state.empty_spots_left
+        else:
+            # load input board_state
+            board, last_move, playing, board_size = board_state
+            self.playing_white = bool(playing)
+            # build new state representation
+            state = np.zeros(board_size**2, dtype=np.int8).reshape(board_size, board_size)
+            # put black stones, update index
+            for br, bc in board[0]:
+                state[br-1,bc-1] = 1
+            # put white stones, update index
+            for wr, wc in board[1]:
+                state[wr-1,wc-1] = -1
+            empty_spots_left = board_size**2 - len(board[0]) - len(board[1])
         # prepare input for best_action_q
         alpha = -2.0
         beta = 2.0
-        empty_spots_left = board_size**2 - len(board[0]) - len(board[1])
         # predict next best action and q
         player = -1 if self.playing_white else 1
-        # TODO: remove .copy()
-        best_move, best_q = self.best_action_q(state.copy(), empty_spots_left, alpha, beta, player, level=starting_level)
+        # start a new generation of cache, older entries will be replaced first
+        self.cache.new_generation()
+        if return_stats or self.collect_stats:
+            self.stats = SearchStats()
+        t_start = time.time()
+        # the opening positions were searched ahead of time
+        book_entry = self.book.lookup(state, player) if self.book is not None else None
+        # look for a forced win by continuous fours first
+        vcf_move = self.find_vcf(state, player) if book_entry is None else None
+        if book_entry is not None:
+            best_move, best_q = book_entry
+            if self.stats is not None:
+                self.stats.shortcuts['book'] += 1
+        elif vcf_move is not None:
+            best_move, best_q = vcf_move, 1.0
+            if self.stats is not None:
+                self.stats.shortcuts['vcf'] += 1
+        elif time_budget is None:
+            # TODO: remove .copy()
+            best_move, best_q = self.best_action_q(state.copy(), empty_spots_left, alpha, beta, player, level=starting_level, state_hash=self.compute_hash(state))
+        else:
+            best_move, best_q = self.iterative_deepening(state, empty_spots_left, player, starting_level, time_budget, soft_budget, time_manager)
         # save the winrate and the state
         self.update_if_game_finish(state, best_move, best_q, player)
+        stats, self.stats = self.stats, None
+        if stats is not None:
+            stats.seconds = time.time() - t_start
+            if self.collect_stats:
+                self.game_stats.append(stats)
         # return the best move
+        if return_stats:
+            return (best_move[0]+1, best_move[1]+1), best_q, stats
         return (best_move[0]+1, best_move[1]+1), best_q
 
-    def best_action_q(self, state, empty_spots_left, alpha, beta, player, level=0):
+    def log_game_stats(self, f, **info):
+        """ Write the SearchStats of the moves of this game, collected with self.collect_stats, as a line of JSON to file f
+        info is added to the line, e.g. the game number and the winner """
+        import json
+        f.write(json.dumps(dict(info, player=self.name, level=self.level, moves=[stats.as_dict() for stats in self.game_stats])) + '\n')
+
+    def iterative_deepening(self, state, empty_spots_left, player, starting_level, time_budget, soft_budget=None, time_manager=None):
+        """
+        Search with increasing self.level, starting from starting_level until the original self.level
+        Each search starts with the best move from the previous one
+        Return the result of the deepest finished search when time_budget (seconds) runs out,
+        or when a search finishes after soft_budget seconds, as the next one would take several times longer
+        If time_manager is given, soft_budget is changed by time_manager.adjust() with the q of the root moves after the first search
+        """
+        max_level = self.level
+        state_hash = self.compute_hash(state)
+        best_move, best_q = None, None
+        t_start = time.time()
+        try:
+            for level in range(starting_level, max(max_level, starting_level)+1):
+                self.level = level
+                # the first search always finishes, so we have a move to play
+                if best_move is not None:
+                    self.deadline = t_start + time_budget
+                first_search = best_move is None
+                best_move, best_q = self.best_action_q(state.copy(), empty_spots_left, -2.0, 2.0, player, level=starting_level,
+                                                       state_hash=state_hash, first_move=best_move)
+                # no need to go deeper if the game result is known
+                if abs(best_q) >= 1.0:
+                    break
+                if first_search and time_manager is not None and soft_budget is not None:
+                    soft_budget = time_manager.adjust(soft_budget, self.root_qs(state, state_hash, empty_spots_left, player, starting_level))
+                if soft_budget is not None and time.time() - t_start > soft_budget:
+                    break
+        except SearchTimeout:
+            pass
+        finally:
+            self.level = max_level
+            self.deadline = None
+        return best_move, best_q
+
+    def root_qs(self, state, state_hash, empty_spots_left, player, level):
+        """
+        Return the values in cache of the interesting moves at state, searched from level, as player's win rates
+        The bounds stored with pruning are included, an upper bound of a move that was cut off overestimates it
+        """
+        n_moves = 40 if empty_spots_left > 200 else 20
+        self.move_interest_values.fill(0)
+        self.move_interest_values[4:11, 4:11] = 5.0
+        moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, n_moves)
+        qs = []
+        for move in moves:
+            move_id = hash_key(hash_add_stone(state_hash, (move[0], move[1]), player))
+            # an inverted window so that any bound is returned
+            q = self.cache.get(move_id, max(self.level - level, 0), 2.0, -2.0)
+            if q is not None:
+                qs.append(float(q))
+        return qs
+
+    def start_root_pool(self, models):
+        """
+        Start len(models) worker processes, each has its own AIPlayer with its own cache and models[i] as the model,
+        e.g. a model file, or the clients of an InferenceServer
+        Until stop_root_pool(), the subtree of each move at the root (the first node with more than one move to search)
+        is searched in a worker, and the results are merged here
+        """
+        ctx = mp.get_context()
+        settings = dict(level=self.level, symmetric=self.symmetric, pruning=self.pruning, vcf_max_nodes=self.vcf_max_nodes,
+                        vct_max_depth=self.vct_max_depth, vct_max_nodes=self.vct_max_nodes, leaf_batch_size=self.leaf_batch_size)
+        self.root_pool = ctx.Pool(len(models), initializer=root_worker_init, initargs=(models, ctx.Value('i', 0), settings))
+
+    def stop_root_pool(self):
+        """ Stop the worker processes of start_root_pool() """
+        if self.root_pool is not None:
+            self.root_pool.close()
+            self.root_pool.join()
+            self.root_pool = None
+
+    def search_root_moves(self, state, state_hash, empty_spots_left, moves, alpha, beta, player, level):
+        """ Return the win rates of player after each move, searched in the root pool with the window (alpha, beta) """
+        tasks = [(state, state_hash, empty_spots_left, move, alpha, beta, player, level, self.level, self.deadline) for move in moves]
+        return self.root_pool.map(root_worker_search, tasks, chunksize=1)
+
+    def best_action_q(self, state, empty_spots_left, alpha, beta, player, level=0, state_hash=None, first_move=None):
         """ 
         Get the optimal action for a state and the predicted win rate for player
 
@@ -93,11 +249,17 @@ class AIPlayer:
         empty_spots_left: int
             How many empty spots are left, easy to keep track
         alpha: float
-            Current alpha value in alpha-beta pruning, the running min of the max win rate
+            Current alpha value in alpha-beta pruning, the win rate player is already guaranteed
         beta: float
-            Current beta value in alpha-beta pruning, the running max of the min win rate
+            Current beta value in alpha-beta pruning, the win rate the opponent is already guaranteed, negated
+            When pruning, the returned best_q is an upper bound if <= alpha, and a lower bound if >= beta
         player: int
             The current player. 1 is black, -1 is white
+        state_hash: int, tuple or None
+            The zobrist hash of state, computed from state if not provided
+            In symmetric mode, it is a tuple of the hashes of all 8 symmetric states
+        first_move: tuple(int, int) or None
+            The move to search first if it's interesting, e.g. the best move of a shallower search
 
         Returns
         -------
@@ -108,31 +270,56 @@ class AIPlayer:
         """
         if empty_spots_left == 0: # Board filled up, it's a tie
             return (0,0), 0.0
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SearchTimeout()
+        if state_hash is None:
+            state_hash = self.compute_hash(state)
+        if self.board is None or self.board.state is not state:
+            # a new state to search, the board will follow the moves in next_iter_winrate
+            self.board = LineBoard(state)
         verbose = False
         n_moves = 40 if empty_spots_left > 200 else 20
         self.move_interest_values.fill(0) # reuse the same array to save init cost
         self.move_interest_values[4:11, 4:11] = 5.0 # manually assign higher interest in middle
-        interested_moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, n_moves, verbose)
+        if self.stats is not None:
+            t0 = time.perf_counter()
+        interested_moves = self.board.find_interesting_moves(empty_spots_left, self.move_interest_values, player, n_moves, verbose)
+        if self.stats is not None:
+            self.stats.numba_seconds += time.perf_counter() - t0
+            self.stats.nodes[level] += 1
+            self.stats.interesting_moves[level] += len(interested_moves)
+        if first_move is not None:
+            # move first_move to the front
+            is_first = (interested_moves[:,0] == first_move[0]) & (interested_moves[:,1] == first_move[1])
+            interested_moves = np.concatenate((interested_moves[is_first], interested_moves[~is_first]))
         #best_move = (-1,-1) # admit defeat if all moves have 0 win rate
         best_move = (interested_moves[0,0], interested_moves[0,1]) # continue to play even I'm losing
         # if there is only one move to place, directly return that move, use same level
         if len(interested_moves) == 1:
+            if self.stats is not None:
+                self.stats.shortcuts['forced'] += 1
             # check if this move is known
-            move, move_q, unknown_moves, unknown_move_ids = self.check_known(state, interested_moves, player, level, forced=True)
+            move, move_q, unknown_moves, unknown_move_ids = self.check_known(state, state_hash, interested_moves, player, level, alpha, beta, forced=True)
             if move != None:
                 best_q = move_q
             else:
-                best_q = self.next_iter_winrate(state, empty_spots_left, best_move, alpha, beta, player, level)
+                best_q = self.next_iter_winrate(state, state_hash, empty_spots_left, best_move, alpha, beta, player, level)
             return best_move, best_q
         # if there are multiple moves to evaluate, check cache first
-        best_move, max_q, unknown_moves, unknown_move_ids = self.check_known(state, interested_moves, player, level)
+        best_move, max_q, unknown_moves, unknown_move_ids = self.check_known(state, state_hash, interested_moves, player, level, alpha, beta)
         if len(unknown_moves) > 0:
             # for unknown moves, if level has reached, evaluate with DNN model
             if level >= self.level:
+                # no need for DNN if there is a forced win
+                vcf_move = self.find_vcf(state, player)
+                if vcf_move is not None:
+                    if self.stats is not None:
+                        self.stats.shortcuts['vcf'] += 1
+                    return vcf_move, 1.0
                 dnn_q_array = self.dnn_evaluate(state, unknown_moves, player)
                 # store the values in cache
                 for move_id, dnn_q in zip(unknown_move_ids, dnn_q_array):
-                    self.cache.set(move_id, dnn_q, level)
+                    self.cache_set(move_id, dnn_q, 0)
                 # find the best move from tf results
                 dnn_best_move_idx = np.argmax(dnn_q_array)
                 dnn_max_q = dnn_q_array[dnn_best_move_idx]
@@ -141,11 +328,60 @@ class AIPlayer:
                     max_q = dnn_max_q
                     best_move = unknown_moves[dnn_best_move_idx]
             else:
+                # no need to search the subtree if there is a forced win
+                vct_move = self.find_vct(state, player)
+                if vct_move is not None:
+                    if self.stats is not None:
+                        self.stats.shortcuts['vct'] += 1
+                    return vct_move, 1.0
+                if self.root_pool is not None:
+                    # search the subtrees in the workers, when pruning the first move is searched alone
+                    # so its value narrows the window of the others
+                    n_first = 1 if self.pruning else len(unknown_moves)
+                    for start, end in ((0, n_first), (n_first, len(unknown_moves))):
+                        move_alpha = max(alpha, max_q) if self.pruning else alpha
+                        if start == end or move_alpha >= beta or max_q >= 1.0:
+                            break
+                        q_array = self.search_root_moves(state, state_hash, empty_spots_left, unknown_moves[start:end], move_alpha, beta, player, level+1)
+                        for move, move_id, q in zip(unknown_moves[start:end], unknown_move_ids[start:end], q_array):
+                            # store the results in cache, as in the loop below
+                            if not self.pruning:
+                                bound = EXACT
+                            elif q <= move_alpha:
+                                bound = UPPER_BOUND
+                            elif q >= beta:
+                                bound = LOWER_BOUND
+                            else:
+                                bound = EXACT
+                            self.cache_set(move_id, q, self.level-level, bound)
+                            if q > max_q:
+                                max_q = q
+                                best_move = move
+                    return best_move, max_q
+                if self.leaf_batch_size > 0 and not self.pruning and level == self.level - 1:
+                    # the next level evaluates its moves with DNN, do them all together first
+                    self.prefetch_leaves(state, state_hash, empty_spots_left, unknown_moves, player)
                 # if level has not reached yet, go deeper to the next level
                 for move, move_id in zip(unknown_moves, unknown_move_ids):
-                    q = self.next_iter_winrate(state, empty_spots_left, move, alpha, beta, player, level+1)
-                    # store the result in cache
-                    self.cache.set(move_id, q, level+1)
+                    if self.pruning:
+                        # the opponent won't let us reach here, cut off
+                        if max_q >= beta:
+                            break
+                        # narrow the window with the best move found so far
+                        move_alpha = max(alpha, max_q)
+                        q = self.next_iter_winrate(state, state_hash, empty_spots_left, move, move_alpha, beta, player, level+1)
+                        # store the result in cache, it's only a bound if it's out of the window
+                        if q <= move_alpha:
+                            bound = UPPER_BOUND
+                        elif q >= beta:
+                            bound = LOWER_BOUND
+                        else:
+                            bound = EXACT
+                        self.cache_set(move_id, q, self.level-level, bound)
+                    else:
+                        q = self.next_iter_winrate(state, state_hash, empty_spots_left, move, alpha, beta, player, level+1)
+                        # store the result in cache
+                        self.cache_set(move_id, q, self.level-level)
                     if q > max_q:
                         max_q = q
                         best_move = move
@@ -154,27 +390,44 @@ class AIPlayer:
                         break
         return best_move, max_q
 
-    def next_iter_winrate(self, state, empty_spots_left, current_move, alpha, beta, player, level):
+    def next_iter_winrate(self, state, state_hash, empty_spots_left, current_move, alpha, beta, player, level):
         """Execute the step of the player, then return the winrate by computing next step"""
-        # update the stone down
-        state[current_move] = player
+        # update the stone down, and the hash with it
+        if self.stats is not None:
+            t0 = time.perf_counter()
+        self.board.place(current_move, player)
+        if self.stats is not None:
+            self.stats.numba_seconds += time.perf_counter() - t0
+        state_hash = hash_add_stone(state_hash, current_move, player)
         # known moves were handled already, here we evaluate opponents winrate
-        opponent_best_move, opponent_best_q = self.best_action_q(state, empty_spots_left-1, alpha, beta, -player, level)
+        # the window is negated for the opponent
+        opponent_best_move, opponent_best_q = self.best_action_q(state, empty_spots_left-1, -beta, -alpha, -player, level, state_hash)
         # recover state
-        state[current_move] = 0
+        if self.stats is not None:
+            t0 = time.perf_counter()
+        self.board.remove(current_move)
+        if self.stats is not None:
+            self.stats.numba_seconds += time.perf_counter() - t0
         # my winrate is opposite of opponents
         return -opponent_best_q
 
-    def check_known(self, state, interested_moves, player, level, forced=False):
+    def check_known(self, state, state_hash, interested_moves, player, level, alpha=-2.0, beta=2.0, forced=False):
         """
         Check which move in interested moves is known, using cache and ending condition
+        Cached bounds are only used if they are out of the window (alpha, beta)
         forced = true when find_interested_moves only return 1 move
         In this case, we will check ending condition i_win, i_lost or i_will_win
+        The returned unknown_move_ids are the cache keys of the states after each move
+        Moves leading to the same key as an earlier unknown move (symmetric states) are skipped
+        i_win, i_lost and i_will_win are read from self.board, which has the state without the move
         """
         max_q = -100
         best_move = None
         unknown_moves = []
         unknown_move_ids = []
+        unknown_id_set = set()
+        # the moves need to be searched this deep to be known, 0 means evaluated by DNN
+        search_depth = max(self.level - level, 0)
         for move in interested_moves:
             this_move = (move[0], move[1])
             assert state[this_move] == 0 # interest move should be empty here
@@ -182,7 +435,7 @@ class AIPlayer:
             state[this_move] = player
             if forced:
                 # if I won, pick this move and early return
-                if i_win(state, this_move, player):
+                if self.board.i_win(this_move, player):
                     # restore state 
                     state[this_move] = 0
                     # early return
@@ -192,18 +445,23 @@ class AIPlayer:
                     unknown_move_ids = []
                     break
                 # if I lost, q is known to be -1.0
-                elif i_lost(state, player):
+                elif self.board.i_lost(player, this_move):
                     # restore state 
                     state[this_move] = 0
                     # q of this move is -1
                     q = -1.0
-            # compute cache key
-            this_state_id = state.tobytes()
+            # compute cache key by adding this move to the hash
+            this_state_id = hash_key(hash_add_stone(state_hash, this_move, player))
             # check if its cached
-            q = self.cache.get(this_state_id, level)
+            q = self.cache.get(this_state_id, search_depth, alpha, beta)
+            if self.stats is not None:
+                if q is None:
+                    self.stats.cache_misses[search_depth] += 1
+                else:
+                    self.stats.cache_hits[search_depth] += 1
             # if not cached, check if I will win
             if q is None:
-                if forced and i_will_win(state, this_move, player):
+                if forced and self.board.i_will_win(this_move, player):
                     q = 1.0
             if q is not None:
                 # early return when found winning move
@@ -220,15 +478,65 @@ class AIPlayer:
                 elif q > max_q:
                     max_q = q
                     best_move = this_move
-            else:
+            elif this_state_id not in unknown_id_set:
                 # q is not known
                 unknown_moves.append(this_move)
                 unknown_move_ids.append(this_state_id)
+                unknown_id_set.add(this_state_id)
             # restore state 
             state[this_move] = 0
         return best_move, max_q, unknown_moves, unknown_move_ids
 
-    
+    def find_vcf(self, state, player):
+        """ Return the first move of a victory by continuous fours for player, or None if not found """
+        if self.vcf_max_nodes <= 0:
+            return None
+        if self.stats is not None:
+            t0 = time.perf_counter()
+        vcf_move = vcf_search(state, player, self.vcf_max_nodes, self.vcf_table)
+        if self.stats is not None:
+            self.stats.numba_seconds += time.perf_counter() - t0
+        if vcf_move < 0:
+            return None
+        return divmod(vcf_move, board_size)
+
+    def find_vct(self, state, player):
+        """ Return the first move of a victory by continuous threats for player, None if not found """
+        if self.vct_max_depth <= 0 or self.vct_max_nodes <= 0:
+            return None
+        if self.stats is not None:
+            t0 = time.perf_counter()
+        vct_move = vct_search(state, player, self.vct_max_depth, self.vct_max_nodes, *self.vct_table)
+        if self.stats is not None:
+            self.stats.numba_seconds += time.perf_counter() - t0
+        if vct_move < 0:
+            return None
+        return divmod(vct_move, board_size)
+
+    def compute_hash(self, state):
+        """ Compute the hash of state from scratch, a tuple of 8 hashes in symmetric mode """
+        if self.symmetric:
+            return tuple(zobrist_sym_hashes(state).tolist())
+        else:
+            return zobrist_hash(state)
+
+    def cache_set(self, key, value, depth, bound=0):
+        """ self.cache.set(), counting the evicted entries in self.stats """
+        evicted = self.cache.set(key, value, depth, bound)
+        if evicted and self.stats is not None:
+            self.stats.evictions += 1
+
+    def model_predict(self, x):
+        """ self.model.predict(x), counting the calls, the states and the time in self.stats """
+        if self.stats is None:
+            return self.model.predict(x)
+        t0 = time.perf_counter()
+        predict_y = self.model.predict(x)
+        self.stats.model_seconds += time.perf_counter() - t0
+        self.stats.dnn_calls += 1
+        self.stats.dnn_positions += len(x)
+        return predict_y
+
     def dnn_evaluate(self, state, dnn_moves, player):
         n_dnn = len(dnn_moves)
         if n_dnn > 0:
@@ -239,11 +547,59 @@ class AIPlayer:
             for i,current_move in enumerate(dnn_moves):
                 ci, cj = current_move
                 all_interest_states[i,0,ci,cj] = 1 # put current move down
-            predict_y = self.model.predict(all_interest_states)
+            predict_y = self.model_predict(all_interest_states)
             return predict_y.ravel()
         else:
             return []
 
+    def prefetch_leaves(self, state, state_hash, empty_spots_left, moves, player):
+        """
+        Collect the states the opponent's nodes after moves would evaluate with DNN, without searching them,
+        evaluate them in batches of self.leaf_batch_size and store the values in cache, where the search will find them
+        The nodes with a single (forced) move or a VCF are left to the search
+        """
+        if len(self.leaf_states) != self.leaf_batch_size:
+            self.leaf_states = np.zeros((self.leaf_batch_size, 3, board_size, board_size), dtype=np.float32)
+        opponent = -player
+        n_moves = 40 if empty_spots_left-1 > 200 else 20
+        leaf_ids = []
+        leaf_id_set = set()
+        for move in moves:
+            if self.deadline is not None and time.time() > self.deadline:
+                raise SearchTimeout()
+            self.board.place(move, player)
+            move_hash = hash_add_stone(state_hash, move, player)
+            # same as the opponent's best_action_q
+            self.move_interest_values.fill(0)
+            self.move_interest_values[4:11, 4:11] = 5.0
+            opponent_moves = self.board.find_interesting_moves(empty_spots_left-1, self.move_interest_values, opponent, n_moves)
+            # with a forced win the opponent won't use DNN
+            if len(opponent_moves) > 1 and self.find_vcf(state, opponent) is None:
+                for r, c in opponent_moves:
+                    leaf_id = hash_key(hash_add_stone(move_hash, (r, c), opponent))
+                    if leaf_id in leaf_id_set or self.cache.get(leaf_id, 0) is not None:
+                        continue
+                    # the state after the opponent's move, from the opponent's view as in dnn_evaluate
+                    i = len(leaf_ids)
+                    self.leaf_states[i,0] = (state == opponent)
+                    self.leaf_states[i,1] = (state == player)
+                    self.leaf_states[i,2] = 1 if opponent == 1 else 0
+                    self.leaf_states[i,0,r,c] = 1
+                    leaf_ids.append(leaf_id)
+                    leaf_id_set.add(leaf_id)
+                    if len(leaf_ids) == self.leaf_batch_size:
+                        self.evaluate_leaves(leaf_ids)
+                        leaf_ids = []
+            self.board.remove(move)
+        if len(leaf_ids) > 0:
+            self.evaluate_leaves(leaf_ids)
+
+    def evaluate_leaves(self, leaf_ids):
+        """ Evaluate the first len(leaf_ids) states in self.leaf_states with DNN, store the values in cache """
+        predict_y = self.model_predict(self.leaf_states[:len(leaf_ids)]).ravel()
+        for leaf_id, q in zip(leaf_ids, predict_y):
+            self.cache_set(leaf_id, q, 0)
+
     def update_if_game_finish(self, state, best_move, best_q, player):
         # put down this step and record learn data
         # state[best_move] = player
@@ -252,7 +608,7 @@ class AIPlayer:
         # state[best_move] = 0
 
         # store learn data for oppoenent, this helps improve the data
-        state_id = state.tobytes()
+        state_id = hash_key(self.compute_hash(state))
         # if self.playing_white == False and best_q == -1.0:
             # import IPython; IPython.embed()
 
@@ -306,206 +662,220 @@ class AIPlayer:
 
 
 
+# the AIPlayer of a root pool worker process
+root_worker_player = None
+
+def root_worker_init(models, counter, settings):
+    """ Create the AIPlayer of this worker of AIPlayer.start_root_pool() with the next model in models """
+    global root_worker_player
+    with counter.get_lock():
+        i = counter.value
+        counter.value += 1
+    root_worker_player = AIPlayer('RootWorker%d' % i, models[i])
+    for name, value in settings.items():
+        setattr(root_worker_player, name, value)
+
+def root_worker_search(task):
+    """ Return the win rate of player after move, searched in a worker of the root pool """
+    state, state_hash, empty_spots_left, move, alpha, beta, player, level, max_level, deadline = task
+    root_worker_player.level = max_level
+    root_worker_player.deadline = deadline
+    root_worker_player.board = LineBoard(state)
+    return root_worker_player.next_iter_winrate(state, state_hash, empty_spots_left, move, alpha, beta, player, level)
+
 
 # Below are utility functions
 
-@numba.jit(nopython=True, nogil=True, cache=True)
-def find_interesting_moves(state, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
-    """ Look at state and find the interesing n_move moves.
-    input:
-    -------
-    state: numpy.array board_size x board_size, 1=black, -1=white, 0=empty
-    empty_spots_left: number of empty spots on the board
-    player: current player to find interesting moves, 1=black, -1=white
-    n_moves: int, desired number of interesing moves
+class SearchStats:
+    """
+    Counters of the search of one move, see AIPlayer.strategy(return_stats=True) and AIPlayer.collect_stats
+    The workers of the root pool don't count
+    """
 
-    output:
-    -------
-    interested_moves: numpy.array final_n_moves x 2
-        *note : final_n_moves = 1 if limited
-        *       else final_n_moves = n_moves + number of length-4 moves
-        *note2: final_n_moves will not exceed empty_spots_left
+    def __init__(self):
+        # best_action_q calls, and the number of interesting moves they found, by level
+        self.nodes = collections.Counter()
+        self.interesting_moves = collections.Counter()
+        # results found without searching: 'book' at the root, 'forced' single moves, 'vcf' and 'vct' wins
+        self.shortcuts = collections.Counter()
+        # cache lookups of check_known by search depth, the levels left to search (0 = DNN value)
+        self.cache_hits = collections.Counter()
+        self.cache_misses = collections.Counter()
+        self.evictions = 0
+        self.dnn_calls = 0
+        self.dnn_positions = 0
+        # seconds in model.predict, in the numba kernels (interesting moves, LineBoard updates, VCF and VCT), and in total
+        self.model_seconds = 0.0
+        self.numba_seconds = 0.0
+        self.seconds = 0.0
+
+    def as_dict(self):
+        """ The counters as a dict of numbers and dicts, for json """
+        d = dict(self.__dict__)
+        for name in ('nodes', 'interesting_moves', 'shortcuts', 'cache_hits', 'cache_misses'):
+            d[name] = {str(k): v for k, v in sorted(d[name].items())}
+        return d
+
+class SearchTimeout(Exception):
+    """ Raised in best_action_q when AIPlayer.deadline has passed """
+    pass
+
+# Zobrist keys, one random 63-bit number for each (stone color, position)
+# zobrist_keys[0] for black stones, zobrist_keys[1] for white stones
+# 63 bits so that all hashes are positive int64, the same in python and numba
+# a fixed seed is used, so the same state has the same hash in every process
+zobrist_keys = np.random.RandomState(15).randint(0, 2**63, size=(2, board_size, board_size), dtype=np.int64)
+# the same keys as python ints, which are faster to use outside numba
+zobrist_table = zobrist_keys.tolist()
+
+def transform_board(a, t):
+    """ Apply the t-th (0-7) symmetric transformation of the square board to the last 2 axes of a
+    Bit 2 of t transposes, bit 0 flips rows, bit 1 flips columns, t = 0 is the identity
+    """
+    if t & 4:
+        a = np.swapaxes(a, -1, -2)
+    if t & 1:
+        a = a[..., ::-1, :]
+    if t & 2:
+        a = a[..., :, ::-1]
+    return a
+
+# zobrist_sym_keys[t] are the keys of the t-th transformed board, so that
+# the t-th hash of a state is the zobrist hash of its t-th symmetric state
+# the minimum of 8 hashes is the same for all symmetric states
+zobrist_sym_keys = np.ascontiguousarray(np.stack([transform_board(zobrist_keys, t) for t in range(8)]))
+# zobrist_sym_table[p][r][c] is the tuple of 8 keys for a stone of player p at (r,c)
+zobrist_sym_table = [[[tuple(k) for k in row] for row in keys] for keys in np.moveaxis(zobrist_sym_keys, 0, -1).tolist()]
+
+def player_index(player):
+    """ Index of player in zobrist_keys, black (1) -> 0, white (-1) -> 1 """
+    return 0 if player == 1 else 1
+
+def hash_add_stone(state_hash, move, player):
+    """ Update state_hash by putting down (or removing) a stone of player at move
+    state_hash is an int, or a tuple of 8 ints in symmetric mode
+    """
+    r, c = move
+    if type(state_hash) is tuple:
+        return tuple(h ^ k for h, k in zip(state_hash, zobrist_sym_table[player_index(player)][r][c]))
+    else:
+        return state_hash ^ zobrist_table[player_index(player)][r][c]
 
+def hash_key(state_hash):
+    """ Cache key of state_hash, the minimum among the 8 hashes in symmetric mode """
+    if type(state_hash) is tuple:
+        return min(state_hash)
+    else:
+        return state_hash
 
-    #suggested_n_moves: suggested number of moves to
+@numba.jit(nopython=True, nogil=True, cache=True)
+def zobrist_hash(state):
+    """ Compute the zobrist hash of state from scratch
+    During the search the hash is updated incrementally by XOR with zobrist_keys
     """
+    h = np.int64(0)
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] == 1:
+                h ^= zobrist_keys[0,r,c]
+            elif state[r,c] == -1:
+                h ^= zobrist_keys[1,r,c]
+    return h
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def zobrist_sym_hashes(state):
+    """ Compute the zobrist hashes of all 8 symmetric states of state """
+    h = np.zeros(8, dtype=np.int64)
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] == 1:
+                h ^= zobrist_sym_keys[:,0,r,c]
+            elif state[r,c] == -1:
+                h ^= zobrist_sym_keys[:,1,r,c]
+    return h
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def update_spot(state, bits, table, r, c, pidx, i_dir, line_values, line_flags, spot_values, spot_flags, n_five):
+    """ Look up the line of (r,c) in direction i_dir (all 4 lines if i_dir == -1) for player pidx in the pattern table,
+    then the sum of the 4 lines in spot_values and spot_flags, and the number of empty spots with EXACT_FIVE in n_five
+    The arrays are those of one player, see LineBoard """
+    for k in range(4):
+        if i_dir != -1 and k != i_dir:
+            continue
+        value, flags = line_pattern(table, bits, r, c, k, pidx)
+        line_values[r,c,k] = value
+        line_flags[r,c,k] = flags
+    old_exact_five = spot_flags[r,c] & EXACT_FIVE
+    value = 10 # as long as it's a valid point, this is for avoiding the taken spaces
+    flags = 0
+    for k in range(4):
+        value += line_values[r,c,k]
+        # the five flags are or-ed, the hard 4 numbers are summed
+        flags = (flags | (line_flags[r,c,k] & (MY_FIVE | OPPONENT_FIVE | EXACT_FIVE))) + (line_flags[r,c,k] & ~(MY_FIVE | OPPONENT_FIVE | EXACT_FIVE))
+    spot_values[r,c] = value
+    spot_flags[r,c] = flags
+    if state[r,c] == 0:
+        n_five[0] += (flags & EXACT_FIVE) // EXACT_FIVE - old_exact_five // EXACT_FIVE
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def update_lines(state, bits, table, r, c, player, line_values, line_flags, spot_values, spot_flags, n_five):
+    """ Place a stone of player at (r,c), or remove the stone if player == 0,
+    then update the spots within 6 steps on the 4 lines through it for both players """
+    # the number of empty spots to make 5 changes with (r,c)
+    sign = -1 if player != 0 else 1
+    for pidx in range(2):
+        if spot_flags[pidx,r,c] & EXACT_FIVE:
+            n_five[pidx] += sign
+    state[r,c] = player
+    if player == 0:
+        remove_stone(bits, r, c)
+    else:
+        place_stone(bits, r, c, player)
+    directions = ((1,1), (1,0), (0,1), (1,-1))
+    for k in range(4):
+        dr, dc = directions[k]
+        for step in range(-6, 7):
+            ext_r, ext_c = r + step*dr, c + step*dc
+            if step == 0 or ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+                continue
+            for pidx in range(2):
+                update_spot(state, bits, table, ext_r, ext_c, pidx, k, line_values[pidx], line_flags[pidx], spot_values[pidx], spot_flags[pidx], n_five[pidx:pidx+1])
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def update_board(state, bits, table, line_values, line_flags, spot_values, spot_flags, n_five):
+    """ Compute all spots on all lines for both players, the arrays should be zeros """
+    for r in range(board_size):
+        for c in range(board_size):
+            for pidx in range(2):
+                update_spot(state, bits, table, r, c, pidx, -1, line_values[pidx], line_flags[pidx], spot_values[pidx], spot_flags[pidx], n_five[pidx:pidx+1])
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def pick_interesting_moves(state, spot_values, spot_flags, empty_spots_left, move_interest_values, n_moves, verbose=False):
+    """ Pick the interesting moves from the interest values and flags of each spot for the current player,
+    see find_interesting_moves for the output """
     force_to_block = False
     exist_will_win_move = False
-    directions = ((1,1), (1,0), (0,1), (1,-1))
     final_single_move = np.zeros(2, dtype=np.int64).reshape(1,2) # for returning the single move
     for r in range(board_size):
         for c in range(board_size):
             if state[r,c] != 0: continue
-            interest_value = 10 # as long as it's a valid point, this is for avoiding the taken spaces
-            my_hard_4 = 0
-            for dr, dc in directions:
-                my_line_length = 1 # last_move
-                opponent_line_length = 1
-                # try to extend in the positive direction (max 5 times to check overline)
-                ext_r = r
-                ext_c = c
-                skipped_1 = 0
-                my_blocked = False
-                opponent_blocked = False
-                for i in range(5):
-                    ext_r += dr
-                    ext_c += dc
-                    if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                        break
-                    elif state[ext_r, ext_c] == player:
-                        if my_blocked == True:
-                            break
-                        else:
-                            my_line_length += 1
-                            opponent_blocked = True
-                    elif state[ext_r, ext_c] == -player:
-                        if opponent_blocked == True:
-                            break
-                        else:
-                            opponent_line_length += 1
-                            my_blocked = True
-                    elif skipped_1 == 0:
-                        skipped_1 = i + 1 # allow one skip and record the position of the skip
-                    else:
-                        # peek at the next one and if it might be useful, add some interest
-                        if ((state[ext_r+dr, ext_c+dc] == player) and (my_blocked == False)) or ((state[ext_r+dr, ext_c+dc] == -player) and (opponent_blocked == False)):
-                            interest_value += 15
-                        break
-
-                # the backward counting starts at the furthest "unskipped" stone
-                forward_my_open = False
-                forward_opponent_open = False
-                if skipped_1 == 0:
-                    my_line_length_back = my_line_length
-                    opponent_line_length_back = opponent_line_length
-                elif skipped_1 == 1:
-                    my_line_length_back = 1
-                    opponent_line_length_back = 1
-                    forward_my_open = True
-                    forward_opponent_open = True
-                else:
-                    if my_blocked == False:
-                        my_line_length_back = skipped_1
-                        opponent_line_length_back = 1
-                        forward_my_open = True
-                    else:
-                        my_line_length_back = 1
-                        opponent_line_length_back = skipped_1
-                        forward_opponent_open = True
-                my_line_length_no_skip = my_line_length_back
-                opponent_line_length_no_skip = opponent_line_length_back
-
-                # backward is a little complicated, will try to extend my stones first
-                ext_r = r
-                ext_c = c
-                skipped_2 = 0
-                opponent_blocked = False
-                for i in range(6-my_line_length_no_skip):
-                    ext_r -= dr
-                    ext_c -= dc
-                    if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                        break
-                    elif state[ext_r, ext_c] == player:
-                        my_line_length_back += 1
-                        opponent_blocked = True
-                    elif state[ext_r, ext_c] == -player:
-                        break
-                    else:
-                        if skipped_2 == 0:
-                            skipped_2 = i + 1
-                        else:
-                            # peek at the next one and if it might be useful, add some interest
-                            if state[ext_r-dr, ext_c-dc] == player:
-                                interest_value += 15
-                            break
-
-                # see if i'm winning
-                if my_line_length_back == 5:
-                    # if there are 5 stones in backward counting, and it's not skipped in the middle
-                    if skipped_2 == 0 or skipped_2 == (6-my_line_length_no_skip):
-                        # i will win with this move, I will place the stone
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        return final_single_move
-
-                # extend my forward line length to check if there is hard 4
-                if skipped_2 == 0:
-                    my_line_length += my_line_length_back - my_line_length_no_skip
-                else:
-                    my_line_length += skipped_2 - 1
-
-                backward_my_open = True if skipped_2 > 0 else False
-                backward_opponent_open = False
-                # then try to extend the opponent
-                if opponent_blocked == True:
-                    if skipped_2 == 1:
-                        backward_opponent_open = True
-                    skipped_2 = 0 # reset the skipped_2 here to enable the check of opponent 5 later
-                else:
-                    ext_r = r
-                    ext_c = c
-                    skipped_2 = 0
-                    for i in range(6-opponent_line_length_no_skip):
-                        ext_r -= dr
-                        ext_c -= dc
-                        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
-                            break
-                        elif state[ext_r, ext_c] == player:
-                            break
-                        elif state[ext_r, ext_c] == -player:
-                            opponent_line_length_back += 1
-                        else:
-                            if skipped_2 == 0:
-                                skipped_2 = i + 1
-                            else:
-                                # peek at the next one and if it might be useful, add some interest
-                                if state[ext_r-dr, ext_c-dc] == -player:
-                                    interest_value += 15
-                                break
-                    # extend opponent forward line length to check if there is hard 4
-                    if skipped_2 == 0:
-                        opponent_line_length += opponent_line_length_back - opponent_line_length_no_skip
-                    else:
-                        opponent_line_length += skipped_2 - 1
-                        backward_opponent_open = True
-                        # here if opponent_line_length_back == 5, skipped_2 will be 0 and this flag won't be True
-                        # but it do not affect our final result, because we have to block this no matter if it's open
-
-                # check if we have to block this
-                if opponent_line_length_back == 5:
-                    if (skipped_2 == 0) or (skipped_2 == 6-opponent_line_length_no_skip):
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        force_to_block = True
-                if force_to_block == False:
-                    # if I will win after this move, I won't consider other moves
-                    if forward_my_open == True and my_line_length == 4:
-                        my_hard_4 += 1
-                    if backward_my_open == True and my_line_length_back == 4:
-                        my_hard_4 += 1
-                    if my_hard_4 >= 2:
-                        final_single_move[0,0] = r
-                        final_single_move[0,1] = c
-                        exist_will_win_move = True
-                if force_to_block == False and exist_will_win_move == False:
-                    # compute the interest_value for other moves
-                    # if any line length >= 5, it's an overline so skipped
-                    if (forward_my_open == True) and (my_line_length < 5):
-                        interest_value += my_line_length ** 4
-                    if (backward_my_open == True) and (my_line_length_back < 5):
-                        interest_value += my_line_length_back ** 4
-                    if (forward_opponent_open == True) and (opponent_line_length < 5):
-                        interest_value += opponent_line_length ** 4
-                    if (backward_opponent_open == True) and (opponent_line_length_back < 5):
-                        interest_value += opponent_line_length_back ** 4
-                # if (r,c) == (5,5):
-                #     print("(dr,dc) =", dr,dc)
-                #     print('forward_my_open', forward_my_open, "my_line_length", my_line_length)
-                #     print('backward_my_open', backward_my_open,"my_line_length_back", my_line_length_back)
-                #     print('forward_opponent_open',forward_opponent_open,'opponent_line_length',opponent_line_length)
-                #     print('backward_opponent_open',backward_opponent_open,'opponent_line_length_back',opponent_line_length_back)
-                #     print("interest_value=", interest_value)
-            # after looking at all directions, record the total interest_value of this move
+            flags = spot_flags[r,c]
+            if flags & MY_FIVE:
+                # i will win with this move, I will place the stone
+                final_single_move[0,0] = r
+                final_single_move[0,1] = c
+                return final_single_move
+            if flags & OPPONENT_FIVE:
+                final_single_move[0,0] = r
+                final_single_move[0,1] = c
+                force_to_block = True
+            elif force_to_block == False and (flags >> HARD_4_SHIFT) >= 2:
+                # if I will win after this move, I won't consider other moves
+                final_single_move[0,0] = r
+                final_single_move[0,1] = c
+                exist_will_win_move = True
+            # record the total interest_value of this move
+            interest_value = spot_values[r,c]
             move_interest_values[r, c] += interest_value
             if interest_value > 256: # one (length_4) ** 4, highly interesting move
                 n_moves += 1
@@ -532,6 +902,45 @@ def find_interesting_moves(state, empty_spots_left, move_interest_values, player
                 print(interested_moves[i,0],interested_moves[i,1],'  :  ', flattened_interest[high_interest_idx[i]])
         return interested_moves
 
+def find_interesting_moves(state, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
+    """ Look at state and find the interesing n_move moves.
+    LineBoard.find_interesting_moves gives the same result without looking at the whole board
+    input:
+    -------
+    state: numpy.array board_size x board_size, 1=black, -1=white, 0=empty
+    empty_spots_left: number of empty spots on the board
+    player: current player to find interesting moves, 1=black, -1=white
+    n_moves: int, desired number of interesing moves
+
+    output:
+    -------
+    interested_moves: numpy.array final_n_moves x 2
+        *note : final_n_moves = 1 if limited
+        *       else final_n_moves = n_moves + number of length-4 moves
+        *note2: final_n_moves will not exceed empty_spots_left
+
+
+    #suggested_n_moves: suggested number of moves to
+    """
+    return scan_interesting_moves(state, pattern_table, empty_spots_left, move_interest_values, player, n_moves, verbose)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def scan_interesting_moves(state, table, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
+    """ find_interesting_moves() with the pattern table as an argument, so that numba code can call it """
+    line_values = np.empty((board_size, board_size, 4), dtype=np.int32)
+    line_flags = np.empty((board_size, board_size, 4), dtype=np.int8)
+    spot_values = np.zeros((board_size, board_size), dtype=np.int32)
+    spot_flags = np.zeros((board_size, board_size), dtype=np.int8)
+    n_five = np.zeros(1, dtype=np.int64)
+    bits = new_bitboard()
+    set_bitboard(bits, state)
+    pidx = 0 if player == 1 else 1
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] == 0:
+                update_spot(state, bits, table, r, c, pidx, -1, line_values, line_flags, spot_values, spot_flags, n_five)
+    return pick_interesting_moves(state, spot_values, spot_flags, empty_spots_left, move_interest_values, n_moves, verbose)
+
 @numba.jit(nopython=True, nogil=True)
 def i_win(state, last_move, player):
     """ Return true if I just got 5-in-a-row with last_move """
@@ -570,11 +979,11 @@ def i_win(state, last_move, player):
 
 @numba.jit(nopython=True, nogil=True)
 def i_lost(state, player):
-    for r in range(board_size):
-        for c in range(board_size):
-            if state[r,c] == 0 and i_win(state, (r,c), -player):
-                return True
-    return False
+    """ Return true if the opponent can make 5 in a row next move """
+    bits = new_bitboard()
+    set_bitboard(bits, state)
+    five_spots = np.empty((1, 2), dtype=np.int64)
+    return count_five_spots(bits, -player, five_spots) > 0
 
 @numba.jit(nopython=True, nogil=True)
 def i_will_win(state, last_move, player):
@@ -656,6 +1065,63 @@ def i_will_win(state, last_move, player):
 
 
 
+class LineBoard:
+    """
+    Board that keeps the result of line_interest() (looked up in the pattern table) for every spot, line and player
+    Placing or removing a stone only updates the spots within 6 steps on the 4 lines through it,
+    instead of looking at the whole board like find_interesting_moves
+    state is shared with the caller, and should only be changed by place() and remove()
+    """
+
+    def __init__(self, state):
+        self.state = state
+        # [player_index, r, c, line]: interest value and flags of each line through each spot
+        self.line_values = np.zeros((2, board_size, board_size, 4), dtype=np.int32)
+        self.line_flags = np.zeros((2, board_size, board_size, 4), dtype=np.int8)
+        # [player_index, r, c]: interest value and flags of each spot, summed over its 4 lines
+        self.spot_values = np.zeros((2, board_size, board_size), dtype=np.int32)
+        self.spot_flags = np.zeros((2, board_size, board_size), dtype=np.int8)
+        # number of empty spots where each player can make exactly 5
+        self.n_five = np.zeros(2, dtype=np.int64)
+        # the stones on each line as bits, see bitboard.py
+        self.bits = new_bitboard()
+        set_bitboard(self.bits, state)
+        update_board(state, self.bits, pattern_table, self.line_values, self.line_flags, self.spot_values, self.spot_flags, self.n_five)
+
+    def place(self, move, player):
+        """ Put a stone of player at move """
+        update_lines(self.state, self.bits, pattern_table, move[0], move[1], player, self.line_values, self.line_flags, self.spot_values, self.spot_flags, self.n_five)
+
+    def remove(self, move):
+        """ Remove the stone at move """
+        update_lines(self.state, self.bits, pattern_table, move[0], move[1], 0, self.line_values, self.line_flags, self.spot_values, self.spot_flags, self.n_five)
+
+    def find_interesting_moves(self, empty_spots_left, move_interest_values, player, n_moves, verbose=False):
+        """ Same as find_interesting_moves(self.state, ...) """
+        pidx = player_index(player)
+        return pick_interesting_moves(self.state, self.spot_values[pidx], self.spot_flags[pidx], empty_spots_left,
+                                      move_interest_values, n_moves, verbose)
+
+    def i_win(self, move, player):
+        """ Same as i_win(state, move, player) after player's stone is put at move """
+        return bool(self.spot_flags[player_index(player), move[0], move[1]] & EXACT_FIVE)
+
+    def i_will_win(self, move, player):
+        """ Return True if player makes 5, an open four or double four at move, like i_will_win(state, move, player)
+        after player's stone is put at move, but found with the bitboard, which also finds the fours i_will_win misses """
+        return is_win_next(self.bits, move[0], move[1], player)
+
+    def i_lost(self, player, move=None):
+        """ Same as i_lost(state, player), move is player's stone put on state without place() """
+        opponent_idx = player_index(-player)
+        n_five = self.n_five[opponent_idx]
+        if move is not None and self.spot_flags[opponent_idx, move[0], move[1]] & EXACT_FIVE:
+            # the opponent can't make 5 at move now
+            n_five -= 1
+        return n_five > 0
+
+
+
 from collections import OrderedDict
 class LRU(OrderedDict):
     'Limit size, evicting the least recently looked-up key when full'
@@ -677,68 +1143,141 @@ class LRU(OrderedDict):
             oldest = next(iter(self))
             del self[oldest]
 
-class LeveledCache:
+# bound types of the values stored in TranspositionTable
+EXACT = 0
+LOWER_BOUND = 1 # the real value is >= the stored value
+UPPER_BOUND = 2 # the real value is <= the stored value
+
+class TranspositionTable:
     """
-    Cache with level system, level 0 has highest priority
-    When maxsize reached, oldest key from lowest cache will be deleted
+    Fixed size hash table with all entries stored in preallocated numpy arrays
+    The memory is allocated once here and never grows
+    Each key is stored in a bucket of bucket_size slots starting at key & mask (open addressing)
+    Each entry has a value, the depth it was searched with, the bound type of the value,
+    and the generation it was stored in
+    When a bucket is full, the entry from the oldest generation with smallest depth is replaced
+    The arrays can be passed to tt_probe() and tt_store() directly in numba jitted code
+    The keys are stored XOR tt_check() of the entry, so threads can share it without locks, e.g. the games of play_batched
     """
 
-    def __init__(self, maxlevel, maxsize=128):
-        assert maxlevel >= 0
-        self.maxlevel = maxlevel
-        self.maxsize = maxsize
-        self.caches = [OrderedDict() for _ in range(maxlevel+1)]
-        self.size = 0
-    
-    def get(self, key, max_accepted_level):
+    def __init__(self, maxsize=2000000, bucket_size=4):
+        # round up the size to a power of 2, so the index can be computed by key & mask
+        size = 1
+        while size < maxsize:
+            size *= 2
+        self.size = size
+        self.mask = size - 1
+        self.bucket_size = bucket_size
+        self.keys = np.zeros(size, dtype=np.int64)
+        self.values = np.zeros(size, dtype=np.float32)
+        self.depths = np.zeros(size, dtype=np.int8)
+        self.bounds = np.zeros(size, dtype=np.int8)
+        # generation 0 marks an empty slot
+        self.generations = np.zeros(size, dtype=np.uint8)
+        self.generation = 1
+
+    def new_generation(self):
+        """ Start a new generation, entries from older generations will be replaced first """
+        self.generation = self.generation % 255 + 1
+
+    def get(self, key, depth, alpha=-2.0, beta=2.0):
         """
-        Go over each level in cache, find one value with key
+        Find the value of key searched with at least depth
+        A lower bound is only returned if >= beta, an upper bound only if <= alpha
         If none found, return None
         """
-        for level in range(min(self.maxlevel, max_accepted_level)+1):
-            # starting from level 0, look for cached value
-            cache = self.caches[level]
-            try:
-                result = cache[key]
-                cache.move_to_end(key)
-                return result
-            except KeyError:
-                pass
-        return None
-        
-    def set(self, key, value, level):
+        i, value = tt_probe(self.keys, self.values, self.depths, self.bounds, self.generations, key, depth, alpha, beta,
+                            self.mask, self.bucket_size)
+        if i < 0:
+            return None
+        return value
+
+    def set(self, key, value, depth, bound=0):
         """
-        set a value in cache with level
+        Set a value of key searched with depth, bound is EXACT, LOWER_BOUND or UPPER_BOUND
+        Return True if another entry was evicted
         """
-        assert level <= self.maxlevel
-        # delete oldest from lowest cache if size reached
-        if self.size >= self.maxsize:
-            for l in range(self.maxlevel, -1, -1):
-                cache = self.caches[l]
-                try:
-                    oldest = next(iter(cache))
-                    del cache[oldest]
-                    break
-                except StopIteration:
-                    # if cache is empty skip and go to the next level cache
-                    pass
+        return tt_store(self.keys, self.values, self.depths, self.bounds, self.generations, key, value, depth, bound,
+                        self.generation, self.mask, self.bucket_size)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def tt_check(value, depth, bound):
+    """ The number stored in keys XOR the key, so that an entry written by two threads at the same time doesn't match any key
+    Then the table can be shared by threads without locks """
+    return (np.int64(value * 16777216.0) & 0xffffffffff) ^ (np.int64(depth) << 40) ^ (np.int64(bound) << 48)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def tt_probe(keys, values, depths, bounds, generations, key, depth, alpha, beta, mask, bucket_size):
+    """ Return the index and value of key in the transposition table if it's searched with at least depth,
+    and its value is exact or a bound out of the window (alpha, beta), otherwise -1 """
+    start = key & mask
+    for i in range(bucket_size):
+        j = (start + i) & mask
+        # read the entry once, another thread might be writing it
+        value = values[j]
+        depth_j = depths[j]
+        bound = bounds[j]
+        if generations[j] != 0 and keys[j] ^ tt_check(value, depth_j, bound) == key:
+            if depth_j < depth:
+                return -1, value
+            if bound == EXACT:
+                return j, value
+            if bound == LOWER_BOUND and value >= beta:
+                return j, value
+            if bound == UPPER_BOUND and value <= alpha:
+                return j, value
+            return -1, value
+    return -1, 0.0
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def tt_store(keys, values, depths, bounds, generations, key, value, depth, bound, generation, mask, bucket_size):
+    """ Store value of key in the transposition table, return True if another entry was evicted
+    The key is written last, with the check of the entry written by this call, not the one read back from the arrays
+    that another thread might have overwritten in the meantime """
+    start = key & mask
+    # the value as stored in values, so the check matches the one tt_probe() computes
+    value32 = np.float32(value)
+    replace_j = -1
+    replace_score = -1
+    for i in range(bucket_size):
+        j = (start + i) & mask
+        if generations[j] == 0:
+            # empty slot, use it unless the key is found later in this bucket
+            if replace_score < 1000000:
+                replace_j = j
+                replace_score = 1000000
+        elif keys[j] ^ tt_check(values[j], depths[j], bounds[j]) == key:
+            # the same key, keep the deeper result, and exact value over a bound
+            if depth > depths[j] or (depth == depths[j] and (bound == EXACT or bounds[j] != EXACT)):
+                values[j] = value32
+                depths[j] = depth
+                bounds[j] = bound
+                keys[j] = key ^ tt_check(value32, depth, bound)
+            generations[j] = generation
+            return False
         else:
-            # update size
-            self.size += 1
-        # insert new key
-        cache = self.caches[level]
-        # move key to end
-        if key in cache:
-            cache.move_to_end(key)
-        # set the value
-        cache[key] = value
+            # older generation and smaller depth are replaced first
+            age = (generation - generations[j]) % 255
+            score = age * 128 - depths[j]
+            if score > replace_score:
+                replace_j = j
+                replace_score = score
+    evicted = replace_score < 1000000
+    values[replace_j] = value32
+    depths[replace_j] = depth
+    bounds[replace_j] = bound
+    generations[replace_j] = generation
+    keys[replace_j] = key ^ tt_check(value32, depth, bound)
+    return evicted
 
 
 
 def read_board_state(f):
+    """ Read the board printed in file f as board_state of strategy(), rows and columns are 1-based
+    x and o are black and white stones, the last move is X or O, and the other player is playing """
     # default
-    black_stones = []
-    white_stones = []
+    black_stones = set()
+    white_stones = set()
     board = [black_stones, white_stones]
     last_move = None
     playing = 0
@@ -749,19 +1288,19 @@ def read_board_state(f):
             row_i = int(line_idx)
             stones = contents.split()
             if len(stones) == board_size:
-                for col_j, s in enumerate(stones):
+                for col_j, s in enumerate(stones, 1):
                     if s == 'x':
-                        black_stones.append((row_i, col_j))
+                        black_stones.add((row_i, col_j))
                     elif s == 'X':
-                        black_stones.append((row_i, col_j))
+                        black_stones.add((row_i, col_j))
                         last_move = (row_i, col_j)
-                        playing = 0
+                        playing = 1
                     elif s == 'o':
-                        white_stones.append((row_i, col_j))
+                        white_stones.add((row_i, col_j))
                     elif s == 'O':
-                        white_stones.append((row_i, col_j))
+                        white_stones.add((row_i, col_j))
                         last_move = (row_i, col_j)
-                        playing = 1
+                        playing = 0
                     elif s == '-':
                         pass
                     else:
@@ -815,6 +1354,14 @@ def benchmark():
 
         # find_interesting_moves_gpu(state, 224, move_interest_values, player, n_moves, verbose=False)
     print(f"{N} repeats took {time.time() - t0:9.3f} s")
+    # the same with LineBoard, placing and removing a stone each time like the search does
+    board = LineBoard(state)
+    t0 = time.time()
+    for _ in range(N):
+        board.place((7,7), -player)
+        board.find_interesting_moves(223, move_interest_values, player, n_moves, verbose=False)
+        board.remove((7,7))
+    print(f"{N} repeats with LineBoard took {time.time() - t0:9.3f} s")
 
 
 if __name__ == "__main__":
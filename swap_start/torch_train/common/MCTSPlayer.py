@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import time
+import numpy as np
+from AIPlayer import find_interesting_moves, i_win, zobrist_hash, hash_key
+from threat_search import vcf_search, new_threat_table
+from game_state import GameState
+
+board_size = 15
+
+class MCTSNode:
+    """ A node in the search tree, the state after player placed a stone at move
+    n is the number of visits, w is the total value for player, prior is the probability to be chosen """
+    __slots__ = ('move', 'player', 'prior', 'n', 'w', 'children', 'terminal_q', 'pending')
+
+    def __init__(self, move, player, prior):
+        self.move = move
+        self.player = player
+        self.prior = prior
+        self.n = 0
+        self.w = 0.0
+        # list of child nodes, None before expanded
+        self.children = None
+        # value for player if the game is finished here, None if not finished
+        self.terminal_q = None
+        # True when waiting for the model to evaluate
+        self.pending = False
+
+    @property
+    def q(self):
+        return self.w / self.n if self.n > 0 else 0.0
+
+class MCTSPlayer:
+    """ Monte-Carlo tree search (PUCT) player
+    The values of leaves come from the model, the priors come from the interest values of find_interesting_moves
+    Leaves of batch_size simulations are collected with virtual loss and evaluated in one model.predict
+    The tree is kept between moves """
+    def __init__(self, name, model=None, n_playouts=800, batch_size=16, c_puct=1.5):
+        self.name = name
+        self.load_model(model)
+        self.n_playouts = n_playouts
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        # max number of moves tried in each VCF search, 0 to disable
+        self.vcf_max_nodes = 1000
+        self.vcf_table = new_threat_table()
+        self.learndata = dict()
+        self.opponent = None
+        self.batch_states = np.zeros((batch_size, 3, board_size, board_size), dtype=np.float32)
+        self.move_interest_values = np.zeros((board_size, board_size), dtype=np.float32)
+        self.reset()
+
+    def load_model(self, model):
+        # no data
+        if model is None:
+            self.model = None
+        # if provided path
+        elif isinstance(model, str):
+            import torch
+            self.model = torch.load(model)
+        else:
+            # provided model
+            self.model = model
+
+    def reset(self):
+        """ Reset before a new game """
+        self.root = None
+        self.root_state = None
+
+    def reset_cache(self):
+        """ Reset the tree before using new model """
+        self.reset()
+
+    def strategy(self, board_state, time_budget=None):
+        """ AI's strategy
+        Information provided to you:
+        board_state = (board, last_move, playing, board_size)
+        board = (x_stones, o_stones)
+        stones is a set contains positions of one player's stones. e.g.
+            x_stones = {(8,8), (8,9), (8,10), (8,11)}
+        playing = 0|1, the current player's index
+
+        Run n_playouts simulations, or until time_budget (seconds) runs out if given
+
+        board_state can also be a GameState, whose board is used without rebuilding it from the stones
+
+        Your strategy will return a position code for the next stone, e.g. (8,7)
+        """
+        if isinstance(board_state, GameState):
+            board_size, playing = board_state.board_size, board_state.playing
+            state = board_state.board.copy()
+            empty_spots_left = board_state.empty_spots_left
+        else:
+            board, last_move, playing, board_size = board_state
+            state = np.zeros((board_size, board_size), dtype=np.int8)
+            for br, bc in board[0]:
+                state[br-1,bc-1] = 1
+            for wr, wc in board[1]:
+                state[wr-1,wc-1] = -1
+            empty_spots_left = board_size**2 - len(board[0]) - len(board[1])
+        player = -1 if playing else 1
+        # look for a forced win by continuous fours first
+        vcf_move = vcf_search(state, player, self.vcf_max_nodes, self.vcf_table) if self.vcf_max_nodes > 0 else -1
+        if vcf_move >= 0:
+            best_move, best_q = divmod(vcf_move, board_size), 1.0
+            self.reset()
+        else:
+            self.reuse_tree(state, player)
+            deadline = time.time() + time_budget if time_budget is not None else None
+            n_done = 0
+            while n_done < self.n_playouts:
+                n_done += self.run_batch(state, empty_spots_left)
+                if deadline is not None and time.time() > deadline:
+                    break
+            best_child = max(self.root.children, key=lambda child: child.n)
+            best_move, best_q = best_child.move, best_child.q
+            # the chosen child becomes the root of the next search
+            self.root = best_child
+            self.root_state = state.copy()
+            self.root_state[best_move] = player
+        # save the winrate and the state
+        self.update_if_game_finish(state, best_move, best_q, player)
+        return (best_move[0]+1, best_move[1]+1), best_q
+
+    def reuse_tree(self, state, player):
+        """ Move the root to the node of state if it's in the tree, otherwise start a new tree """
+        root = None
+        if self.root is not None and self.root.children is not None:
+            stones = self.root_state != 0
+            # state should be root_state + one opponent move
+            if np.all(state[stones] == self.root_state[stones]) and np.count_nonzero(state) == np.count_nonzero(stones) + 1:
+                for child in self.root.children:
+                    if state[child.move] == child.player:
+                        root = child
+                        break
+        if root is None:
+            root = MCTSNode(None, -player, 1.0)
+        self.root = root
+        self.root_state = state
+
+    def run_batch(self, state, empty_spots_left):
+        """ Run up to batch_size simulations from the root, evaluate the new leaves in one model.predict
+        Return the number of finished simulations """
+        leaves = []
+        n_done = 0
+        # give up after too many simulations collided on pending leaves
+        for _ in range(2 * self.batch_size):
+            if len(leaves) == self.batch_size:
+                break
+            path = self.select_leaf(state, empty_spots_left)
+            if path is None:
+                continue
+            leaf = path[-1]
+            if leaf.terminal_q is not None:
+                self.backup(path, leaf.terminal_q)
+                n_done += 1
+            else:
+                # fill in the model input from leaf.player's view
+                i = len(leaves)
+                self.set_leaf_state(state, path, i)
+                leaf.pending = True
+                leaves.append(path)
+        if len(leaves) > 0:
+            predict_y = self.model.predict(self.batch_states[:len(leaves)]).ravel()
+            for path, q in zip(leaves, predict_y):
+                path[-1].pending = False
+                self.backup(path, float(q))
+                n_done += 1
+        # count at least one, so a batch of collisions still ends the search
+        return max(n_done, 1)
+
+    def select_leaf(self, state, empty_spots_left):
+        """ Go down the tree from the root by PUCT, adding a virtual loss to each node on the way
+        Return the path of nodes to the new leaf or a finished game, or None if a pending leaf was hit """
+        node = self.root
+        path = [node]
+        played = []
+        while True:
+            if node.terminal_q is not None:
+                break
+            if node.children is None:
+                self.expand(node, state, empty_spots_left - len(played))
+            child = self.select_child(node)
+            if child.pending:
+                # another simulation is waiting for this leaf, undo the virtual loss
+                for n in path[1:]:
+                    n.n -= 1
+                    n.w += 1.0
+                path = None
+                break
+            # virtual loss
+            child.n += 1
+            child.w -= 1.0
+            state[child.move] = child.player
+            played.append(child.move)
+            path.append(child)
+            if child.n == 1:
+                # new leaf
+                if i_win(state, child.move, child.player):
+                    child.terminal_q = 1.0
+                elif empty_spots_left - len(played) == 0:
+                    child.terminal_q = 0.0
+                break
+            node = child
+        # restore state
+        for move in played:
+            state[move] = 0
+        return path
+
+    def select_child(self, node):
+        """ Return the child with the highest PUCT score """
+        sqrt_n = np.sqrt(node.n + 1)
+        best_score, best_child = -np.inf, None
+        for child in node.children:
+            score = child.q + self.c_puct * child.prior * sqrt_n / (1 + child.n)
+            if score > best_score:
+                best_score, best_child = score, child
+        return best_child
+
+    def expand(self, node, state, empty_spots_left):
+        """ Create the children of node, the priors are the normalized interest values """
+        player = -node.player
+        n_moves = 40 if empty_spots_left > 200 else 20
+        self.move_interest_values.fill(0)
+        self.move_interest_values[4:11, 4:11] = 5.0
+        interested_moves = find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, n_moves)
+        if len(interested_moves) == 1:
+            priors = np.ones(1)
+        else:
+            priors = self.move_interest_values[interested_moves[:,0], interested_moves[:,1]]
+            priors = priors / priors.sum()
+        node.children = [MCTSNode((r, c), player, p) for (r, c), p in zip(interested_moves, priors)]
+
+    def set_leaf_state(self, state, path, i):
+        """ Put the state at the end of path into batch_states[i], from the view of the leaf's player """
+        leaf = path[-1]
+        for node in path[1:]:
+            state[node.move] = node.player
+        self.batch_states[i,0] = (state == leaf.player)
+        self.batch_states[i,1] = (state == -leaf.player)
+        self.batch_states[i,2] = 1 if leaf.player == 1 else 0
+        for node in path[1:]:
+            state[node.move] = 0
+
+    def backup(self, path, q):
+        """ Replace the virtual losses on path with the leaf value q, q is for the leaf's player """
+        leaf_player = path[-1].player
+        self.root.n += 1
+        for node in path[1:]:
+            node.w += 1.0 + (q if node.player == leaf_player else -q)
+
+    def update_if_game_finish(self, state, best_move, best_q, player):
+        # store learn data for oppoenent, this helps improve the data
+        state_id = hash_key(zobrist_hash(state))
+        if hasattr(self, 'opponent') and hasattr(self.opponent, 'learndata'):
+            self.opponent.learndata[state_id] = [state.copy(), -best_q, 1]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import math
+
+def expected_score(elo):
+    """ Expected score of a player elo points stronger than the opponent """
+    return 1.0 / (1.0 + 10.0 ** (-elo / 400.0))
+
+def elo_from_score(score):
+    """ Elo difference giving the expected score, +-inf for a score of 1 or 0 """
+    if score <= 0.0:
+        return -math.inf
+    if score >= 1.0:
+        return math.inf
+    return -400.0 * math.log10(1.0 / score - 1.0)
+
+class MatchResult:
+    """
+    Wins, losses and draws of the new model against the previous one, as Black and as White
+    elo() and elo_interval() are the Elo difference of the new model and its confidence interval,
+    sprt() tests H0: elo = elo0 against H1: elo = elo1 after each game, and stops the match when one is accepted
+    """
+
+    def __init__(self, elo0=0.0, elo1=20.0, alpha=0.05, beta=0.05, min_games=20):
+        # [wins, losses, draws] of the new model
+        self.as_black = [0, 0, 0]
+        self.as_white = [0, 0, 0]
+        self.elo0 = elo0
+        self.elo1 = elo1
+        # the chances to accept H1 when H0 is true, and H0 when H1 is true
+        self.alpha = alpha
+        self.beta = beta
+        # the normal approximation of the LLR is too rough with fewer games
+        self.min_games = min_games
+
+    def add(self, new_is_black, score):
+        """ Add a game of the new model as Black or White, score is 1 for a win, 0 for a loss and 0.5 for a draw """
+        results = self.as_black if new_is_black else self.as_white
+        results[{1.0: 0, 0.0: 1, 0.5: 2}[score]] += 1
+
+    @property
+    def wins(self):
+        return self.as_black[0] + self.as_white[0]
+
+    @property
+    def losses(self):
+        return self.as_black[1] + self.as_white[1]
+
+    @property
+    def draws(self):
+        return self.as_black[2] + self.as_white[2]
+
+    @property
+    def n_games(self):
+        return self.wins + self.losses + self.draws
+
+    def score(self):
+        """ Mean score of the new model, and the variance of the score of one game """
+        n = self.n_games
+        if n == 0:
+            return 0.5, 0.0
+        mean = (self.wins + 0.5 * self.draws) / n
+        var = (self.wins * (1 - mean)**2 + self.draws * (0.5 - mean)**2 + self.losses * mean**2) / n
+        return mean, var
+
+    def elo(self):
+        return elo_from_score(self.score()[0])
+
+    def elo_interval(self, z=1.96):
+        """ Lower and upper Elo of the confidence interval, 95% for z = 1.96 """
+        mean, var = self.score()
+        margin = z * math.sqrt(var / max(self.n_games, 1))
+        return elo_from_score(mean - margin), elo_from_score(mean + margin)
+
+    def llr(self):
+        """ Log-likelihood ratio of H1 to H0, with the normal approximation of the mean score (GSPRT) """
+        mean, var = self.score()
+        if self.n_games == 0:
+            return 0.0
+        s0, s1 = expected_score(self.elo0), expected_score(self.elo1)
+        # all games with the same result, avoid dividing by 0
+        var = max(var, 1e-4)
+        return self.n_games * (s1 - s0) * (2 * mean - s0 - s1) / (2 * var)
+
+    def bounds(self):
+        """ The LLR below which H0 is accepted, and above which H1 is accepted """
+        return math.log(self.beta / (1 - self.alpha)), math.log((1 - self.beta) / self.alpha)
+
+    def sprt(self):
+        """ Return 'H1' if the new model is accepted as elo1 stronger, 'H0' if not, None to keep playing """
+        if self.n_games < self.min_games:
+            return None
+        llr = self.llr()
+        lower, upper = self.bounds()
+        if llr >= upper:
+            return 'H1'
+        if llr <= lower:
+            return 'H0'
+        return None
+
+    def summary(self):
+        lower, upper = self.elo_interval()
+        lower_bound, upper_bound = self.bounds()
+        decision = {'H1': f'new model is stronger (elo >= {self.elo1:g})',
+                    'H0': f'new model is not stronger (elo <= {self.elo0:g})',
+                    None: 'inconclusive'}[self.sprt()]
+        return '\n'.join([
+            '-' * 50,
+            f'           |   Win           Lose           Draw',
+            '-' * 50,
+            f' as Black  | {self.as_black[0]:10} {self.as_black[1]:10} {self.as_black[2]:10}',
+            f' as White  | {self.as_white[0]:10} {self.as_white[1]:10} {self.as_white[2]:10}',
+            '-' * 50,
+            f'Games {self.n_games}, score {self.score()[0]:.3f}, Elo {self.elo():+.1f} (95% {lower:+.1f} .. {upper:+.1f})',
+            f'SPRT elo0 {self.elo0:g} elo1 {self.elo1:g}: LLR {self.llr():.2f} ({lower_bound:.2f}, {upper_bound:.2f}), {decision}',
+        ])
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import time
+import threading
+import numpy as np
+
+board_size = 15
+
+# the 4 line directions, and the steps 1-5 along them
+directions = np.array([(1, 1), (1, 0), (0, 1), (1, -1)])
+steps = np.arange(1, 6)
+
+class BatchGomoku:
+    """
+    Play n_games games in lock step, all boards are kept in one (n_games, 15, 15) int8 array, 1 = black, -1 = white
+    Each step() places one stone in every game that's not finished, and checks all of them for 5 in a row at once
+    play() asks a batched policy for the moves of all unfinished games together:
+        policy(states, players, games) -> moves, states is (n, 15, 15) int8, players is (n,) of 1 or -1,
+        games is (n,) the indices of the games in this batch, moves is (n, 2) 0-based
+    The same rules as Gomoku: exactly 5 in a row wins, an illegal move loses, a full board is a draw
+    With overline_wins, 6 or more in a row win too (free-style), otherwise an overline is only counted in self.overlines
+    """
+
+    def __init__(self, n_games, board_size=board_size, overline_wins=False):
+        self.n_games = n_games
+        self.board_size = board_size
+        self.overline_wins = overline_wins
+        self.boards = np.zeros((n_games, board_size, board_size), dtype=np.int8)
+        # the moves of each game in order, 0-based, and the number of stones on each board
+        self.moves = np.zeros((n_games, board_size**2, 2), dtype=np.int8)
+        self.n_stones = np.zeros(n_games, dtype=np.int64)
+        self.reset()
+
+    def reset(self, begin_boards=None):
+        """ Start new games, from the (n_games, 15, 15) begin_boards if given, otherwise from empty boards """
+        if begin_boards is None:
+            self.boards.fill(0)
+        else:
+            self.boards[:] = begin_boards
+        self.n_stones[:] = np.count_nonzero(self.boards, axis=(1, 2))
+        # black moves when both have the same number of stones
+        n_black = np.sum(self.boards == 1, axis=(1, 2))
+        self.players = np.where(n_black * 2 == self.n_stones, 1, -1).astype(np.int8)
+        self.done = np.zeros(self.n_games, dtype=bool)
+        # 1 if black won, -1 if white won, 0 for a draw or an unfinished game
+        self.winners = np.zeros(self.n_games, dtype=np.int8)
+        # number of moves making 6 or more in a row in each game
+        self.overlines = np.zeros(self.n_games, dtype=np.int64)
+
+    def step(self, moves):
+        """ Place the stones of the players to move at moves (n_games, 2), the moves of finished games are ignored """
+        games = np.flatnonzero(~self.done)
+        r, c = moves[games, 0], moves[games, 1]
+        players = self.players[games]
+        # a move outside the board or on a stone loses
+        legal = (r >= 0) & (r < self.board_size) & (c >= 0) & (c < self.board_size)
+        legal[legal] = self.boards[games[legal], r[legal], c[legal]] == 0
+        self.winners[games[~legal]] = -players[~legal]
+        self.done[games[~legal]] = True
+        games, r, c, players = games[legal], r[legal], c[legal], players[legal]
+        self.boards[games, r, c] = players
+        self.moves[games, self.n_stones[games]] = np.stack([r, c], axis=1)
+        self.n_stones[games] += 1
+        five, overline = self.lines_at(games, r, c, players)
+        self.overlines[games[overline]] += 1
+        won = five | overline if self.overline_wins else five
+        self.winners[games[won]] = players[won]
+        self.done[games[won]] = True
+        self.done[games[self.n_stones[games] == self.board_size**2]] = True
+        self.players[games] = -players
+        return self.done
+
+    def lines_at(self, games, r, c, players):
+        """ Return if the stone of players at (r, c) in games makes exactly 5 in a row, and if it makes 6 or more """
+        n = len(games)
+        five = np.zeros(n, dtype=bool)
+        overline = np.zeros(n, dtype=bool)
+        for dr, dc in directions:
+            run = np.ones(n, dtype=np.int64)
+            for sign in (1, -1):
+                # the stones at 1-5 steps in this direction, stop counting at the first spot that's not the player's
+                rr = r[:,None] + sign * dr * steps
+                cc = c[:,None] + sign * dc * steps
+                inside = (rr >= 0) & (rr < self.board_size) & (cc >= 0) & (cc < self.board_size)
+                stones = self.boards[games[:,None], np.clip(rr, 0, self.board_size-1), np.clip(cc, 0, self.board_size-1)]
+                mine = inside & (stones == players[:,None])
+                run += np.cumprod(mine, axis=1).sum(axis=1)
+            five |= run == 5
+            overline |= run >= 6
+        return five, overline
+
+    def play(self, policy, max_steps=None):
+        """ Play all games until they finish, or for max_steps steps, return the winners """
+        n_steps = 0
+        while not self.done.all() and (max_steps is None or n_steps < max_steps):
+            games = np.flatnonzero(~self.done)
+            moves = np.zeros((self.n_games, 2), dtype=np.int64)
+            moves[games] = policy(self.boards[games], self.players[games], games)
+            self.step(moves)
+            n_steps += 1
+        return self.winners
+
+def random_policy(states, players, games):
+    """ Play a random empty spot in each state """
+    scores = np.random.random(states.shape) - (states != 0)
+    moves = scores.reshape(len(states), -1).argmax(axis=1)
+    return np.stack(divmod(moves, states.shape[-1]), axis=1)
+
+class DNNPolicy:
+    """
+    Play the interesting move with the best DNN value in each state, all candidates of all states in one model.predict
+    With epsilon > 0, a random interesting move is played instead with that probability
+    """
+
+    def __init__(self, model, n_moves=20, epsilon=0.0):
+        self.model = model
+        self.n_moves = n_moves
+        self.epsilon = epsilon
+        self.move_interest_values = np.zeros((board_size, board_size), dtype=np.float32)
+
+    def __call__(self, states, players, games):
+        from AIPlayer import find_interesting_moves
+        all_moves = []
+        for state, player in zip(states, players):
+            empty_spots_left = int(np.sum(state == 0))
+            self.move_interest_values.fill(0)
+            self.move_interest_values[4:11, 4:11] = 5.0
+            all_moves.append(find_interesting_moves(state, empty_spots_left, self.move_interest_values, player, self.n_moves))
+        counts = np.array([len(m) for m in all_moves])
+        # the states after each candidate move from the view of the player to move, as in AIPlayer.dnn_evaluate
+        game_idx = np.repeat(np.arange(len(states)), counts)
+        moves = np.concatenate(all_moves).astype(np.int64)
+        x = np.zeros((len(moves), 3, board_size, board_size), dtype=np.float32)
+        x[:,0] = states[game_idx] == players[game_idx,None,None]
+        x[:,1] = states[game_idx] == -players[game_idx,None,None]
+        x[:,2] = (players[game_idx] == 1)[:,None,None]
+        x[np.arange(len(moves)), 0, moves[:,0], moves[:,1]] = 1
+        q = self.model.predict(x).ravel()
+        # the best candidate of each state
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        best = np.array([start + np.argmax(q[start:start+n]) for start, n in zip(starts, counts)])
+        if self.epsilon > 0:
+            explore = np.random.random(len(states)) < self.epsilon
+            best[explore] = starts[explore] + (np.random.random(explore.sum()) * counts[explore]).astype(np.int64)
+        return moves[best]
+
+class SearchPolicy:
+    """
+    Play the move of the strategy() of a player for each state, e.g. an AIPlayer search, each game searches in its own thread
+    players[i] is (black player, white player) of game i and models[i] their models, the games can't share player objects
+    The DNN evaluations of all games searching in one step are done together, in one model.predict per model,
+    the players predict with the views of a BatchingModel of the step
+    """
+
+    def __init__(self, players, models):
+        self.players = players
+        self.models = models
+
+    def __call__(self, states, players, games):
+        from inference_server import BatchingModel
+        # the threads predict with their players' models through the views
+        batcher = BatchingModel(None, len(games))
+        moves = np.zeros((len(games), 2), dtype=np.int64)
+        # the exceptions of the threads, raised here after all of them finish
+        errors = []
+
+        def search(k):
+            try:
+                i = 0 if players[k] == 1 else 1
+                player = self.players[games[k]][i]
+                player.model = batcher.for_model(self.models[games[k]][i])
+                move, q = player.strategy(game_state(states[k]))
+                # strategy() returns 1-based moves, (0, 0) to admit defeat, which is an illegal move here
+                moves[k] = move[0] - 1, move[1] - 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                batcher.leave()
+
+        threads = [threading.Thread(target=search, args=(k,)) for k in range(len(games))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return moves
+
+def game_state(state):
+    """ Return a GameState of the (15, 15) state for strategy(), the moves are in board order, only their number is right """
+    from game_state import GameState
+    gs = GameState(state.shape[-1])
+    gs.board[:] = state
+    gs.moves = list(zip(*np.nonzero(state)))
+    return gs
+
+def board_from_stones(stones):
+    """ Return the (15, 15) state of stones = (x_stones, o_stones), sets of 1-based positions as the begin boards of Gomoku """
+    from game_state import GameState
+    gs = GameState(board_size)
+    gs.set_stones(stones)
+    return gs.board
+
+def benchmark(n_games=256):
+    """ Compare random games played in one batch to the same number played one by one """
+    t0 = time.time()
+    game = BatchGomoku(n_games)
+    winners = game.play(random_policy)
+    print(f"{n_games} games in a batch: {time.time()-t0:.2f}s, black {np.sum(winners == 1)} white {np.sum(winners == -1)} draw {np.sum(winners == 0)}, "
+          f"{np.sum(game.overlines)} overlines")
+    t0 = time.time()
+    for _ in range(n_games):
+        game = BatchGomoku(1)
+        game.play(random_policy)
+    print(f"{n_games} games one by one: {time.time()-t0:.2f}s")
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import numba
+import numpy as np
+
+board_size = 15
+# number of lines in each direction, diagonals have the most
+n_lines = 2 * board_size - 1
+
+# the lines in direction k of ((1,1), (1,0), (0,1), (1,-1)) are stored in bits[player_index, k]
+# each line is an int64 where bit i is the i-th spot on the line
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_index(r, c, k):
+    """ Return (line, bit) of the spot (r,c) on its line in direction k """
+    if k == 0:
+        return c - r + board_size - 1, r
+    elif k == 1:
+        return c, r
+    elif k == 2:
+        return r, c
+    else:
+        return r + c, r
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_spot(k, line, bit):
+    """ Return the spot (r,c) of bit on the line in direction k, the reverse of line_index """
+    if k == 0:
+        return bit, line - board_size + 1 + bit
+    elif k == 1:
+        return bit, line
+    elif k == 2:
+        return line, bit
+    else:
+        return bit, line - bit
+
+def make_line_masks():
+    """ Return the mask of the spots on the board for each line """
+    masks = np.zeros((4, n_lines), dtype=np.int64)
+    for r in range(board_size):
+        for c in range(board_size):
+            for k in range(4):
+                line, bit = line_index(r, c, k)
+                masks[k, line] |= 1 << bit
+    return masks
+
+line_masks = make_line_masks()
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def new_bitboard():
+    """ Return empty bitboards of both players, [0] for black stones, [1] for white stones """
+    return np.zeros((2, 4, n_lines), dtype=np.int64)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def set_bitboard(bits, state):
+    """ Set bits to the stones on state """
+    bits[:] = 0
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] != 0:
+                place_stone(bits, r, c, state[r,c])
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def place_stone(bits, r, c, player):
+    """ Put a stone of player at (r,c) """
+    pidx = 0 if player == 1 else 1
+    for k in range(4):
+        line, bit = line_index(r, c, k)
+        bits[pidx, k, line] |= 1 << bit
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def remove_stone(bits, r, c):
+    """ Remove the stone at (r,c) """
+    for k in range(4):
+        line, bit = line_index(r, c, k)
+        bits[0, k, line] &= ~(1 << bit)
+        bits[1, k, line] &= ~(1 << bit)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def popcount(x):
+    """ Number of bits set in x, which has at most 16 bits """
+    x = x - ((x >> 1) & 0x5555)
+    x = (x & 0x3333) + ((x >> 2) & 0x3333)
+    x = (x + (x >> 4)) & 0x0f0f
+    return (x + (x >> 8)) & 0x1f
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def five_spots_mask(mine, empty):
+    """ Return the mask of the empty spots where placing a stone makes exactly 5 in a row,
+    mine and empty are the masks of the player's stones and the empty spots on a line """
+    # windows of 5 starting at bit i, without the player's stone at i-1 and i+5 (overline)
+    ends = ~(mine << 1) & ~(mine >> 5)
+    spots = 0
+    for k in range(5):
+        # the spot at i+k is empty and the other 4 are mine
+        window = ends & (empty >> k)
+        for j in range(5):
+            if j != k:
+                window &= mine >> j
+        spots |= window << k
+    return spots
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_five_spots(bits, k, line, pidx):
+    """ Return the mask of the spots on the line where player pidx makes exactly 5 """
+    mine = bits[pidx, k, line]
+    if popcount(mine) < 4:
+        return 0
+    empty = line_masks[k, line] & ~(mine | bits[1-pidx, k, line])
+    return five_spots_mask(mine, empty)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def count_five_spots(bits, player, five_spots):
+    """ Find all empty spots where player can make exactly 5 in a row
+    Store the first spots in five_spots (n x 2) in the order of rows, and return the total number found """
+    pidx = 0 if player == 1 else 1
+    # the spots found in each row, a spot can make 5 on more than one line
+    rows = np.zeros(board_size, dtype=np.int64)
+    for k in range(4):
+        for line in range(n_lines):
+            spots = line_five_spots(bits, k, line, pidx)
+            while spots != 0:
+                bit = 0
+                while not (spots >> bit) & 1:
+                    bit += 1
+                spots &= ~(1 << bit)
+                r, c = line_spot(k, line, bit)
+                rows[r] |= 1 << c
+    n = 0
+    for r in range(board_size):
+        for c in range(board_size):
+            if (rows[r] >> c) & 1:
+                if n < len(five_spots):
+                    five_spots[n,0] = r
+                    five_spots[n,1] = c
+                n += 1
+    return n
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def count_five_spots_near(bits, r, c, player, five_spots):
+    """ Find the empty spots within 4 steps on the 4 lines through (r,c) where player can make exactly 5 on that line,
+    which are all the new ones after player placed a stone at (r,c)
+    Store the first spots in five_spots (n x 2), and return the number found """
+    pidx = 0 if player == 1 else 1
+    n = 0
+    for k in range(4):
+        line, bit = line_index(r, c, k)
+        # spots within 4 steps of (r,c)
+        near = (0x1ff << bit) >> 4
+        spots = line_five_spots(bits, k, line, pidx) & near
+        for b in range(max(bit-4, 0), bit+5):
+            if (spots >> b) & 1:
+                if n < len(five_spots):
+                    five_spots[n,0], five_spots[n,1] = line_spot(k, line, b)
+                n += 1
+    return n
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def is_five(bits, r, c, player):
+    """ Return True if placing a stone of player at the empty spot (r,c) makes exactly 5 in a row """
+    pidx = 0 if player == 1 else 1
+    for k in range(4):
+        line, bit = line_index(r, c, k)
+        mine = bits[pidx, k, line] | (1 << bit)
+        for start in range(max(bit-4, 0), bit+1):
+            window = 0x1f << start
+            if mine & window == window and not (mine >> (start+5)) & 1 and (start == 0 or not (mine >> (start-1)) & 1):
+                return True
+    return False
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def may_make_n(bits, r, c, player, n):
+    """ Quick check if placing player's stone at (r,c) might make n+1 in a row:
+    Some 5-spot window through (r,c) has n stones of player and no opponent stone """
+    pidx = 0 if player == 1 else 1
+    for k in range(4):
+        line, bit = line_index(r, c, k)
+        mine = bits[pidx, k, line]
+        # the opponent's stones and the spots outside the board block the windows
+        blocked = bits[1-pidx, k, line] | ~line_masks[k, line]
+        for start in range(max(bit-4, 0), bit+1):
+            window = 0x1f << start
+            if blocked & window == 0 and popcount(mine & window) == n:
+                return True
+    return False
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def is_win_next(bits, r, c, player):
+    """ Return True if placing a stone of player at the empty spot (r,c) makes 5,
+    or an open four or double four (2 spots to make 5), which wins if the opponent can't make 5 first """
+    if is_five(bits, r, c, player):
+        return True
+    five_spots = np.empty((2, 2), dtype=np.int64)
+    place_stone(bits, r, c, player)
+    n = count_five_spots_near(bits, r, c, player, five_spots)
+    remove_stone(bits, r, c)
+    return n >= 2
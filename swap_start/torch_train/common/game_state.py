@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import numpy as np
+
+class GameState:
+    """
+    State of a game for the players' strategy(), updated move by move
+    board is an int8 array, 1 = black, -1 = white, 0 = empty, the same as the state searched by AIPlayer
+    moves are the stones placed in order, as 0-based (r, c)
+    Players should read board without changing it, and copy it if they need to
+    """
+
+    def __init__(self, board_size=15):
+        self.board_size = board_size
+        self.board = np.zeros((board_size, board_size), dtype=np.int8)
+        self.moves = []
+
+    @property
+    def playing(self):
+        """ Index of the player to move, 0 for black, 1 for white """
+        return len(self.moves) % 2
+
+    @property
+    def last_move(self):
+        """ The last move, 0-based, None if the board is empty """
+        return self.moves[-1] if self.moves else None
+
+    @property
+    def empty_spots_left(self):
+        return self.board_size**2 - len(self.moves)
+
+    def place(self, move, player):
+        """ Put a stone of player (1 or -1) at the empty spot move, 0-based """
+        self.board[move] = player
+        self.moves.append(move)
+
+    def undo(self):
+        """ Remove the last stone """
+        self.board[self.moves.pop()] = 0
+
+    def set_stones(self, stones):
+        """ Set the board to stones = (x_stones, o_stones), sets of 1-based positions as in board_state of strategy() """
+        self.board.fill(0)
+        self.moves = []
+        black_stones, white_stones = [sorted(s) for s in stones]
+        # alternate the colors, so playing is right when black has the same number of stones or one more
+        for i in range(max(len(black_stones), len(white_stones))):
+            for player, player_stones in ((1, black_stones), (-1, white_stones)):
+                if i < len(player_stones):
+                    r, c = player_stones[i]
+                    self.place((r-1, c-1), player)
+
+    def stones(self):
+        """ Return (x_stones, o_stones), sets of 1-based positions """
+        return tuple({(int(r)+1, int(c)+1) for r, c in zip(*np.nonzero(self.board == player))} for player in (1, -1))
+
+    def five_stones(self, move):
+        """ Return the stones making exactly 5 in a row with the stone at move, an empty list if none """
+        player = self.board[move]
+        r, c = move
+        for dr, dc in ((1, 1), (1, 0), (0, 1), (1, -1)):
+            line = [move]
+            for sign in (1, -1):
+                i, j = r + sign*dr, c + sign*dc
+                while 0 <= i < self.board_size and 0 <= j < self.board_size and self.board[i, j] == player:
+                    line.append((i, j))
+                    i, j = i + sign*dr, j + sign*dc
+            if len(line) == 5:
+                return line
+        return []
@@ -15,7 +15,11 @@ import pickle
 import h5py
 import numpy as np
 import random
+import queue
+import threading
+import multiprocessing as mp
 from functools import update_wrapper
+from game_state import GameState
 
 def decorator(d):
     "Make function d a decorator: d wraps a function fn."
@@ -66,21 +70,33 @@ class Gomoku(object):
         print("*      Welcome to Gomoku !      *")
         print("*********************************")
         print(self.__doc__)
-        self.reset()
         self.board_size = board_size
+        self.reset()
         self.fastmode = fastmode
         #self.players = [Player(player_name) for player_name in players]
         self.first_center = first_center
 
     @property
     def state(self):
-        return (self.board, self.last_move, self.playing, self.board_size)
+        """ The GameState given to the players' strategy """
+        return self.game_state
+
+    @property
+    def board(self):
+        """ (x_stones, o_stones), sets of positions of each player's stones """
+        return self.game_state.stones()
+
+    @board.setter
+    def board(self, stones):
+        self.game_state.set_stones(stones)
 
     def load_state(self, state):
-        (self.board, self.last_move, self.playing, self.board_size) = state
+        (board, self.last_move, self.playing, self.board_size) = state
+        self.game_state = GameState(self.board_size)
+        self.board = board
 
     def reset(self):
-        self.board = (set(), set())
+        self.game_state = GameState(self.board_size)
         self.playing = None
         self.winning_stones = set()
         self.last_move = None
@@ -91,9 +107,9 @@ class Gomoku(object):
         for x in range(1, self.board_size+1):
             row = ['%2s|'%x]
             for y in range(1, self.board_size+1):
-                if (x,y) in self.board[0]:
+                if self.game_state.board[x-1,y-1] == 1:
                     c = 'x'
-                elif (x,y) in self.board[1]:
+                elif self.game_state.board[x-1,y-1] == -1:
                     c = 'o'
                 else:
                     c = '-'
@@ -104,7 +120,7 @@ class Gomoku(object):
 
     def play(self):
         if self.fastmode < 2:  print("Game Start!")
-        i_turn = len(self.board[0]) + len(self.board[1])
+        i_turn = len(self.game_state.moves)
         new_step = None
         while True:
             if self.fastmode < 2:  print("----- Turn %d -------" % i_turn)
@@ -150,50 +166,24 @@ class Gomoku(object):
             print("This position is outside the board!")
             return False
         # check if this position is already taken
-        taken_pos = self.board[0] | self.board[1]
-        if self.first_center is True and len(taken_pos) == 0:
+        if self.first_center is True and len(self.game_state.moves) == 0:
             # if this is the very first move, it must be on the center
             center = int((self.board_size+1)/2)
             if r != center or c != center:
                 print("This is the first move, please put it on the center (%s%s)!"% (str(center),chr(center+96)))
                 return False
-        elif self.last_move in taken_pos:
+        elif self.game_state.board[r-1,c-1] != 0:
             print("This position is already taken!")
             return False
-        self.board[self.playing].add(self.last_move)
+        self.game_state.place((r-1, c-1), 1 if self.playing == 0 else -1)
         return True
 
     def check_winner(self):
         r, c = self.last_move
-        my_stones = self.board[self.playing]
-        # find any nearby stone
-        nearby_stones = set()
-        for x in range(max(r-1, 1), min(r+2, self.board_size+1)):
-            for y in range(max(c-1, 1), min(c+2, self.board_size+1)):
-                stone = (x,y)
-                if stone in my_stones and (2*r-x, 2*c-y) not in nearby_stones:
-                    nearby_stones.add(stone)
-        for nearby_s in nearby_stones:
-            winning_stones = {self.last_move, nearby_s}
-            nr, nc = nearby_s
-            dx, dy = nr-r, nc-c
-            # try to extend in this direction
-            for i in range(1,5):
-                ext_stone = (nr+dx*i, nc+dy*i)
-                if ext_stone in my_stones:
-                    winning_stones.add(ext_stone)
-                else:
-                    break
-            # try to extend in the opposite direction
-            for i in range(1,5):
-                ext_stone = (r-dx*i, c-dy*i)
-                if ext_stone in my_stones:
-                    winning_stones.add(ext_stone)
-                else:
-                    break
-            if len(winning_stones) == 5:
-                self.winning_stones = winning_stones
-                return self.players[self.playing].name
+        winning_stones = self.game_state.five_stones((r-1, c-1))
+        if winning_stones:
+            self.winning_stones = {(i+1, j+1) for i, j in winning_stones}
+            return self.players[self.playing].name
         return None
 
     def delay(self, n):
@@ -290,7 +280,7 @@ def refine_train_data(player, learndata_A, learndata_B):
     for i, k in enumerate(learndata_A.keys()):
         x, y, n = learndata_A[k]
         # let white player evaluate this
-        _, opponent_q = player.best_action_q(x, 225, 1, -1, -1)
+        _, opponent_q = player.best_action_q(x, 225, -2.0, 2.0, -1)
         new_y = -opponent_q
         diff += (new_y-y)**2
         learndata_A[k] = x, new_y, n
@@ -301,7 +291,7 @@ def refine_train_data(player, learndata_A, learndata_B):
     for i, k in enumerate(learndata_B.keys()):
         x, y, n = learndata_B[k]
         # let black player evaluate this
-        _, opponent_q = player.best_action_q(x, 225, 1, -1, 1)
+        _, opponent_q = player.best_action_q(x, 225, -2.0, 2.0, 1)
         new_y = -opponent_q
         diff += (new_y-y)**2
         learndata_B[k] = x, new_y, n
@@ -323,6 +313,247 @@ def get_state(x1):
     is_black = bool(x1[2,0,0])
     return (x1[0] - x1[1]) if is_black else (x1[1] - x1[0])
 
+def make_players(model, args):
+    """ Create the Black and White players for self-play """
+    from AIPlayer import AIPlayer
+    if args.mcts > 0:
+        from MCTSPlayer import MCTSPlayer
+        player_A = MCTSPlayer('Black', model, n_playouts=args.mcts)
+        player_B = MCTSPlayer('White', model, n_playouts=args.mcts)
+    else:
+        player_A = AIPlayer('Black', model, symmetric=args.symmetric)
+        player_B = AIPlayer('White', model, symmetric=args.symmetric)
+        player_A.leaf_batch_size = player_B.leaf_batch_size = args.leaf_batch
+        player_A.collect_stats = player_B.collect_stats = getattr(args, 'search_stats', False)
+    # set up linked learndata and cache (allow AI to look into opponent's data)
+    player_A.opponent = player_B
+    player_B.opponent = player_A
+    return player_A, player_B
+
+def log_search_stats(players, stats_output, **info):
+    """ Write the search stats of the game of the players collecting them to stats_output, one line of JSON per player """
+    for player in players:
+        if getattr(player, 'collect_stats', False):
+            player.log_game_stats(stats_output, **info)
+    stats_output.flush()
+
+def selfplay_worker(worker_id, model, n_games, seed, args, results, stop):
+    """
+    Play n_games in a worker process, model is an InferenceClient of the main process
+    After each game, its learn data are sent to results as ('data', i, key, state bytes, q, n), i = 0 for Black's and 1 for White's,
+    followed by ('game', winner, begin board), and ('done', worker_id) at the end
+    """
+    # the forked workers start with the same random state, each draws its own begin boards
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        game = Gomoku(board_size=15, first_center=False)
+        game.fastmode = 2
+        game.players = make_players(model, args)
+        allstones = set([(r,c) for r in range(1,16) for c in range(1,16)])
+        begin_lib = __import__(args.begin_lib).begin_lib if args.begin_lib != None else None
+        for _ in range(n_games):
+            if stop.is_set():
+                break
+            game.reset()
+            for player in game.players:
+                player.reset()
+            if random.random() < args.begin_lib_p:
+                game.board = gen_begin_board(allstones, begin_lib)
+            else:
+                game.board = gen_begin_board(allstones, None)
+            begin_board = format_begin_board(game.board)
+            game.last_move = next(iter(game.board[0]))
+            winner = game.play()
+            for i, player in enumerate(game.players):
+                for k, (x, y, n) in player.learndata.items():
+                    results.put(('data', i, k, x.tobytes(), float(y), n))
+                player.learndata.clear()
+            results.put(('game', winner, begin_board))
+    finally:
+        results.put(('done', worker_id))
+
+def play_parallel(server, args, n_games, learndata_A, learndata_B, winner_board, game_output, max_data_count):
+    """
+    Play n_games in args.workers processes, which use the model through server
+    The learn data from the workers are merged into learndata_A and learndata_B as they arrive,
+    the last record of a state replaces the earlier ones like in one process
+    """
+    learndatas = (learndata_A, learndata_B)
+    results = mp.Queue()
+    stop = mp.Event()
+    workers = []
+    for worker_id, client in enumerate(server.clients):
+        n = n_games // args.workers + (1 if worker_id < n_games % args.workers else 0)
+        workers.append(mp.Process(target=selfplay_worker, args=(worker_id, client, n, random.getrandbits(32), args, results, stop)))
+    server.start()
+    for w in workers:
+        w.start()
+    i_game = 0
+    n_done = 0
+    while n_done < len(workers):
+        try:
+            record = results.get(timeout=10)
+        except queue.Empty:
+            if not any(w.is_alive() for w in workers):
+                print('Workers stopped unexpectedly')
+                break
+            continue
+        if record[0] == 'data':
+            _, i, k, x, y, n = record
+            learndatas[i][k] = [np.frombuffer(x, dtype=np.int8).reshape(15,15).copy(), y, n]
+        elif record[0] == 'game':
+            _, winner, begin_board = record
+            winner_board[winner] += 1
+            i_game += 1
+            game_output.write('Game %-4d: Winner is %s\n'%(i_game, winner))
+            game_output.flush()
+            n_used = len(learndata_A)
+            print(f"Finished game {i_game}: {begin_board} | data {n_used//1000}k/{max_data_count//1000}k")
+            # prevent memory overflow and getting killed
+            if n_used > max_data_count and not stop.is_set():
+                print('Learn data is full, stopping')
+                stop.set()
+        else:
+            n_done += 1
+    for w in workers:
+        w.join()
+    server.stop()
+    if server.error is not None:
+        raise server.error
+
+def play_batched(game, model, args, n_games, learndata_A, learndata_B, winner_board, game_output, max_data_count, stats_output=None):
+    """
+    Play n_games in args.batch_games threads of this process, a thread starts the next game when one finishes
+    The threads predict with one BatchingModel of model, so the DNN evaluations of all games in progress
+    are done together in one model.predict
+    Each thread plays with its own copy of game and its own players, which record learn data to learndata_A and
+    learndata_B like the players of game, and the AIPlayers share one cache
+    The search stats of each game are written to stats_output if given
+    """
+    from inference_server import BatchingModel
+    batcher = BatchingModel(model, args.batch_games)
+    allstones = set([(r,c) for r in range(1,16) for c in range(1,16)])
+    begin_lib = __import__(args.begin_lib).begin_lib if args.begin_lib != None else None
+    lock = threading.Lock()
+    # number of games started and finished, and if the learn data is full
+    counts = {'started': 0, 'finished': 0, 'full': False}
+    shared_cache = game.players[0].cache if args.mcts == 0 else None
+
+    def play_games():
+        try:
+            my_game = copy.copy(game)
+            my_game.players = make_players(batcher, args)
+            for player, learndata in zip(my_game.players, (learndata_A, learndata_B)):
+                player.learndata = learndata
+                if shared_cache is not None:
+                    player.cache = shared_cache
+            while True:
+                with lock:
+                    if counts['started'] >= n_games or counts['full']:
+                        break
+                    counts['started'] += 1
+                my_game.reset()
+                for player in my_game.players:
+                    player.reset()
+                if random.random() < args.begin_lib_p:
+                    my_game.board = gen_begin_board(allstones, begin_lib)
+                else:
+                    my_game.board = gen_begin_board(allstones, None)
+                begin_board = format_begin_board(my_game.board)
+                my_game.last_move = next(iter(my_game.board[0]))
+                winner = my_game.play()
+                with lock:
+                    winner_board[winner] += 1
+                    counts['finished'] += 1
+                    game_output.write('Game %-4d: Winner is %s\n'%(counts['finished'], winner))
+                    game_output.flush()
+                    if stats_output is not None:
+                        log_search_stats(my_game.players, stats_output, game=counts['finished'], winner=winner)
+                    n_used = len(learndata_A)
+                    print(f"Finished game {counts['finished']}: {begin_board} | data {n_used//1000}k/{max_data_count//1000}k | "
+                          f"{batcher.n_states/max(batcher.n_batches, 1):.0f} states per batch")
+                    # prevent memory overflow and getting killed
+                    if n_used > max_data_count and not counts['full']:
+                        print('Learn data is full, stopping')
+                        counts['full'] = True
+        finally:
+            batcher.leave()
+
+    threads = [threading.Thread(target=play_games) for _ in range(args.batch_games)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def play_arena(new_model, prev_model, args, game_output):
+    """
+    Play the new model against the previous one for at most args.arena_games games, in rounds of args.arena_threads games
+    played in lock step on a BatchGomoku, each game searches its move in its own thread with SearchPolicy,
+    and the DNN evaluations of all games of a step are done together
+    The games are played in pairs from the same begin board, the new model plays Black in one and White in the other
+    The match stops after the round where the SPRT of the result accepts or rejects that the new model is stronger
+    Return the MatchResult
+    """
+    from AIPlayer import TranspositionTable
+    from arena import MatchResult
+    from batch_game import BatchGomoku, SearchPolicy, board_from_stones
+    allstones = set([(r,c) for r in range(1,16) for c in range(1,16)])
+    begin_lib = __import__(args.begin_lib).begin_lib if args.begin_lib != None else None
+    result = MatchResult()
+    # an even number of games per round, for the pairs of games
+    round_games = max(args.arena_threads // 2 * 2, 2)
+    # the players of each game of a round, {model id: (Black, White)}
+    game_players = []
+    for _ in range(round_games):
+        players = {}
+        for model in (new_model, prev_model):
+            players[id(model)] = make_players(model, args)
+            for player in players[id(model)]:
+                # no learn data or search stats in the arena
+                player.opponent = None
+                player.collect_stats = False
+        game_players.append(players)
+    if args.mcts == 0:
+        # the positions evaluated by the same model share a cache
+        for model in (new_model, prev_model):
+            cache = TranspositionTable()
+            for players in game_players:
+                for player in players[id(model)]:
+                    player.cache = cache
+    while result.n_games < args.arena_games and result.sprt() is None:
+        n_games = min(round_games, (args.arena_games - result.n_games + 1) // 2 * 2)
+        begin_boards = []
+        for _ in range(n_games // 2):
+            if random.random() < args.begin_lib_p:
+                begin_boards.append(gen_begin_board(allstones, begin_lib))
+            else:
+                begin_boards.append(gen_begin_board(allstones, None))
+        # the new model plays Black in the even games
+        new_is_black = [i % 2 == 0 for i in range(n_games)]
+        models = [(new_model, prev_model) if is_black else (prev_model, new_model) for is_black in new_is_black]
+        players = [(game_players[i][id(black_model)][0], game_players[i][id(white_model)][1]) for i, (black_model, white_model) in enumerate(models)]
+        for black_player, white_player in players:
+            black_player.reset()
+            white_player.reset()
+        batch = BatchGomoku(n_games)
+        batch.reset(np.stack([board_from_stones(begin_boards[i // 2]) for i in range(n_games)]))
+        winners = batch.play(SearchPolicy(players, models))
+        for i in range(n_games):
+            if winners[i] == 0:
+                score = 0.5
+            else:
+                score = 1.0 if (winners[i] == 1) == new_is_black[i] else 0.0
+            result.add(new_is_black[i], score)
+            game_output.write('Game %-4d: New model as %s, score %.1f\n'%(result.n_games, 'Black' if new_is_black[i] else 'White', score))
+            lower, upper = result.elo_interval()
+            print(f"Arena game {result.n_games}: {format_begin_board(begin_boards[i // 2])} | new model +{result.wins} ={result.draws} -{result.losses} | "
+                  f"Elo {result.elo():+.0f} ({lower:+.0f} .. {upper:+.0f}) LLR {result.llr():.2f}")
+        game_output.flush()
+    if result.sprt() is not None:
+        print(f"SPRT accepts {result.sprt()} after {result.n_games} games")
+    return result
+
 MODEL_FILE = 'dnn_model.pt'
 
 def main():
@@ -335,6 +566,14 @@ def main():
     parser.add_argument('-p', '--begin_lib_p', type=float, default=1.0, help='Possibility of begin lib to be used')
     parser.add_argument('-r', '--refine_data', action='store_true', help='Use a higher level AI to refine data before training')
     parser.add_argument('-b', '--benchmark', action='store_true', default=False, help='Enable benchmark after each training model')
+    parser.add_argument('-a', '--arena_games', type=int, default=200, help='Max number of benchmark games of the new model against the previous one, fewer when the SPRT stops early')
+    parser.add_argument('-j', '--arena_threads', type=int, default=16, help='Number of benchmark games played together in lock step, each searching in its own thread')
+    parser.add_argument('-s', '--symmetric', action='store_true', default=False, help='Share cache and learn data among rotated or mirrored states')
+    parser.add_argument('-m', '--mcts', type=int, default=0, help='Use Monte-Carlo tree search players with this number of playouts per move, 0 to use AIPlayer')
+    parser.add_argument('-w', '--workers', type=int, default=0, help='Play the games and refine the data in this number of processes sharing the model through an inference server, 0 to use this process only')
+    parser.add_argument('-g', '--batch_games', type=int, default=0, help='Play this number of games together in threads of this process, evaluating their DNN requests in one batch, 0 to play one game at a time')
+    parser.add_argument('-S', '--search_stats', action='store_true', help='Write the search stats of every move of the games to search_stats.jsonl, one line per game and player')
+    parser.add_argument('-L', '--leaf_batch', type=int, default=0, help='Evaluate the leaves of sibling subtrees in batches of this size (256-1024), 0 to evaluate each node separately')
     args = parser.parse_args()
 
     game = Gomoku(board_size=15, first_center=False)
@@ -382,12 +621,7 @@ def main():
 
 
     from AIPlayer import AIPlayer
-    player_A = AIPlayer('Black', model)
-    player_B = AIPlayer('White', model)
-    # set up linked learndata and cache (allow AI to look into opponent's data)
-    player_A.opponent = player_B
-    player_B.opponent = player_A
-
+    player_A, player_B = make_players(model, args)
     game.players = [player_A, player_B]
     if args.train_step > 1:
         game.fastmode = 2
@@ -400,6 +634,14 @@ def main():
     else:
         begin_lib = None
 
+    if args.workers > 0:
+        # the workers share this process's model
+        from inference_server import InferenceServer
+        server = InferenceServer(model, args.workers)
+
+    # search_stats.jsonl of the model being trained, None if not writing the stats
+    stats_output = None
+
     def playone(i, game_output, winner_board, replay=False):
         game.reset()
         player_A.reset()
@@ -419,107 +661,114 @@ def main():
         winner_board[winner] += 1
         game_output.write('Game %-4d: Winner is %s\n'%(i+1, winner))
         game_output.flush()
+        if stats_output is not None:
+            log_search_stats(game.players, stats_output, game=i+1, winner=winner)
 
     print("Training the model for %d iterations."%args.n_train)
 
-    for i_train in range(last_i_train+1, args.n_train):
-        model_name = "trained_model_%03d" % i_train
-        # create and enter the model folder
-        os.mkdir(model_name)
-        os.chdir(model_name)
-        # play the games
-        print("Training model %s" % model_name)
-        winner_board = dict([(p.name, 0) for p in game.players])
-        winner_board['Draw'] = 0
-        with open('game_results.txt','w') as game_output:
-            replay_last_game = False
-            i_game = 0
-            repeating_n = 0
-            repeat_n_after_surprise = 0
-            while True:
-                playone(i_game, game_output, winner_board, replay=replay_last_game)
-                surprised = False # any(player.surprised for player in game.players)
-                replay_last_game = False
-                # if surprised:
-                #     replay_last_game = True
-                #     repeat_n_after_surprise = 0
-                # elif repeat_n_after_surprise < 5:
-                #     # keep replaying at least 5 games after surprise
-                #     replay_last_game = True
-                n_used = len(player_A.learndata)
+    try:
+        for i_train in range(last_i_train+1, args.n_train):
+            model_name = "trained_model_%03d" % i_train
+            # create and enter the model folder
+            os.mkdir(model_name)
+            os.chdir(model_name)
+            # play the games
+            print("Training model %s" % model_name)
+            winner_board = dict([(p.name, 0) for p in game.players])
+            winner_board['Draw'] = 0
+            # the worker processes don't send the stats
+            stats_output = open('search_stats.jsonl', 'w') if args.search_stats and args.workers == 0 else None
+            with open('game_results.txt','w') as game_output:
                 max_data_count = 3000000
-                if replay_last_game:
-                    repeating_n += 1
-                    repeat_n_after_surprise += 1
-                    print(f"Game {i_game} repeating {repeating_n} | {repeat_n_after_surprise}: {game.last_begin_board} | data {n_used//1000}k/{max_data_count//1000}k")
+                if args.workers > 0:
+                    play_parallel(server, args, args.train_step, player_A.learndata, player_B.learndata, winner_board, game_output, max_data_count)
+                elif args.batch_games > 0:
+                    play_batched(game, model, args, args.train_step, player_A.learndata, player_B.learndata, winner_board, game_output, max_data_count, stats_output)
                 else:
+                    replay_last_game = False
+                    i_game = 0
                     repeating_n = 0
                     repeat_n_after_surprise = 0
-                    i_game += 1
-                    if i_game >= args.train_step:
-                        break
-                    print(f"New game {i_game}: {format_begin_board(game.last_begin_board)} | data {n_used//1000}k/{max_data_count//1000}k")
-                # prevent memory overflow and getting killed
-                if n_used > max_data_count:
-                    print('Learn data is full, stopping')
-                    break
-
-        print("Name    |   Games Won")
-        for name, nwin in winner_board.items():
-            print("%-7s | %7d"%(name, nwin))
-        # reset player cache
-        player_A.reset_cache()
-        player_B.reset_cache()
-        # share the cache
-        player_B.cache = player_A.cache
-        # refine the data if needed
-        if args.refine_data:
-            refine_train_data(player_A, player_A.learndata, player_B.learndata)
-        # collect training data
-        train_X, train_Y, train_W = prepare_train_data(player_A.learndata, player_B.learndata)
-        # fit the model
-        # import IPython; IPython.embed()
-        model.fit(train_X, train_Y, epochs=args.n_epoch, validation_split=0.2)
-        save_model(model, MODEL_FILE)
-        print("Model %s saved!" % model_name)
-        os.chdir('..')
-        if args.benchmark and i_train > 0:
-            prev_model_name = f"trained_model_{i_train-1:03d}"
-            prev_model_name = os.path.join(prev_model_name, MODEL_FILE)
-            prev_model = load_existing_model(prev_model_name)
-            os.chdir(model_name)
-            with open('benchmark.txt','w') as game_output:
-                # play 1000 games as Black
-                print("New model as Black", file=game_output)
-                player_A.model, player_B.model = model, prev_model
-                winner_board_b = dict([(p.name, 0) for p in game.players])
-                winner_board_b['Draw'] = 0
-                for i_game in range(100):
-                    playone(i_game, game_output, winner_board_b)
-                print("Name    |   Games Won", file=game_output)
-                for name, nwin in winner_board_b.items():
-                    print("%-7s | %7d"%(name, nwin), file=game_output)
-                # play 100 games as White
-                print("New model as White", file=game_output)
-                player_A.model, player_B.model = prev_model, model
-                winner_board_w = dict([(p.name, 0) for p in game.players])
-                winner_board_w['Draw'] = 0
-                for i_game in range(100):
-                    playone(i_game, game_output, winner_board_w)
-                print("Name    |   Games Won", file=game_output)
-                for name, nwin in winner_board_w.items():
-                    print("%-7s | %7d"%(name, nwin), file=game_output)
-                print('\n\n'+'-' * 50, file=game_output)
-                print(f'           |   Win           Lose           Draw', file=game_output)
-                print('-' * 50, file=game_output)
-                print(f' as Black  | {winner_board_b[player_A.name]:10} {winner_board_b[player_B.name]:10} {winner_board_b["Draw"]:10}', file=game_output)
-                print(f' as White  | {winner_board_w[player_B.name]:10} {winner_board_w[player_A.name]:10} {winner_board_w["Draw"]:10}', file=game_output)
-                print('-' * 50, file=game_output)
+                    while True:
+                        playone(i_game, game_output, winner_board, replay=replay_last_game)
+                        surprised = False # any(player.surprised for player in game.players)
+                        replay_last_game = False
+                        # if surprised:
+                        #     replay_last_game = True
+                        #     repeat_n_after_surprise = 0
+                        # elif repeat_n_after_surprise < 5:
+                        #     # keep replaying at least 5 games after surprise
+                        #     replay_last_game = True
+                        n_used = len(player_A.learndata)
+                        if replay_last_game:
+                            repeating_n += 1
+                            repeat_n_after_surprise += 1
+                            print(f"Game {i_game} repeating {repeating_n} | {repeat_n_after_surprise}: {game.last_begin_board} | data {n_used//1000}k/{max_data_count//1000}k")
+                        else:
+                            repeating_n = 0
+                            repeat_n_after_surprise = 0
+                            i_game += 1
+                            if i_game >= args.train_step:
+                                break
+                            print(f"New game {i_game}: {format_begin_board(game.last_begin_board)} | data {n_used//1000}k/{max_data_count//1000}k")
+                        # prevent memory overflow and getting killed
+                        if n_used > max_data_count:
+                            print('Learn data is full, stopping')
+                            break
+
+            if stats_output is not None:
+                stats_output.close()
+                stats_output = None
+            print("Name    |   Games Won")
+            for name, nwin in winner_board.items():
+                print("%-7s | %7d"%(name, nwin))
+            # reset player cache
+            player_A.reset_cache()
+            player_B.reset_cache()
+            # share the cache
+            if args.mcts == 0:
+                player_B.cache = player_A.cache
+            # refine the data if needed
+            if args.refine_data:
+                # MCTS players don't have best_action_q, refine with an AIPlayer
+                refine_player = player_A if args.mcts == 0 else AIPlayer('Refine', model, symmetric=args.symmetric)
+                refine_player.leaf_batch_size = args.leaf_batch
+                if args.workers > 0:
+                    # search the root moves in the worker processes
+                    refine_player.start_root_pool(server.clients)
+                    server.start()
+                refine_train_data(refine_player, player_A.learndata, player_B.learndata)
+                if args.workers > 0:
+                    refine_player.stop_root_pool()
+                    server.stop()
+            # collect training data
+            train_X, train_Y, train_W = prepare_train_data(player_A.learndata, player_B.learndata)
+            # fit the model
+            # import IPython; IPython.embed()
+            model.fit(train_X, train_Y, epochs=args.n_epoch, validation_split=0.2)
+            save_model(model, MODEL_FILE)
+            print("Model %s saved!" % model_name)
             os.chdir('..')
-            # refresh the training by loading it back
-            model_fnm = os.path.join(model_name, MODEL_FILE)
-            model = load_existing_model(model_fnm)
-            player_A.model = player_B.model = model
+            if args.benchmark and i_train > 0:
+                prev_model_name = f"trained_model_{i_train-1:03d}"
+                prev_model_name = os.path.join(prev_model_name, MODEL_FILE)
+                prev_model = load_existing_model(prev_model_name)
+                os.chdir(model_name)
+                with open('benchmark.txt','w') as game_output:
+                    result = play_arena(model, prev_model, args, game_output)
+                    print('\n\n' + result.summary(), file=game_output)
+                print(result.summary())
+                os.chdir('..')
+                # refresh the training by loading it back
+                model_fnm = os.path.join(model_name, MODEL_FILE)
+                model = load_existing_model(model_fnm)
+                player_A.model = player_B.model = model
+                if args.workers > 0:
+                    server.model = model
+    finally:
+        if args.workers > 0:
+            # free the shared memory of the server
+            server.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import queue
+import traceback
+import numpy as np
+
+board_size = 15
+
+class InferenceServer:
+    """
+    Serve model.predict to self-play worker processes, so only this process keeps a copy of the model
+    Each client has its own shared memory slot for the board tensors and the predicted values,
+    only the client ids go through a queue
+    The server thread waits for the first request, then collects the other requests until max_batch states
+    or max_wait seconds have passed, and evaluates them all in one model.predict
+    If model.predict raises, the clients of the batch raise in their predict(), and the error is kept in self.error
+    """
+
+    def __init__(self, model, n_clients, max_batch=1024, max_wait=0.002):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        ctx = mp.get_context()
+        # client ids of the pending requests, None stops the server
+        self.requests = ctx.Queue()
+        self.shms = []
+        self.clients = []
+        for client_id in range(n_clients):
+            shm = shared_memory.SharedMemory(create=True, size=InferenceClient.slot_size(max_batch))
+            self.shms.append(shm)
+            self.clients.append(InferenceClient(client_id, shm.name, max_batch, self.requests, ctx.Semaphore(0)))
+        # states of one batch
+        self.batch_states = np.zeros((max_batch, 3, board_size, board_size), dtype=np.float32)
+        self.thread = None
+        # the last exception of model.predict, None if it never failed
+        self.error = None
+
+    def start(self):
+        """ Start serving in a thread, the model should not be changed until stop() """
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the server thread after the pending requests """
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """ Stop the server and free the shared memory """
+        self.stop()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
+
+    def serve(self):
+        slots = [client.attach(shm) for client, shm in zip(self.clients, self.shms)]
+        stopping = False
+        # the request that didn't fit in the last batch
+        carried = None
+        while not stopping:
+            if carried is not None:
+                client_id, carried = carried, None
+            else:
+                client_id = self.requests.get()
+            if client_id is None:
+                break
+            batch = [client_id]
+            n_states = slots[client_id][0][0]
+            deadline = time.time() + self.max_wait
+            # collect more requests until the batch is full or the latency cap is reached
+            while n_states < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    client_id = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if client_id is None:
+                    stopping = True
+                    break
+                n = slots[client_id][0][0]
+                if n_states + n > self.max_batch:
+                    # evaluate it in the next batch
+                    carried = client_id
+                    break
+                batch.append(client_id)
+                n_states += n
+            # evaluate all states in one predict
+            i = 0
+            for client_id in batch:
+                header, states, values = slots[client_id]
+                n = header[0]
+                self.batch_states[i:i+n] = states[:n]
+                i += n
+            try:
+                predict_y = self.model.predict(self.batch_states[:n_states]).ravel()
+            except Exception as e:
+                traceback.print_exc()
+                self.error = e
+                # a negative number of states tells the clients the batch failed
+                for client_id in batch:
+                    slots[client_id][0][0] = -1
+                    self.clients[client_id].done.release()
+                continue
+            i = 0
+            for client_id in batch:
+                header, states, values = slots[client_id]
+                n = header[0]
+                values[:n] = predict_y[i:i+n]
+                i += n
+                self.clients[client_id].done.release()
+
+class InferenceClient:
+    """
+    Stand-in for the model in a self-play worker process, predict() sends the states to InferenceServer and waits
+    Pass it to the worker process when it is started, the shared memory is attached in the worker
+    """
+
+    def __init__(self, client_id, shm_name, max_batch, requests, done):
+        self.client_id = client_id
+        self.shm_name = shm_name
+        self.max_batch = max_batch
+        self.requests = requests
+        # released by the server when the values are ready
+        self.done = done
+        self.shm = None
+
+    @staticmethod
+    def slot_size(max_batch):
+        """ Bytes of the shared memory slot: the number of states, the states and their values """
+        return 8 + max_batch * 3 * board_size**2 * 4 + max_batch * 4
+
+    def attach(self, shm):
+        """ Return the header, states and values arrays in the slot shm """
+        header = np.ndarray(1, dtype=np.int64, buffer=shm.buf)
+        states = np.ndarray((self.max_batch, 3, board_size, board_size), dtype=np.float32, buffer=shm.buf, offset=8)
+        values = np.ndarray(self.max_batch, dtype=np.float32, buffer=shm.buf, offset=8 + states.nbytes)
+        return header, states, values
+
+    def __getstate__(self):
+        # the attached shared memory is not sent to the other process
+        d = self.__dict__.copy()
+        d['shm'] = None
+        d.pop('slot', None)
+        return d
+
+    def predict(self, x):
+        """ Same as model.predict(x) of the server's model, x is (n, 3, 15, 15) float32 """
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(name=self.shm_name)
+            self.slot = self.attach(self.shm)
+        header, states, values = self.slot
+        y = np.empty((len(x), 1), dtype=np.float32)
+        for start in range(0, len(x), self.max_batch):
+            n = min(len(x) - start, self.max_batch)
+            states[:n] = x[start:start+n]
+            header[0] = n
+            self.requests.put(self.client_id)
+            self.done.acquire()
+            if header[0] < 0:
+                raise RuntimeError('model.predict failed in the InferenceServer')
+            y[start:start+n, 0] = values[:n]
+        return y
+
+class BatchingModel:
+    """
+    Stand-in for the model shared by n_clients threads of one process, e.g. the games of batched self-play
+    predict() waits until every active thread is waiting in predict(), then the last one evaluates all their states
+    in one model.predict, so the batch has the states of all threads
+    A thread has to call leave() when it won't predict anymore, or the others wait for it forever
+    Threads playing with several models, e.g. the games of an arena, predict with the views of for_model(),
+    so they share one batcher and wait for each other whichever model they use, each batch has one predict per model
+    """
+
+    def __init__(self, model, n_clients):
+        self.model = model
+        self.n_active = n_clients
+        self.cond = threading.Condition()
+        # [states, values, model] of the waiting threads, values is None until evaluated
+        self.requests = []
+        # number of model.predict calls and states evaluated
+        self.n_batches = 0
+        self.n_states = 0
+
+    def for_model(self, model):
+        """ Return a stand-in for model, which predicts in the batches of this batcher """
+        return BatchedModelView(self, model)
+
+    def predict(self, x, model=None):
+        """ Same as model.predict(x), returned when the batch with x is evaluated, model is self.model if None """
+        request = [x, None, self.model if model is None else model]
+        with self.cond:
+            self.requests.append(request)
+            if len(self.requests) >= self.n_active:
+                self.run_batch()
+            while request[1] is None:
+                self.cond.wait()
+        if isinstance(request[1], Exception):
+            raise request[1]
+        return request[1]
+
+    def leave(self):
+        """ The calling thread won't predict anymore """
+        with self.cond:
+            self.n_active -= 1
+            if self.requests and len(self.requests) >= self.n_active:
+                self.run_batch()
+
+    def run_batch(self):
+        # called with self.cond locked, while all other active threads are waiting
+        requests, self.requests = self.requests, []
+        models = {}
+        for request in requests:
+            models.setdefault(id(request[2]), []).append(request)
+        for model_requests in models.values():
+            try:
+                predict_y = model_requests[0][2].predict(np.concatenate([x for x, _, _ in model_requests]))
+            except Exception as e:
+                # raised in all the waiting threads
+                for request in requests:
+                    request[1] = e
+                self.cond.notify_all()
+                return
+            i = 0
+            for request in model_requests:
+                n = len(request[0])
+                request[1] = predict_y[i:i+n]
+                i += n
+            self.n_batches += 1
+            self.n_states += i
+        self.cond.notify_all()
+
+class BatchedModelView:
+    """ A model of the threads sharing a BatchingModel, see BatchingModel.for_model() """
+
+    def __init__(self, batcher, model):
+        self.batcher = batcher
+        self.model = model
+
+    def predict(self, x):
+        return self.batcher.predict(x, self.model)
+
+def client_benchmark(client, n_calls, n_states):
+    x = np.random.RandomState(client.client_id).randint(0, 2, size=(n_states, 3, board_size, board_size)).astype(np.float32)
+    for _ in range(n_calls):
+        client.predict(x)
+
+def benchmark(n_clients=8, n_calls=200, n_states=30):
+    """ Compare the time of n_clients processes predicting with the server, to one process predicting the same states """
+    from dnn_model import get_new_model
+    model = get_new_model()
+    x = np.zeros((n_states, 3, board_size, board_size), dtype=np.float32)
+    t0 = time.time()
+    for _ in range(n_clients * n_calls):
+        model.predict(x)
+    print(f"1 process: {time.time()-t0:.2f}s")
+    server = InferenceServer(model, n_clients)
+    server.start()
+    workers = [mp.Process(target=client_benchmark, args=(client, n_calls, n_states)) for client in server.clients]
+    t0 = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    print(f"{n_clients} processes with server: {time.time()-t0:.2f}s")
+    server.close()
+
+if __name__ == '__main__':
+    benchmark()
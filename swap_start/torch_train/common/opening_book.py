@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import os, time
+import numpy as np
+from AIPlayer import LineBoard, zobrist_keys as board_zobrist_keys
+
+board_size = 15
+
+# the zobrist keys of AIPlayer by flat index, so the book key of a state is its cache key in symmetric mode
+zobrist_keys = board_zobrist_keys.reshape(2, -1)
+
+def make_sym_points():
+    """ sym_points[t] maps the spots of the t-th symmetric board to the spots of the original board,
+    and sym_inverse[t] maps them back, both as flat indices """
+    sym_points = np.zeros((8, board_size**2), dtype=np.int64)
+    for t in range(8):
+        a = np.arange(board_size**2).reshape(board_size, board_size)
+        if t & 4:
+            a = a.T
+        if t & 1:
+            a = a[::-1, :]
+        if t & 2:
+            a = a[:, ::-1]
+        sym_points[t] = a.ravel()
+    return sym_points, np.argsort(sym_points, axis=1)
+
+sym_points, sym_inverse = make_sym_points()
+
+# one entry of the book, move is the flat index on the symmetric board with the smallest hash
+book_dtype = np.dtype([('key', '<i8'), ('move', '<i2'), ('player', 'i1'), ('level', 'i1'), ('q', '<f4')])
+
+def canonical_key(state):
+    """ Return (key, t) of state, the smallest zobrist hash among its 8 symmetric states, and the transformation t of it """
+    spots = np.flatnonzero(state)
+    colors = (state.ravel()[spots] == -1).astype(np.int64)
+    hashes = [np.bitwise_xor.reduce(zobrist_keys[colors, sym_inverse[t, spots]]) if len(spots) > 0 else 0 for t in range(8)]
+    t = int(np.argmin(hashes))
+    return int(hashes[t]), t
+
+class OpeningBook:
+    """
+    The best moves and q values of the opening positions, searched ahead of time by build_book()
+    The entries are sorted by key in a .npy file, which is memory-mapped instead of read,
+    so a lookup only reads the few pages visited by the binary search
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = np.load(path, mmap_mode='r')
+        self.keys = self.entries['key']
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, state, player):
+        """ Return (move, q) for player to play on state (1 = black, -1 = white), None if not in the book """
+        key, t = canonical_key(state)
+        i = np.searchsorted(self.keys, key)
+        while i < len(self.entries) and self.keys[i] == key:
+            entry = self.entries[i]
+            if entry['player'] == player:
+                move = divmod(int(sym_points[t, entry['move']]), board_size)
+                if state[move] == 0:
+                    return move, float(entry['q'])
+            i += 1
+        return None
+
+def load_book(path):
+    """ Return the OpeningBook at path, None if the file doesn't exist """
+    if path is None or not os.path.isfile(path):
+        return None
+    book = OpeningBook(path)
+    print(f"Opening book {path} loaded, {len(book)} positions")
+    return book
+
+def player_to_move(state):
+    """ Black moves when both have the same number of stones """
+    return 1 if np.sum(state == 1) == np.sum(state == -1) else -1
+
+def begin_states(begin_lib):
+    """ Return the states of the openings in begin_lib, stones are placed in turn starting with black, 1-based """
+    states = []
+    for stones in begin_lib:
+        state = np.zeros((board_size, board_size), dtype=np.int8)
+        for i, (r, c) in enumerate(stones):
+            state[r-1, c-1] = 1 if i % 2 == 0 else -1
+        states.append(state)
+    return states
+
+def build_book(player, states, max_ply, width=3):
+    """
+    Search all positions with less than max_ply stones reachable from states with player (AIPlayer),
+    following the best move and the next width-1 interesting moves at each position
+    Return the entries sorted by key
+    """
+    entries = {}
+    pending = [s.copy() for s in states if np.count_nonzero(s) < max_ply]
+    move_interest_values = np.zeros((board_size, board_size), dtype=np.float32)
+    t_start = time.time()
+    while pending:
+        state = pending.pop()
+        to_move = player_to_move(state)
+        key, t = canonical_key(state)
+        if (key, to_move) in entries:
+            continue
+        empty_spots_left = int(np.sum(state == 0))
+        player.cache.new_generation()
+        best_move, best_q = player.best_action_q(state.copy(), empty_spots_left, -2.0, 2.0, to_move)
+        best_move = (int(best_move[0]), int(best_move[1]))
+        entries[key, to_move] = (key, sym_inverse[t, best_move[0]*board_size+best_move[1]], to_move, player.level, best_q)
+        print(f"{len(entries):6d} positions, {len(pending):6d} pending, {time.time()-t_start:.0f}s", end='\r')
+        if np.count_nonzero(state) + 1 >= max_ply or abs(best_q) >= 1.0:
+            continue
+        # follow the best move and the most interesting others
+        move_interest_values.fill(0)
+        move_interest_values[4:11, 4:11] = 5.0
+        moves = LineBoard(state).find_interesting_moves(empty_spots_left, move_interest_values, to_move, width)
+        next_moves = [best_move] + [(int(r), int(c)) for r, c in moves if (r, c) != best_move][:width-1]
+        for r, c in next_moves:
+            next_state = state.copy()
+            next_state[r, c] = to_move
+            pending.append(next_state)
+    print()
+    book = np.array(sorted(entries.values()), dtype=book_dtype)
+    return book
+
+def data_states(fnm, max_ply):
+    """ Return the states with less than max_ply stones in the training data file fnm (data.h5 of gomoku_train_swap) """
+    import h5py
+    with h5py.File(fnm, 'r') as h5f:
+        states = np.concatenate([h5f['bx'][:], h5f['wx'][:]])
+    return [x for x in states if np.count_nonzero(x) < max_ply]
+
+def save_book(book, path):
+    np.save(path, book)
+    print(f"Opening book saved to {path}, {len(book)} positions")
+
+def main():
+    import argparse
+    from AIPlayer import AIPlayer
+    parser = argparse.ArgumentParser("Build the opening book from the begin board library and the openings of self-play games")
+    parser.add_argument('model_file', help='File to load model from')
+    parser.add_argument('-l', '--begin_lib', default='begin_lib', help='Begin board library file')
+    parser.add_argument('-d', '--data', nargs='*', default=[], help='Training data files (data.h5 of gomoku_train_swap) whose opening states are added')
+    parser.add_argument('-n', '--max_ply', default=7, type=int, help='Positions with less than this number of stones are in the book')
+    parser.add_argument('-w', '--width', default=3, type=int, help='Number of moves followed at each position')
+    parser.add_argument('-e', '--level', default=2, type=int, help='Search level of each position')
+    parser.add_argument('-o', '--output', default='opening_book.npy', help='Output file')
+    args = parser.parse_args()
+    player = AIPlayer('Book', args.model_file, level=args.level, pruning=True)
+    begin_lib = __import__(args.begin_lib).begin_lib
+    states = begin_states(begin_lib)
+    for fnm in args.data:
+        states += data_states(fnm, args.max_ply)
+    book = build_book(player, states, args.max_ply, args.width)
+    save_book(book, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import os
+import hashlib
+import tempfile
+import numba
+import numpy as np
+from bitboard import line_index, line_masks, popcount
+
+board_size = 15
+
+# flags of a spot on one line, see line_interest()
+MY_FIVE = 1 # player wins with this move
+OPPONENT_FIVE = 2 # the opponent wins here, player has to block
+EXACT_FIVE = 4 # player makes exactly 5 in a row, same as i_win
+HARD_4_SHIFT = 3 # the number of hard 4 made by player is stored from this bit
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_interest(state, r, c, dr, dc, player):
+    """ Look at the line through (r,c) in the direction (dr,dc), as if player placed a stone at (r,c)
+    Only the spots within 6 steps on this line are read, so it only changes when one of them changes
+
+    output:
+    -------
+    interest_value: int, the interest of (r,c) from this line for find_interesting_moves
+    flags: int, MY_FIVE, OPPONENT_FIVE and the number of hard 4 << HARD_4_SHIFT
+    """
+    interest_value = 0
+    my_line_length = 1 # last_move
+    opponent_line_length = 1
+    # try to extend in the positive direction (max 5 times to check overline)
+    ext_r = r
+    ext_c = c
+    skipped_1 = 0
+    my_blocked = False
+    opponent_blocked = False
+    for i in range(5):
+        ext_r += dr
+        ext_c += dc
+        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+            break
+        elif state[ext_r, ext_c] == player:
+            if my_blocked == True:
+                break
+            else:
+                my_line_length += 1
+                opponent_blocked = True
+        elif state[ext_r, ext_c] == -player:
+            if opponent_blocked == True:
+                break
+            else:
+                opponent_line_length += 1
+                my_blocked = True
+        elif skipped_1 == 0:
+            skipped_1 = i + 1 # allow one skip and record the position of the skip
+        else:
+            # peek at the next one and if it might be useful, add some interest
+            peek_r, peek_c = ext_r + dr, ext_c + dc
+            if 0 <= peek_r < board_size and 0 <= peek_c < board_size:
+                if ((state[peek_r, peek_c] == player) and (my_blocked == False)) or ((state[peek_r, peek_c] == -player) and (opponent_blocked == False)):
+                    interest_value += 15
+            break
+
+    # the backward counting starts at the furthest "unskipped" stone
+    forward_my_open = False
+    forward_opponent_open = False
+    if skipped_1 == 0:
+        my_line_length_back = my_line_length
+        opponent_line_length_back = opponent_line_length
+    elif skipped_1 == 1:
+        my_line_length_back = 1
+        opponent_line_length_back = 1
+        forward_my_open = True
+        forward_opponent_open = True
+    else:
+        if my_blocked == False:
+            my_line_length_back = skipped_1
+            opponent_line_length_back = 1
+            forward_my_open = True
+        else:
+            my_line_length_back = 1
+            opponent_line_length_back = skipped_1
+            forward_opponent_open = True
+    my_line_length_no_skip = my_line_length_back
+    opponent_line_length_no_skip = opponent_line_length_back
+
+    # backward is a little complicated, will try to extend my stones first
+    ext_r = r
+    ext_c = c
+    skipped_2 = 0
+    opponent_blocked = False
+    for i in range(6-my_line_length_no_skip):
+        ext_r -= dr
+        ext_c -= dc
+        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+            break
+        elif state[ext_r, ext_c] == player:
+            my_line_length_back += 1
+            opponent_blocked = True
+        elif state[ext_r, ext_c] == -player:
+            break
+        else:
+            if skipped_2 == 0:
+                skipped_2 = i + 1
+            else:
+                # peek at the next one and if it might be useful, add some interest
+                peek_r, peek_c = ext_r - dr, ext_c - dc
+                if 0 <= peek_r < board_size and 0 <= peek_c < board_size and state[peek_r, peek_c] == player:
+                    interest_value += 15
+                break
+
+    # see if i'm winning
+    if my_line_length_back == 5:
+        # if there are 5 stones in backward counting, and it's not skipped in the middle
+        if skipped_2 == 0 or skipped_2 == (6-my_line_length_no_skip):
+            # i will win with this move
+            return interest_value, MY_FIVE
+
+    # extend my forward line length to check if there is hard 4
+    if skipped_2 == 0:
+        my_line_length += my_line_length_back - my_line_length_no_skip
+    else:
+        my_line_length += skipped_2 - 1
+
+    backward_my_open = True if skipped_2 > 0 else False
+    backward_opponent_open = False
+    # then try to extend the opponent
+    if opponent_blocked == True:
+        if skipped_2 == 1:
+            backward_opponent_open = True
+        skipped_2 = 0 # reset the skipped_2 here to enable the check of opponent 5 later
+    else:
+        ext_r = r
+        ext_c = c
+        skipped_2 = 0
+        for i in range(6-opponent_line_length_no_skip):
+            ext_r -= dr
+            ext_c -= dc
+            if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+                break
+            elif state[ext_r, ext_c] == player:
+                break
+            elif state[ext_r, ext_c] == -player:
+                opponent_line_length_back += 1
+            else:
+                if skipped_2 == 0:
+                    skipped_2 = i + 1
+                else:
+                    # peek at the next one and if it might be useful, add some interest
+                    peek_r, peek_c = ext_r - dr, ext_c - dc
+                    if 0 <= peek_r < board_size and 0 <= peek_c < board_size and state[peek_r, peek_c] == -player:
+                        interest_value += 15
+                    break
+        # extend opponent forward line length to check if there is hard 4
+        if skipped_2 == 0:
+            opponent_line_length += opponent_line_length_back - opponent_line_length_no_skip
+        else:
+            opponent_line_length += skipped_2 - 1
+            backward_opponent_open = True
+            # here if opponent_line_length_back == 5, skipped_2 will be 0 and this flag won't be True
+            # but it do not affect our final result, because we have to block this no matter if it's open
+
+    # check if we have to block this
+    if opponent_line_length_back == 5:
+        if (skipped_2 == 0) or (skipped_2 == 6-opponent_line_length_no_skip):
+            return interest_value, OPPONENT_FIVE
+    # if I will win after this move, I won't consider other moves
+    my_hard_4 = 0
+    if forward_my_open == True and my_line_length == 4:
+        my_hard_4 += 1
+    if backward_my_open == True and my_line_length_back == 4:
+        my_hard_4 += 1
+    # compute the interest_value for other moves
+    # if any line length >= 5, it's an overline so skipped
+    if (forward_my_open == True) and (my_line_length < 5):
+        interest_value += my_line_length ** 4
+    if (backward_my_open == True) and (my_line_length_back < 5):
+        interest_value += my_line_length_back ** 4
+    if (forward_opponent_open == True) and (opponent_line_length < 5):
+        interest_value += opponent_line_length ** 4
+    if (backward_opponent_open == True) and (opponent_line_length_back < 5):
+        interest_value += opponent_line_length_back ** 4
+    return interest_value, my_hard_4 << HARD_4_SHIFT
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_five(state, r, c, dr, dc, player):
+    """ Return True if player makes exactly 5 in a row on the line through (r,c) in the direction (dr,dc)
+    by placing a stone at (r,c), same as i_win """
+    line_length = 1
+    ext_r = r
+    ext_c = c
+    for _ in range(5):
+        ext_r += dr
+        ext_c += dc
+        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size or state[ext_r, ext_c] != player:
+            break
+        line_length += 1
+    ext_r = r
+    ext_c = c
+    for _ in range(6-line_length):
+        ext_r -= dr
+        ext_c -= dc
+        if ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size or state[ext_r, ext_c] != player:
+            break
+        line_length += 1
+    return line_length == 5
+
+# Pattern table: the interest value and flags of line_interest() and line_five() for every line pattern
+# A pattern is the 6 spots on each side of a spot on one line, each side is encoded in base 3,
+# 0 = empty, 1 = player's stone, 2 = opponent's stone, digit j for the j-th spot of the side on the board along the line
+# the codes of a side with n spots on the board (n < 6 near the edge) start at half_offsets[n]
+half_offsets = np.array([(3**n - 1) // 2 for n in range(8)], dtype=np.int64)
+n_half_codes = half_offsets[7]
+# ternary[x] is the base 3 number with the 6 bits of x as digits
+ternary = np.array([sum(((x >> j) & 1) * 3**j for j in range(6)) for x in range(64)], dtype=np.int64)
+# the table stores interest_value << PATTERN_FLAG_BITS | flags
+PATTERN_FLAG_BITS = 5
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def build_pattern_table():
+    """ Evaluate line_interest() and line_five() on every pattern
+    Return the table indexed by [forward code, backward code], see pattern_codes() """
+    table = np.zeros((n_half_codes, n_half_codes), dtype=np.uint16)
+    state = np.zeros((board_size, board_size), dtype=np.int8)
+    for n_back in range(7):
+        for n_fwd in range(7):
+            # put the pattern on the diagonal (direction (1,1)) with exactly n_back and n_fwd spots on each side of (r,c)
+            r = n_back
+            c = r + board_size - 1 - n_back - n_fwd
+            for back_code in range(3**n_back):
+                code = back_code
+                for j in range(n_back):
+                    digit = code % 3
+                    code //= 3
+                    step = n_back - j
+                    state[r-step, c-step] = 1 if digit == 1 else (-1 if digit == 2 else 0)
+                for fwd_code in range(3**n_fwd):
+                    code = fwd_code
+                    for j in range(n_fwd):
+                        digit = code % 3
+                        code //= 3
+                        step = j + 1
+                        state[r+step, c+step] = 1 if digit == 1 else (-1 if digit == 2 else 0)
+                    value, flags = line_interest(state, r, c, 1, 1, 1)
+                    if line_five(state, r, c, 1, 1, 1):
+                        flags |= EXACT_FIVE
+                    table[half_offsets[n_fwd] + fwd_code, half_offsets[n_back] + back_code] = (value << PATTERN_FLAG_BITS) | flags
+            state[:] = 0
+    return table
+
+def pattern_table_path():
+    """ The file of the table in the user's cache folder, named by the hash of this file,
+    so the table is built again after line_interest() changes """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    with open(os.path.realpath(__file__), 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'gomoku', f'pattern_table_{digest}.npy')
+
+def load_pattern_table():
+    """ Load the table from the cache file, build and save it if the file is missing
+    The table is only kept in memory if the cache folder can't be written """
+    path = pattern_table_path()
+    if os.path.exists(path):
+        return np.load(path)
+    table = build_pattern_table()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write a temporary file and rename it, so the processes importing at the same time never read a partial table
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, table)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'Pattern table not saved to {path}: {e}')
+    return table
+
+# passed to the numba functions as an argument, a large global array would stop numba from caching them
+pattern_table = load_pattern_table()
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def pattern_codes(bits, r, c, k, pidx):
+    """ Return the forward and backward codes of the pattern of (r,c) on its line in direction k,
+    from the view of player pidx, read from the bitboard bits """
+    line, bit = line_index(r, c, k)
+    mask = line_masks[k, line]
+    mine = bits[pidx, k, line]
+    opponent = bits[1-pidx, k, line]
+    # bits bit+1 to bit+6 of the line
+    n_fwd = popcount((mask >> (bit+1)) & 0x3f)
+    fwd = half_offsets[n_fwd] + ternary[(mine >> (bit+1)) & 0x3f] + 2 * ternary[(opponent >> (bit+1)) & 0x3f]
+    # bits bit-6 to bit-1 of the line, the spots outside the board are the lowest ones
+    n_back = popcount(((mask << 6) >> bit) & 0x3f)
+    skip = 6 - n_back
+    back = half_offsets[n_back] + ternary[(((mine << 6) >> bit) & 0x3f) >> skip] + 2 * ternary[(((opponent << 6) >> bit) & 0x3f) >> skip]
+    return fwd, back
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def line_pattern(table, bits, r, c, k, pidx):
+    """ Same as line_interest() of player pidx on the line of (r,c) in direction k,
+    with EXACT_FIVE added to the flags if line_five(), looked up in table (pattern_table) """
+    fwd, back = pattern_codes(bits, r, c, k, pidx)
+    entry = table[fwd, back]
+    return entry >> PATTERN_FLAG_BITS, entry & ((1 << PATTERN_FLAG_BITS) - 1)
+
+if __name__ == '__main__':
+    print(f'Pattern table cached in {pattern_table_path()}')
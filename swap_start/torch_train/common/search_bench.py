@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import os, sys, time, json, glob, platform
+import importlib.util
+import numpy as np
+
+board_size = 15
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_positions')
+phases = ('early', 'middle', 'late')
+# lower edges of the bins of the DNN batch size histogram
+batch_bins = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+def format_board(state, last_move):
+    """ Return the text of state as read by read_board_state, last_move (0-based) is marked with X or O """
+    lines = ['    ' + ' '.join(chr(97+i) for i in range(board_size)), '   ' + '='*(2*board_size)]
+    for r in range(board_size):
+        row = []
+        for c in range(board_size):
+            s = {1: 'x', -1: 'o', 0: '-'}[int(state[r, c])]
+            row.append(s.upper() if (r, c) == tuple(last_move) else s)
+        lines.append(f'{r+1:2d}| ' + ' '.join(row))
+    return '\n'.join(lines) + '\n'
+
+def load_corpus(path=corpus_dir):
+    """
+    Read the positions in the .txt files of path with read_board_state, the file name starts with the phase of the game
+    Return a list of dicts with the name, phase, board_state, and for the kernels the state, the player to move
+    and the last move (0-based) of the other player
+    """
+    from AIPlayer import read_board_state, convert_board_state
+    corpus = []
+    for fnm in sorted(glob.glob(os.path.join(path, '*.txt'))):
+        name = os.path.splitext(os.path.basename(fnm))[0]
+        board_state = read_board_state(fnm)
+        board, last_move, playing, _ = board_state
+        corpus.append(dict(name=name, phase=name.split('_')[0], board_state=board_state,
+                           state=convert_board_state(board_state), player=-1 if playing else 1,
+                           last_move=(last_move[0]-1, last_move[1]-1)))
+    return corpus
+
+def load_module(path):
+    """
+    Import the AIPlayer module at path, e.g. one of the copies in other folders
+    The modules it imports from its folder are imported again from there, instead of reusing the ones of this folder
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    for fnm in glob.glob(os.path.join(folder, '*.py')):
+        sys.modules.pop(os.path.splitext(os.path.basename(fnm))[0], None)
+    sys.path.insert(0, folder)
+    spec = importlib.util.spec_from_file_location('bench_player', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class LinearModel:
+    """ Stand-in for the DNN with fixed random weights, so the searches are the same in every run without a model file """
+
+    def __init__(self, seed=0):
+        self.w = np.random.RandomState(seed).normal(0, 0.05, size=3*board_size**2).astype(np.float32)
+
+    def predict(self, x):
+        return np.tanh(x.reshape(len(x), -1) @ self.w)[:,None]
+
+class CountingModel:
+    """ Model that records the batch size and the time of each predict of model """
+
+    def __init__(self, model):
+        self.model = model
+        self.batch_sizes = []
+        self.seconds = 0.0
+
+    def predict(self, x):
+        t0 = time.time()
+        y = self.model.predict(x)
+        self.seconds += time.time() - t0
+        self.batch_sizes.append(len(x))
+        return y
+
+class CountingCache:
+    """ Cache that counts the hits and misses of get() on cache """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, *args, **kwargs):
+        q = self.cache.get(*args, **kwargs)
+        if q is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return q
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+def batch_histogram(batch_sizes):
+    """ Number of batches in each bin of batch_bins, keyed by the bin's range """
+    counts = np.histogram(batch_sizes, bins=batch_bins + [np.inf])[0]
+    names = [f'{lo}-{hi-1}' if hi - lo > 1 else f'{lo}' for lo, hi in zip(batch_bins, batch_bins[1:])] + [f'{batch_bins[-1]}+']
+    return {name: int(n) for name, n in zip(names, counts)}
+
+def time_calls(f, min_time):
+    """ Call f until min_time seconds pass, return (number of calls, seconds) """
+    n = 0
+    t0 = time.time()
+    while True:
+        for _ in range(10):
+            f()
+        n += 10
+        seconds = time.time() - t0
+        if seconds >= min_time:
+            return n, seconds
+
+def bench_kernels(module, corpus, min_time=0.2):
+    """
+    Throughput of the numba kernels of module on each phase of corpus, for the ones module has:
+    find_interesting_moves for the player to move, i_will_win with the last move, i_lost for the player to move
+    """
+    move_interest_values = np.zeros((board_size, board_size), dtype=np.float32)
+    move_interest_values[4:11, 4:11] = 5.0
+    kernels = {
+        'find_interesting_moves': lambda p: lambda: module.find_interesting_moves(p['state'], int(np.sum(p['state'] == 0)), move_interest_values, p['player'], 20),
+        'i_will_win': lambda p: lambda: module.i_will_win(p['state'], p['last_move'], -p['player']),
+        'i_lost': lambda p: lambda: module.i_lost(p['state'], p['player']),
+    }
+    results = {}
+    for name, make_call in kernels.items():
+        if not hasattr(module, name):
+            print(f'{name}: not in {module.__file__}, skipped')
+            continue
+        # compile before timing
+        make_call(corpus[0])()
+        results[name] = {}
+        for phase in phases + ('all',):
+            positions = [p for p in corpus if phase in (p['phase'], 'all')]
+            if not positions:
+                continue
+            n_calls, seconds = 0, 0.0
+            for p in positions:
+                n, s = time_calls(make_call(p), min_time / len(positions))
+                n_calls += n
+                seconds += s
+            results[name][phase] = dict(calls_per_sec=n_calls/seconds, us_per_call=seconds/n_calls*1e6)
+            print(f'{name:24s} {phase:7s} {n_calls/seconds:12.0f} calls/s')
+    return results
+
+def bench_search(module, corpus, model, level=1, pruning=False, leaf_batch=0):
+    """
+    Search each position of corpus with a new AIPlayer of module and an empty cache, with leaf_batch as its leaf_batch_size
+    Return the move, q, nodes, time, DNN batches and cache hits of each position, and their sums by phase
+    interior_nodes are the calls of best_action_q, including the nodes ended by a win, a forced move or a VCF,
+    nodes are the interior nodes and the leaves evaluated with DNN, the leaves found in the cache are not counted
+    """
+    # compile before timing
+    module.AIPlayer('Bench', model, level=0).strategy(corpus[0]['board_state'])
+    positions = {}
+    for p in corpus:
+        counting_model = CountingModel(model)
+        player = module.AIPlayer('Bench', counting_model, level=level, pruning=pruning)
+        player.leaf_batch_size = leaf_batch
+        player.cache = CountingCache(player.cache)
+        # count the interior nodes by counting the calls of best_action_q, which call it again through the instance
+        interior_nodes = [0]
+        best_action_q = player.best_action_q
+        def counting_best_action_q(*args, **kwargs):
+            interior_nodes[0] += 1
+            return best_action_q(*args, **kwargs)
+        player.best_action_q = counting_best_action_q
+        t0 = time.time()
+        move, q = player.strategy(p['board_state'])
+        seconds = time.time() - t0
+        dnn_positions = int(sum(counting_model.batch_sizes))
+        nodes = interior_nodes[0] + dnn_positions
+        positions[p['name']] = dict(phase=p['phase'], move=[int(move[0]), int(move[1])], q=float(q), nodes=nodes, interior_nodes=interior_nodes[0], seconds=seconds,
+                                    model_seconds=counting_model.seconds, dnn_calls=len(counting_model.batch_sizes),
+                                    dnn_positions=dnn_positions, batch_sizes=counting_model.batch_sizes,
+                                    cache_hits=player.cache.hits, cache_misses=player.cache.misses)
+        print(f"{p['name']:12s} move {(int(move[0]), int(move[1]))} q {q:6.3f} | {nodes:7d} nodes ({interior_nodes[0]} interior) {seconds:7.2f}s {nodes/seconds:8.0f} nodes/s | "
+              f"{len(counting_model.batch_sizes)} DNN calls | cache hits {player.cache.hits} misses {player.cache.misses}")
+    summary = {}
+    for phase in phases + ('all',):
+        rs = [r for r in positions.values() if phase in (r['phase'], 'all')]
+        if not rs:
+            continue
+        total = {k: sum(r[k] for r in rs) for k in ('nodes', 'interior_nodes', 'seconds', 'model_seconds', 'dnn_calls', 'dnn_positions', 'cache_hits', 'cache_misses')}
+        summary[phase] = dict(total, moves=len(rs), nodes_per_sec=total['nodes']/total['seconds'], time_per_move=total['seconds']/len(rs),
+                              cache_hit_rate=total['cache_hits']/max(total['cache_hits']+total['cache_misses'], 1),
+                              batch_size_histogram=batch_histogram([b for r in rs for b in r['batch_sizes']]))
+    for r in positions.values():
+        del r['batch_sizes']
+    return dict(positions=positions, phases=summary)
+
+def check_leaf_batch(module, corpus, model, level=1, leaf_batch=256):
+    """
+    Check that the search with pruning doesn't evaluate more positions with DNN when leaf_batch_size is set,
+    the leaves prefetched ahead would be evaluated even when a cutoff skips their subtree
+    """
+    without = bench_search(module, corpus, model, level, pruning=True)['positions']
+    with_batch = bench_search(module, corpus, model, level, pruning=True, leaf_batch=leaf_batch)['positions']
+    failed = [name for name in without if with_batch[name]['dnn_positions'] > without[name]['dnn_positions']]
+    for name in failed:
+        print(f"{name}: {with_batch[name]['dnn_positions']} positions evaluated with leaf_batch_size {leaf_batch}, "
+              f"{without[name]['dnn_positions']} without")
+    print(f"Pruning with leaf_batch_size {leaf_batch}: {'FAILED' if failed else 'OK'}")
+    return not failed
+
+def compare(old, new):
+    """ Print the changes of the kernel throughput and the search speed from the results old to new, and the changed moves """
+    for name, by_phase in new.get('kernels', {}).items():
+        for phase, r in by_phase.items():
+            if phase in old.get('kernels', {}).get(name, {}):
+                before = old['kernels'][name][phase]['calls_per_sec']
+                print(f"{name:24s} {phase:7s} {before:12.0f} -> {r['calls_per_sec']:12.0f} calls/s {r['calls_per_sec']/before-1:+7.1%}")
+    if 'search' in new and 'search' in old:
+        # the nodes of older results are only the interior nodes, compare them with the interior nodes and the time per move
+        counted = 'nodes' if 'interior_nodes' in old['search']['phases'].get('all', {}) else 'interior_nodes'
+        if counted == 'interior_nodes':
+            print('The old results count only the interior nodes, rerun them to compare the nodes/s')
+        for phase, r in new['search']['phases'].items():
+            if phase in old['search']['phases']:
+                o = old['search']['phases'][phase]
+                speed = ''
+                if counted == 'nodes':
+                    speed = f"{o['nodes_per_sec']:9.0f} -> {r['nodes_per_sec']:9.0f} nodes/s {r['nodes_per_sec']/o['nodes_per_sec']-1:+7.1%} | "
+                print(f"search {phase:7s} {speed}{o['time_per_move']:.3f} -> {r['time_per_move']:.3f} s/move | "
+                      f"{counted} {o['nodes']} -> {r[counted]}")
+        for name, r in new['search']['positions'].items():
+            o = old['search']['positions'].get(name)
+            if o is not None and (o['move'] != r['move'] or o['nodes'] != r[counted]):
+                print(f"{name}: move {o['move']} -> {r['move']}, {counted} {o['nodes']} -> {r[counted]}")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser("Benchmark the search kernels and the search on a fixed set of positions",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-c', '--corpus', default=corpus_dir, help='Folder of the positions, early_*.txt, middle_*.txt and late_*.txt')
+    parser.add_argument('-m', '--module', help='AIPlayer.py to benchmark, the one in this folder if not given')
+    parser.add_argument('-M', '--model', help='Model file to search with, a fixed random linear model if not given')
+    parser.add_argument('-e', '--level', type=int, default=1, help='Search level')
+    parser.add_argument('-p', '--pruning', action='store_true', help='Search with alpha-beta pruning')
+    parser.add_argument('-L', '--leaf_batch', type=int, default=0, help='leaf_batch_size of the search')
+    parser.add_argument('--check_leaf_batch', action='store_true', help="Only check that leaf_batch (256 if 0) doesn't add DNN evaluations to the search with pruning")
+    parser.add_argument('-t', '--min_time', type=float, default=0.2, help='Seconds to time each kernel on each phase')
+    parser.add_argument('-k', '--kernels_only', action='store_true', help='Skip the search benchmark')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='JSON file of the results')
+    parser.add_argument('-C', '--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+    corpus = load_corpus(args.corpus)
+    print(f"{len(corpus)} positions from {args.corpus}")
+    if args.module is not None:
+        module = load_module(args.module)
+    else:
+        import AIPlayer as module
+    if args.model is not None:
+        from dnn_model import load_existing_model
+        model = load_existing_model(args.model)
+    else:
+        model = LinearModel()
+    if args.check_leaf_batch:
+        sys.exit(0 if check_leaf_batch(module, corpus, model, args.level, args.leaf_batch or 256) else 1)
+    import numba
+    results = dict(module=os.path.abspath(module.__file__), model=args.model, level=args.level, pruning=args.pruning,
+                   time=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(), numpy=np.__version__, numba=numba.__version__)
+    results['kernels'] = bench_kernels(module, corpus, args.min_time)
+    if not args.kernels_only:
+        if not hasattr(module, 'AIPlayer'):
+            print(f'No AIPlayer in {module.__file__}, search skipped')
+        else:
+            results['search'] = bench_search(module, corpus, model, args.level, args.pruning, args.leaf_batch)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+import numba
+import numpy as np
+from bitboard import new_bitboard, set_bitboard, place_stone, remove_stone, is_five, count_five_spots, count_five_spots_near, may_make_n
+
+board_size = 15
+
+# zobrist keys used by the threat search hash table, [0] for black stones, [1] for white stones
+threat_keys = np.random.RandomState(5).randint(1, 2**63, size=(2, board_size, board_size), dtype=np.int64)
+
+def new_threat_table(size=2**14):
+    """ Hash table used by vcf_search() to remember the states already known to have no VCF
+    size has to be a power of 2 """
+    return np.zeros(size, dtype=np.int64)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def put(state, bits, r, c, player):
+    """ Put a stone of player at (r,c) on both state and its bitboard, or remove the stone if player == 0 """
+    state[r,c] = player
+    if player == 0:
+        remove_stone(bits, r, c)
+    else:
+        place_stone(bits, r, c, player)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def vcf_search(state, player, max_nodes, table):
+    """ Search for a victory by continuous fours (VCF) for player, who is about to move
+    Only moves making a four are tried, and the opponent has to block the only spot to make 5
+    The search stops after max_nodes moves were tried
+
+    input:
+    -------
+    state: numpy.array board_size x board_size, 1=black, -1=white, 0=empty, will be restored when returned
+    player: the attacker, 1=black, -1=white
+    max_nodes: int, the limit of searched moves
+    table: numpy.array int64 from new_threat_table(), remembers states without VCF, cleared here
+
+    output:
+    -------
+    r * board_size + c of the first winning move, or -1 if no VCF found
+    """
+    table[:] = 0
+    h = 0
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] == 1:
+                h ^= threat_keys[0,r,c]
+            elif state[r,c] == -1:
+                h ^= threat_keys[1,r,c]
+    bits = new_bitboard()
+    set_bitboard(bits, state)
+    n_nodes = np.zeros(1, dtype=np.int64)
+    return vcf_node(state, bits, player, h, max_nodes, n_nodes, table)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def vcf_node(state, bits, player, h, max_nodes, n_nodes, table):
+    """ One attacker node of vcf_search, bits is the bitboard of state, h is the hash of state, n_nodes[0] counts the searched moves """
+    mask = len(table) - 1
+    if table[h & mask] == h:
+        return -1
+    five_spots = np.empty((2, 2), dtype=np.int64)
+    # win directly if I can make 5
+    if count_five_spots(bits, player, five_spots) > 0:
+        return five_spots[0,0] * board_size + five_spots[0,1]
+    # if the opponent can make 5, the only choice is to block it
+    n_opponent_five = count_five_spots(bits, -player, five_spots)
+    if n_opponent_five > 1:
+        return -1
+    pidx = 0 if player == 1 else 1
+    oidx = 1 - pidx
+    for r in range(board_size):
+        for c in range(board_size):
+            if n_opponent_five == 1 and (r != five_spots[0,0] or c != five_spots[0,1]):
+                continue
+            if state[r,c] != 0 or not may_make_n(bits, r, c, player, 3):
+                continue
+            if n_nodes[0] >= max_nodes:
+                return -1
+            n_nodes[0] += 1
+            put(state, bits, r, c, player)
+            block_spots = np.empty((2, 2), dtype=np.int64)
+            n_block = count_five_spots_near(bits, r, c, player, block_spots)
+            result = -1
+            if n_block >= 2:
+                # open four or double four, the opponent can't block both
+                result = r * board_size + c
+            elif n_block == 1:
+                br, bc = block_spots[0,0], block_spots[0,1]
+                # the opponent wins if blocking makes 5
+                if not is_five(bits, br, bc, -player):
+                    put(state, bits, br, bc, -player)
+                    next_h = h ^ threat_keys[pidx,r,c] ^ threat_keys[oidx,br,bc]
+                    if vcf_node(state, bits, player, next_h, max_nodes, n_nodes, table) >= 0:
+                        result = r * board_size + c
+                    put(state, bits, br, bc, 0)
+            put(state, bits, r, c, 0)
+            if result >= 0:
+                return result
+    # only remember the state when the search was not stopped by max_nodes
+    if n_nodes[0] < max_nodes:
+        table[h & mask] = h
+    return -1
+
+# key xor-ed into the hash when white is the attacker, so the same stones with different attackers differ
+threat_side_key = np.int64(np.random.RandomState(7).randint(1, 2**63, dtype=np.int64))
+
+def new_proof_table(size=2**16):
+    """ Hash table used by vct_search() to cache the proved and disproved states
+    keys are the hashes of states, values are r * board_size + c of the winning move if proved,
+    or -(depth+1) if disproved when searching with depth
+    size has to be a power of 2 """
+    return np.zeros(size, dtype=np.int64), np.zeros(size, dtype=np.int16)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def add_spot(spots, n, r, c):
+    """ Add (r,c) to the first n spots if it's not there and there is room, return the new n """
+    for i in range(n):
+        if spots[i,0] == r and spots[i,1] == c:
+            return n
+    if n < len(spots):
+        spots[n,0] = r
+        spots[n,1] = c
+        n += 1
+    return n
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def find_three_defenses(state, bits, r, c, player, defenses):
+    """ player just placed a stone at (r,c) without making a four
+    Find the spots where player can win next move with an open four or double four,
+    together with the spots to make 5 after that. The opponent has to take one of them (or make a four),
+    otherwise player wins. Store them in defenses (n x 2) and return the number found, 0 if it's no threat """
+    directions = ((1,1), (1,0), (0,1), (1,-1))
+    five_spots = np.empty((2, 2), dtype=np.int64)
+    n = 0
+    for dr, dc in directions:
+        for k in range(-4, 5):
+            ext_r, ext_c = r + k*dr, c + k*dc
+            if k == 0 or ext_r < 0 or ext_r >= board_size or ext_c < 0 or ext_c >= board_size:
+                continue
+            if state[ext_r, ext_c] != 0 or not may_make_n(bits, ext_r, ext_c, player, 3):
+                continue
+            put(state, bits, ext_r, ext_c, player)
+            if count_five_spots_near(bits, ext_r, ext_c, player, five_spots) >= 2:
+                n = add_spot(defenses, n, ext_r, ext_c)
+                n = add_spot(defenses, n, five_spots[0,0], five_spots[0,1])
+                n = add_spot(defenses, n, five_spots[1,0], five_spots[1,1])
+            put(state, bits, ext_r, ext_c, 0)
+    return n
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def find_double_four_spot(state, bits, player):
+    """ Return r * board_size + c of a spot where player makes an open four or double four, -1 if none """
+    five_spots = np.empty((2, 2), dtype=np.int64)
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] != 0 or not may_make_n(bits, r, c, player, 3):
+                continue
+            put(state, bits, r, c, player)
+            n = count_five_spots_near(bits, r, c, player, five_spots)
+            put(state, bits, r, c, 0)
+            if n >= 2:
+                return r * board_size + c
+    return -1
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def vct_search(state, player, max_depth, max_nodes, table_keys, table_values):
+    """ Search for a victory by continuous threats (VCT) for player, who is about to move
+    The attacker tries moves making a four or an open three, using at most max_depth moves
+    The defender tries all spots stopping the threat, and all moves making a four (counter four)
+    The search stops after max_nodes moves were tried, a proof is always correct,
+    but no VCT found doesn't mean there is no VCT
+
+    input:
+    -------
+    state: numpy.array board_size x board_size, 1=black, -1=white, 0=empty, will be restored when returned
+    player: the attacker, 1=black, -1=white
+    max_depth: int, the max number of attacker moves
+    max_nodes: int, the limit of searched moves
+    table_keys, table_values: numpy.array from new_proof_table(), kept between searches
+
+    output:
+    -------
+    r * board_size + c of the first winning move, or -1 if no VCT found
+    """
+    h = 0
+    for r in range(board_size):
+        for c in range(board_size):
+            if state[r,c] == 1:
+                h ^= threat_keys[0,r,c]
+            elif state[r,c] == -1:
+                h ^= threat_keys[1,r,c]
+    if player == -1:
+        h ^= threat_side_key
+    bits = new_bitboard()
+    set_bitboard(bits, state)
+    n_nodes = np.zeros(1, dtype=np.int64)
+    return vct_node(state, bits, player, h, max_depth, max_nodes, n_nodes, table_keys, table_values)
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def vct_node(state, bits, player, h, depth, max_nodes, n_nodes, table_keys, table_values):
+    """ One attacker node of vct_search, bits is the bitboard of state, h is the hash of state, n_nodes[0] counts the searched moves """
+    mask = len(table_keys) - 1
+    i_table = h & mask
+    if table_keys[i_table] == h:
+        if table_values[i_table] >= 0:
+            return table_values[i_table]
+        elif -table_values[i_table] - 1 >= depth:
+            return -1
+    five_spots = np.empty((2, 2), dtype=np.int64)
+    # win directly if I can make 5
+    if count_five_spots(bits, player, five_spots) > 0:
+        return five_spots[0,0] * board_size + five_spots[0,1]
+    # if the opponent can make 5, the only choice is to block it
+    n_opponent_five = count_five_spots(bits, -player, five_spots)
+    if n_opponent_five > 1:
+        return -1
+    if n_opponent_five == 0:
+        # win if I can make an open four or double four
+        win_move = find_double_four_spot(state, bits, player)
+        if win_move >= 0:
+            return win_move
+    if depth <= 0:
+        return -1
+    pidx = 0 if player == 1 else 1
+    oidx = 1 - pidx
+    block_spots = np.empty((2, 2), dtype=np.int64)
+    defenses = np.empty((64, 2), dtype=np.int64)
+    # try fours first, then threes
+    for making_four in (True, False):
+        for r in range(board_size):
+            for c in range(board_size):
+                if n_opponent_five == 1 and (r != five_spots[0,0] or c != five_spots[0,1]):
+                    continue
+                if state[r,c] != 0:
+                    continue
+                if making_four and not may_make_n(bits, r, c, player, 3):
+                    continue
+                if not making_four and not may_make_n(bits, r, c, player, 2):
+                    continue
+                if n_nodes[0] >= max_nodes:
+                    return -1
+                n_nodes[0] += 1
+                put(state, bits, r, c, player)
+                next_h = h ^ threat_keys[pidx,r,c]
+                n_block = count_five_spots_near(bits, r, c, player, block_spots)
+                proved = False
+                if n_block >= 2:
+                    proved = True
+                elif n_block == 1 and making_four:
+                    # the opponent has to block the four, and wins if blocking makes 5
+                    br, bc = block_spots[0,0], block_spots[0,1]
+                    if not is_five(bits, br, bc, -player):
+                        put(state, bits, br, bc, -player)
+                        proved = vct_node(state, bits, player, next_h ^ threat_keys[oidx,br,bc], depth-1, max_nodes, n_nodes, table_keys, table_values) >= 0
+                        put(state, bits, br, bc, 0)
+                elif n_block == 0 and not making_four:
+                    n_defense = find_three_defenses(state, bits, r, c, player, defenses)
+                    if n_defense > 0:
+                        # the opponent can also make a four somewhere else first
+                        for dr in range(board_size):
+                            for dc in range(board_size):
+                                if state[dr,dc] == 0 and may_make_n(bits, dr, dc, -player, 3):
+                                    put(state, bits, dr, dc, -player)
+                                    if count_five_spots_near(bits, dr, dc, -player, block_spots) > 0:
+                                        n_defense = add_spot(defenses, n_defense, dr, dc)
+                                    put(state, bits, dr, dc, 0)
+                        # I win only if every defense fails
+                        proved = True
+                        for i in range(n_defense):
+                            dr, dc = defenses[i,0], defenses[i,1]
+                            put(state, bits, dr, dc, -player)
+                            defended = vct_node(state, bits, player, next_h ^ threat_keys[oidx,dr,dc], depth-1, max_nodes, n_nodes, table_keys, table_values) < 0
+                            put(state, bits, dr, dc, 0)
+                            if defended:
+                                proved = False
+                                break
+                        # too many defenses to store, can't prove it
+                        if n_defense >= len(defenses):
+                            proved = False
+                put(state, bits, r, c, 0)
+                if proved:
+                    table_keys[i_table] = h
+                    table_values[i_table] = r * board_size + c
+                    return r * board_size + c
+    # only remember the state when the search was not stopped by max_nodes
+    if n_nodes[0] < max_nodes:
+        table_keys[i_table] = h
+        table_values[i_table] = -depth - 1
+    return -1
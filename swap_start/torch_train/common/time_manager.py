@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+
+class TimeManager:
+    """
+    Allocate the thinking time of each move from the time left on the game clock
+    budget() gives a soft limit, after which the search shouldn't start a deeper iteration,
+    and a hard limit, when the search has to stop and play the best move found so far
+    adjust() changes the soft limit with the spread of q among the candidate moves after the first iteration
+    """
+
+    def __init__(self, moves_to_go=30, min_moves_to_go=10, reserve=5.0, min_time=0.2, hard_factor=4.0, max_fraction=0.2):
+        # the expected number of my moves left at the start of a game, fewer are expected as the game goes on
+        self.moves_to_go = moves_to_go
+        self.min_moves_to_go = min_moves_to_go
+        # seconds kept for the delays of reading the screen and placing stones
+        self.reserve = reserve
+        self.min_time = min_time
+        # the hard limit is hard_factor times the soft limit, but at most max_fraction of the time left
+        self.hard_factor = hard_factor
+        self.max_fraction = max_fraction
+
+    def budget(self, time_left, n_stones):
+        """ Return (soft, hard) seconds to think for the next move, n_stones is the number of stones on the board """
+        moves_left = max(self.moves_to_go - n_stones // 2, self.min_moves_to_go)
+        usable = max(time_left - self.reserve, 0.0)
+        soft = max(usable / moves_left, self.min_time)
+        hard = max(min(soft * self.hard_factor, usable * self.max_fraction), soft)
+        return soft, hard
+
+    def adjust(self, soft, qs):
+        """
+        Return the soft limit for the position where the candidate moves have the win rates qs (for the player to move)
+        No more time for a forced move or a known result, less for a clear best move, more when the best ones are close
+        """
+        if len(qs) <= 1:
+            return 0.0
+        best, second = sorted(qs, reverse=True)[:2]
+        if abs(best) >= 1.0:
+            return 0.0
+        gap = best - second
+        if gap > 0.3:
+            return soft * 0.5
+        elif gap < 0.05:
+            return soft * 2.0
+        return soft